@@ -0,0 +1,122 @@
+# ------------------------------------------------------------------------------
+# Name:        Acceptance criteria
+# Purpose:     Acceptance criteria for the LNS heuristic (maximization of supply).
+#              Decides whether a neighbor replaces the current solution of the search,
+#              See Pisinger and Ropke, Large Neighborhood Search in Handbook of Metaheuristics.
+#              improvement      - accept only strict improvements (the original behaviour)
+#              annealing        - simulated annealing, accept worse solutions w.p. exp(delta/T)
+#              late_acceptance  - late acceptance hill climbing (Burke and Bykov)
+#              threshold        - threshold accepting (Dueck and Scheuer)
+# ------------------------------------------------------------------------------
+
+import math
+import random
+
+
+class ImprovementAcceptance(object):
+    """
+    Accept a neighbor only if it strictly improves the current solution.
+    """
+
+    def accept(self, candidate_value, current_value):
+        return candidate_value > current_value
+
+
+class SimulatedAnnealingAcceptance(object):
+    """
+    Accept improvements, and worse solutions with probability exp((candidate - current)/temperature).
+    The temperature is multiplied by cooling_rate after every decision (cooling_rate=1 keeps it fixed,
+    as used by the replicas of parallel tempering).
+    """
+
+    def __init__(self, temperature, cooling_rate=1.0, min_temperature=1e-9):
+        self.temperature = temperature
+        self.cooling_rate = cooling_rate
+        self.min_temperature = min_temperature
+
+    def accept(self, candidate_value, current_value):
+        if candidate_value > current_value:
+            accepted = True
+        elif self.temperature <= self.min_temperature:
+            accepted = False
+        else:
+            accepted = random.random() < math.exp((candidate_value - current_value) / self.temperature)
+        self.temperature = max(self.min_temperature, self.temperature * self.cooling_rate)
+        return accepted
+
+
+class LateAcceptance(object):
+    """
+    Late acceptance hill climbing: accept a neighbor if it is not worse than the current solution,
+    or than the value of the current solution history_length decisions ago.
+    """
+
+    def __init__(self, history_length, initial_value):
+        self.history = [initial_value] * max(1, int(history_length))
+        self.iteration = 0
+
+    def accept(self, candidate_value, current_value):
+        position = self.iteration % len(self.history)
+        accepted = candidate_value >= current_value or candidate_value >= self.history[position]
+        # the history holds the value of the current solution after each decision
+        self.history[position] = candidate_value if accepted else current_value
+        self.iteration += 1
+        return accepted
+
+
+class ThresholdAcceptance(object):
+    """
+    Threshold accepting: accept a neighbor unless it is worse than the current solution by more than threshold.
+    The threshold is multiplied by decay after every decision.
+    """
+
+    def __init__(self, threshold, decay=1.0):
+        self.threshold = threshold
+        self.decay = decay
+
+    def accept(self, candidate_value, current_value):
+        accepted = candidate_value > current_value - self.threshold
+        self.threshold *= self.decay
+        return accepted
+
+
+def create_acceptance_criterion(name, temperature, cooling_rate, history_length, initial_value):
+    """
+    Create an acceptance criterion by name.
+    :param name: one of improvement, annealing, late_acceptance, threshold
+    :param temperature: initial temperature (annealing) or threshold (threshold), in objective units
+    :param cooling_rate: multiplier of the temperature/threshold after every decision
+    :param history_length: history length (late_acceptance)
+    :param initial_value: objective value of the initial solution (late_acceptance)
+    :return: an object with an accept(candidate_value, current_value) method
+    """
+    if name == 'improvement':
+        return ImprovementAcceptance()
+    elif name == 'annealing':
+        return SimulatedAnnealingAcceptance(temperature, cooling_rate)
+    elif name == 'late_acceptance':
+        return LateAcceptance(history_length, initial_value)
+    elif name == 'threshold':
+        return ThresholdAcceptance(temperature, cooling_rate)
+    raise ValueError('Unknown acceptance criterion: ' + str(name))
+
+
+def tempering_ladder(max_temperature, min_temperature, num_replicas):
+    """
+    Geometric temperature ladder for parallel tempering, from the hottest to the coldest replica.
+    """
+    if num_replicas == 1:
+        return [min_temperature]
+    ratio = (float(min_temperature) / max_temperature) ** (1.0 / (num_replicas - 1))
+    return [max_temperature * ratio ** i for i in range(num_replicas)]
+
+
+def swap_probability(value_i, temperature_i, value_j, temperature_j):
+    """
+    Probability of exchanging the states of two parallel tempering replicas (maximization).
+    :return: min(1, exp((value_j - value_i) * (1/temperature_i - 1/temperature_j)))
+    """
+    exponent = (value_j - value_i) * (1.0 / temperature_i - 1.0 / temperature_j)
+    if exponent >= 0:
+        return 1.0
+    return math.exp(exponent)
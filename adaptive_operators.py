@@ -0,0 +1,109 @@
+# ------------------------------------------------------------------------------
+# Name:        Adaptive operator selection
+# Purpose:     Roulette wheel selection of LNS operators with adaptive weights (ALNS),
+#              See Pisinger and Ropke, Large Neighborhood Search in Handbook of Metaheuristics.
+#              Each operator's weight is updated at the end of every segment of iterations,
+#              according to the improvements it found per CPU-second spent on it.
+#              Operators which rarely pay off are thus selected less often (but never disabled).
+# ------------------------------------------------------------------------------
+
+import random
+import time
+
+# time.clock was removed in python 3.8, process_time does not exist in python 2
+if hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+else:
+    cpu_time = time.clock
+
+
+class AdaptiveOperatorSelector(object):
+    """
+    Roulette wheel over a set of named operators.
+    Usage: name = selector.select(), do the work, then selector.record(name, improved, cpu_seconds)
+    """
+
+    def __init__(self, operators, segment_length=25, reaction_factor=0.2, min_weight=0.05, adaptive=True):
+        """
+        :param operators: dictionary {operator name: operator parameters}, parameters are returned by select()
+        :param segment_length: number of recorded uses after which the weights are updated
+        :param reaction_factor: how fast weights react to the last segment (0 = static, 1 = only last segment)
+        :param min_weight: lower bound of a weight, so that every operator keeps being sampled occasionally
+        :param adaptive: if False the weights are never updated (plain uniform selection)
+        """
+        self.operators = operators
+        self.names = sorted(operators.keys())
+        self.segment_length = segment_length
+        self.reaction_factor = reaction_factor
+        self.min_weight = min_weight
+        self.adaptive = adaptive
+        self.weights = {name: 1.0 for name in self.names}
+        # statistics of the current segment
+        self.segment_uses = 0
+        self.segment_improvements = {name: 0.0 for name in self.names}
+        self.segment_time = {name: 0.0 for name in self.names}
+        # overall statistics
+        self.total_uses = {name: 0 for name in self.names}
+        self.total_improvements = {name: 0 for name in self.names}
+        self.total_time = {name: 0.0 for name in self.names}
+
+    def select(self):
+        """
+        Select an operator with probability proportional to its weight.
+        :return: the name of the selected operator
+        """
+        if len(self.names) == 1:
+            return self.names[0]
+        target = random.uniform(0, sum(self.weights.values()))
+        for name in self.names:
+            target -= self.weights[name]
+            if target <= 0:
+                return name
+        return self.names[-1]
+
+    def parameters(self, name):
+        return self.operators[name]
+
+    def record(self, name, improved, cpu_seconds):
+        """
+        Record the outcome of using an operator.
+        :param name: the operator used
+        :param improved: did the neighbor created by the operator improve the incumbent?
+        :param cpu_seconds: time spent on the operator, including the evaluation of the neighbor
+        """
+        self.segment_uses += 1
+        self.segment_improvements[name] += improved
+        self.segment_time[name] += cpu_seconds
+        self.total_uses[name] += 1
+        self.total_improvements[name] += improved
+        self.total_time[name] += cpu_seconds
+        if self.segment_uses >= self.segment_length:
+            self.update_weights()
+
+    def update_weights(self):
+        """
+        Update weights according to the improvements per CPU-second of the last segment.
+        Rates are normalized by the mean rate of the operators used in the segment,
+        operators which were not used in the segment retain their weight.
+        """
+        used = [name for name in self.names if self.segment_time[name] > 0]
+        if self.adaptive and used:
+            rates = {name: self.segment_improvements[name] / self.segment_time[name] for name in used}
+            mean_rate = sum(rates.values()) / len(used)
+            for name in used:
+                relative_rate = rates[name] / mean_rate if mean_rate > 0 else 1.0
+                self.weights[name] = max(self.min_weight, (1 - self.reaction_factor) * self.weights[name] +
+                                         self.reaction_factor * relative_rate)
+        self.segment_uses = 0
+        self.segment_improvements = {name: 0.0 for name in self.names}
+        self.segment_time = {name: 0.0 for name in self.names}
+
+    def statistics(self):
+        """
+        :return: rows of [operator, weight, uses, improvements, improvement_rate, cpu_time, improvements_per_cpu_sec]
+        """
+        return [[name, self.weights[name], self.total_uses[name], self.total_improvements[name],
+                 float(self.total_improvements[name]) / self.total_uses[name] if self.total_uses[name] else 0,
+                 self.total_time[name],
+                 self.total_improvements[name] / self.total_time[name] if self.total_time[name] > 0 else 0]
+                for name in self.names]
@@ -0,0 +1,418 @@
+# ------------------------------------------------------------------------------
+# Name:        Batch runner
+# Purpose:     Run a batch of experiments (a parameter grid) from a single python process, instead of
+#              a .bat file with a `python main_program.py ...` line per run.
+#              The runs are executed by --workers long lived worker processes. A worker imports the heavy
+#              libraries and preloads every instance of the batch into memory once, when it starts, and then
+#              executes runs one after the other: it imports the run's program afresh with the run's arguments
+#              (the programs parse their arguments on import) and calls its main_program(). This does not
+#              depend on fork, so it works the same on windows, where multiprocessing spawns new processes.
+#              Each run has a wall clock time limit, after which its worker is terminated (killed if it does not
+#              exit within TERMINATE_TIMEOUT seconds) and replaced by a new one. The outcome of every run is
+#              appended to a single results file.
+#              With --queue, the runs are jobs of a durable queue (a SQLite database, see job_queue.py): a batch
+#              interrupted by a crash or a reboot is continued by running the runner again with the same queue.
+#              Heuristic runs checkpoint their search periodically, and an interrupted job resumes from its
+#              last checkpoint instead of restarting.
+#              The parameter grid is one of:
+#              .csv  - a run per row, a 'program' column (default main_program.py) and a column per argument
+#                      (without the --). Empty cells are omitted, flags are set by true/false.
+#              .yaml - a list of {program: ..., parameters: {argument: value or list of values}}, a run per
+#                      combination of the listed values (requires pyyaml).
+#              .bat  - the existing batch files, a run per `python program.py arguments` line.
+#              Example: python batch_runner.py --grid gaya_final_runs.bat --workers 4 --queue gaya_final_runs.sqlite
+#                       (after a reboot: python batch_runner.py --queue gaya_final_runs.sqlite --workers 4)
+# ------------------------------------------------------------------------------
+
+import argparse
+import csv
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import shlex
+import signal
+import sys
+import time
+import traceback
+from instance_loader import preload_instance
+from job_queue import JobQueue
+import exit_handlers
+import results_store
+import telemetry
+import profiling
+
+DEFAULT_PROGRAM = 'main_program.py'
+DEFAULT_TIME_LIMIT = 1.0  # hours, the default --time_limit of the programs
+TERMINATE_TIMEOUT = 10.0  # seconds a terminated worker is given to exit, before it is killed
+CHECKPOINT_PROGRAMS = ['robustness_heuristic_upper_bound.py']  # programs supporting --checkpoint_file
+RESULT_COLUMNS = ['run_id', 'program', 'arguments', 'status', 'exit_code', 'start_time', 'wall_time', 'result']
+
+
+# ************************************************
+# ********* Reading the parameter grid ***********
+# ************************************************
+
+def arguments_from_parameters(parameters):
+    """
+    :param parameters: dictionary {argument: value}, True/False values are flags
+    :return: the command line arguments, sorted by argument name
+    """
+    arguments = []
+    for name in sorted(parameters.keys()):
+        value = parameters[name]
+        if value is None or value is False or str(value).strip().lower() in ('', 'false'):
+            continue
+        arguments.append('--' + name)
+        if value is not True and str(value).strip().lower() != 'true':
+            arguments.append(str(value).strip())
+    return arguments
+
+
+def read_csv_grid(filename):
+    runs = []
+    with open(filename, 'r') as csv_file:
+        for row in csv.DictReader(csv_file):
+            program = (row.pop('program', '') or DEFAULT_PROGRAM).strip()
+            runs.append((program, arguments_from_parameters(row)))
+    return runs
+
+
+def read_yaml_grid(filename):
+    import yaml  # optional, only required for yaml grids
+    with open(filename, 'r') as yaml_file:
+        entries = yaml.safe_load(yaml_file)
+    runs = []
+    for entry in entries:
+        parameters = entry.get('parameters', dict())
+        names = sorted(parameters.keys())
+        values = [parameters[name] if isinstance(parameters[name], list) else [parameters[name]] for name in names]
+        for combination in itertools.product(*values):
+            runs.append((entry.get('program', DEFAULT_PROGRAM), arguments_from_parameters(dict(zip(names, combination)))))
+    return runs
+
+
+def read_bat_grid(filename):
+    runs = []
+    with open(filename, 'r') as bat_file:
+        for line in bat_file:
+            tokens = shlex.split(line.strip(), posix=False)
+            if len(tokens) >= 2 and tokens[0].lower() in ('python', 'python.exe') and tokens[1].endswith('.py'):
+                runs.append((tokens[1], tokens[2:]))
+    return runs
+
+
+def read_grid(filename):
+    """
+    :param filename: a .csv, .yaml (.yml) or .bat parameter grid
+    :return: list of runs (program, list of arguments)
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        return read_csv_grid(filename)
+    if extension in ('.yaml', '.yml'):
+        return read_yaml_grid(filename)
+    if extension == '.bat':
+        return read_bat_grid(filename)
+    raise ValueError('Unknown parameter grid format: ' + filename)
+
+
+def argument_value(arguments, name, default=None):
+    """
+    :return: the value of --name in the command line arguments (default if missing)
+    """
+    if '--' + name in arguments:
+        position = arguments.index('--' + name)
+        if position + 1 < len(arguments):
+            return arguments[position + 1]
+    return default
+
+
+# ************************************************
+# ********* Executing runs ***********************
+# ************************************************
+
+def execute_run(program, arguments, log_filename):
+    """
+    Executes a single run in a worker process: imports the program afresh with the run's arguments (the programs
+    parse their arguments on import) and calls its main_program().
+    :return: the outcome (status, summary of the returned value, exit code)
+    """
+    stdout, stderr = sys.stdout, sys.stderr
+    log_file = None
+    if log_filename:
+        log_file = open(log_filename, 'w')
+        sys.stdout = log_file
+        sys.stderr = log_file
+    sys.argv = [program] + list(arguments)
+    module_name = os.path.splitext(os.path.basename(program))[0]
+    sys.modules.pop(module_name, None)  # the previous run's module, with the previous run's arguments
+    profiling.reset()
+    try:
+        module = importlib.import_module(module_name)
+        outcome = ('completed', summarize_result(module.main_program()), 0)
+    except SystemExit as exit_error:
+        exit_code = exit_error.code if isinstance(exit_error.code, int) else (0 if exit_error.code is None else 1)
+        if exit_code - 128 in (signal.SIGTERM, signal.SIGINT):
+            terminate_worker(exit_code - 128)  # a signal handler of the run turned the signal into an exit
+        outcome = ('completed' if exit_code == 0 else 'failed', str(exit_error.code), exit_code)
+    except Exception:
+        outcome = ('failed', traceback.format_exc().strip().split('\n')[-1], 1)
+    exit_handlers.run_all()  # the run's outputs are complete once its outcome is reported
+    telemetry.stop_reporting()  # the next run of the worker may serve its metrics on the same port
+    sys.stdout.flush()
+    sys.stdout, sys.stderr = stdout, stderr
+    if log_file is not None:
+        log_file.close()
+    return outcome
+
+
+def terminate_worker(signal_number):
+    """
+    End the worker process by a termination signal, after flushing the run's outputs (the runner does not wait
+    for an outcome of a terminated run, and replaces its worker).
+    """
+    exit_handlers.run_all()
+    sys.stdout.flush()
+    exit_handlers.terminate(signal_number)
+
+
+def worker_loop(instance_names, connection):
+    """
+    The main loop of a worker process: preload the instances, then execute the runs received through connection
+    (program, arguments, log file name), one after the other, and send back their outcomes. None stops the worker.
+    """
+    warm_up(instance_names)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break  # the runner is gone
+        if task is None:
+            break
+        connection.send(execute_run(*task))
+    connection.close()
+
+
+class RunWorker(object):
+    """
+    A long lived worker process (see worker_loop). Usage: worker = RunWorker(instances); worker.start_run(...);
+    worker.connection.poll(); worker.connection.recv(); worker.stop()
+    """
+
+    def __init__(self, instance_names):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_loop, args=(instance_names, worker_connection))
+        self.process.start()
+        worker_connection.close()
+        self.job = None  # the job in progress: (job id, start time, time limit, program, arguments)
+
+    def start_run(self, job, log_filename):
+        self.connection.send((job[3], job[4], log_filename))
+        self.job = job
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join()
+
+    def terminate(self):
+        """
+        Terminate the worker (SIGTERM, the run flushes its outputs), and kill it if it does not exit in time.
+        """
+        self.process.terminate()
+        self.process.join(TERMINATE_TIMEOUT)
+        if self.process.is_alive() and hasattr(signal, 'SIGKILL'):
+            os.kill(self.process.pid, signal.SIGKILL)  # on windows, terminate() already kills the process
+        self.process.join()
+
+
+def summarize_result(value):
+    """
+    :return: the scalar entries of a run's returned value, as json (empty if the run returns no dictionary)
+    """
+    if not isinstance(value, dict):
+        return ''
+    scalars = {str(key): item for key, item in value.items() if isinstance(item, (int, float, str))}
+    return json.dumps(scalars, sort_keys=True) if scalars else ''
+
+
+def run_time_limit(arguments, limit_hours, grace_minutes):
+    """
+    :return: the wall clock time limit of a run in seconds: limit_hours if positive, otherwise the run's own
+             --time_limit (hours) plus a grace period
+    """
+    if limit_hours > 0:
+        return limit_hours*60*60
+    return float(argument_value(arguments, 'time_limit', DEFAULT_TIME_LIMIT))*60*60 + grace_minutes*60
+
+
+def append_result(results_filename, row):
+    write_header = not os.path.exists(results_filename)
+    with open(results_filename, 'a') as results_file:
+        writer = csv.writer(results_file)
+        if write_header:
+            writer.writerow(RESULT_COLUMNS)
+        writer.writerow([row[column] for column in RESULT_COLUMNS])
+
+
+def batch_instances(runs):
+    """
+    :return: the instances of the runs (their --instance_location)
+    """
+    return sorted(set([argument_value(arguments, 'instance_location') for program, arguments in runs]) - set([None]))
+
+
+def warm_up(instance_names):
+    """
+    Import the heavy libraries and preload the instances into memory, in a worker process before its first run.
+    """
+    for module_name in ['networkx', 'numpy', 'cplex']:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass
+    for instance_name in instance_names:
+        try:
+            # the instance location exactly as the programs build it
+            preload_instance(os.getcwd() + '\\' + instance_name + '\\')
+        except (IOError, OSError):
+            print("Could not preload instance " + instance_name + ", its runs load it themselves")
+
+
+def job_arguments(queue, job, checkpoint_directory):
+    """
+    :return: the command line arguments of a job, with a checkpoint file for programs which support checkpoints
+             (the same file in every attempt of the job, so that an interrupted job resumes from it)
+    """
+    arguments = list(job['arguments'])
+    if checkpoint_directory and os.path.basename(job['program']) in CHECKPOINT_PROGRAMS and \
+            argument_value(arguments, 'checkpoint_file') is None:
+        checkpoint = job['checkpoint']
+        if not checkpoint:
+            checkpoint = os.path.join(checkpoint_directory, 'job_' + str(job['job_id']) + '.checkpoint')
+            queue.set_checkpoint(job['job_id'], checkpoint)
+        arguments += ['--checkpoint_file', checkpoint]
+    return arguments
+
+
+def run_batch(queue, results_filename, num_workers=1, limit_hours=0.0, grace_minutes=10.0, log_directory='',
+              checkpoint_directory='', poll_interval=0.5):
+    """
+    Execute the pending jobs of the queue, up to num_workers at a time, and append their outcomes to the results file.
+    :param queue: a JobQueue
+    :param checkpoint_directory: directory of the jobs' checkpoint files (empty for no checkpoints)
+    :return: dictionary {status: number of runs}
+    """
+    num_pending = queue.counts().get('pending', 0)
+    instance_names = batch_instances(queue.pending_runs())
+    if checkpoint_directory and not os.path.isdir(checkpoint_directory):
+        os.makedirs(checkpoint_directory)
+    workers = [RunWorker(instance_names) for _ in range(max(1, min(num_workers, num_pending)))]
+    status_count = dict()
+    while True:
+        for position, worker in enumerate(workers):
+            if worker.job is not None:
+                continue
+            job = queue.claim()
+            if job is None:
+                break
+            if not worker.process.is_alive():
+                worker = workers[position] = RunWorker(instance_names)  # instead of a terminated (or crashed) worker
+            run_id, program = job['job_id'], job['program']
+            arguments = job_arguments(queue, job, checkpoint_directory)
+            log_filename = os.path.join(log_directory, 'run_' + str(run_id) + '.log') if log_directory else ''
+            worker.start_run((run_id, time.time(), run_time_limit(arguments, limit_hours, grace_minutes), program,
+                              arguments), log_filename)
+            print("Started job " + str(run_id) + " (" + str(len([cur_worker for cur_worker in workers
+                                                                  if cur_worker.job is not None])) +
+                  " running, " + str(num_pending) + " queued at start): " + program + " " + " ".join(arguments))
+        if all([worker.job is None for worker in workers]):
+            break
+        time.sleep(poll_interval)
+        for position, worker in enumerate(workers):
+            if worker.job is None:
+                continue
+            run_id, start_time, time_limit, program, arguments = worker.job
+            outcome = None
+            if worker.connection.poll():
+                try:
+                    outcome = worker.connection.recv()
+                except EOFError:
+                    pass  # the worker died while reporting, handled as a crash below
+            if outcome is None and worker.process.is_alive() and time.time() - start_time > time_limit:
+                worker.terminate()
+                outcome = ('timeout', '', worker.process.exitcode)
+            elif outcome is None and not worker.process.is_alive():
+                outcome = ('failed', '', worker.process.exitcode)  # terminated without an outcome (e.g., crashed)
+            if outcome is None:
+                continue
+            worker.job = None
+            wall_time = round(time.time() - start_time, 3)
+            queue.finish(run_id, outcome[0], outcome[2], wall_time, outcome[1])
+            append_result(results_filename, {'run_id': run_id, 'program': program, 'arguments': ' '.join(arguments),
+                                             'status': outcome[0], 'exit_code': outcome[2],
+                                             'start_time': time.strftime('%d-%m-%Y %H:%M:%S',
+                                                                         time.localtime(start_time)),
+                                             'wall_time': wall_time, 'result': outcome[1]})
+            status_count[outcome[0]] = status_count.get(outcome[0], 0) + 1
+            print("Job " + str(run_id) + " " + outcome[0] + " after " + str(round(wall_time, 1)) + " sec.")
+    for worker in workers:
+        if worker.process.is_alive():
+            worker.stop()
+    return status_count
+
+
+# ****************************************************
+# *************** Run the program ********************
+# ****************************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a batch of experiments from a parameter grid, in a single process.")
+    parser.add_argument('--grid', help="The parameter grid: a .csv, .yaml or .bat file", type=str, default="")
+    parser.add_argument('--workers', help="Number of runs executed at a time [default 1]", type=int, default=1)
+    parser.add_argument('--run_time_limit', help="Wall clock time limit of every run, in hours, after which it is "
+                                                 "terminated [default 0 = the run's --time_limit plus a grace period]",
+                        type=float, default=0.0)
+    parser.add_argument('--grace_period', help="Minutes added to a run's --time_limit before it is terminated "
+                                               "[default 10]", type=float, default=10.0)
+    parser.add_argument('--results_file', help="The results file, a row is appended per run "
+                                               "[default: batch_results.csv in the GRID_CASCADE_OUTPUT directory, or "
+                                               "c:/temp/grid_cascade_output on windows]",
+                        type=str, default="")
+    parser.add_argument('--queue', help="A durable job queue (SQLite database): the grid's runs are added to it, and "
+                                        "its pending and interrupted jobs are run. Without --grid, an existing queue "
+                                        "is continued [default: an in-memory queue of the grid's runs]",
+                        type=str, default="")
+    parser.add_argument('--retry', help="Return the failed and timed out jobs of the queue to pending (timed out "
+                                        "heuristic runs continue from their checkpoint)", action="store_true")
+    parser.add_argument('--checkpoint_directory', help="Directory of the heuristic runs' checkpoints "
+                                                       "[default: QUEUE_checkpoints next to the queue]",
+                        type=str, default="")
+    parser.add_argument('--log_directory', help="Write the output of each run into run_ID.log in this directory, "
+                                                "instead of the screen", type=str, default="")
+    args = parser.parse_args()
+
+    if not args.grid and not args.queue:
+        parser.error("Provide a parameter grid (--grid) or a job queue (--queue)")
+    if not args.results_file:
+        args.results_file = results_store.output_path('batch_results.csv')
+    job_queue = JobQueue(args.queue if args.queue else ':memory:')
+    recovered = job_queue.recover()
+    if recovered:
+        print("Recovered " + str(recovered) + " interrupted jobs")
+    if args.retry:
+        print("Retrying " + str(job_queue.retry()) + " jobs")
+    if args.grid:
+        job_queue.add(read_grid(args.grid))
+        print("Queued the runs of " + args.grid)
+    checkpoints = ''
+    if args.queue:
+        checkpoints = args.checkpoint_directory if args.checkpoint_directory else \
+            os.path.splitext(args.queue)[0] + '_checkpoints'
+    status_summary = run_batch(job_queue, args.results_file, args.workers, args.run_time_limit, args.grace_period,
+                               args.log_directory, checkpoints)
+    job_queue.close()
+    print("Batch completed: " + ", ".join([status + " " + str(count) for status, count in sorted(status_summary.items())]))
@@ -0,0 +1,330 @@
+# ------------------------------------------------------------------------------
+# Name:        Cascade simulation benchmark
+# Purpose:     A reproducible benchmark of the cascade simulation (cfe and compute_current_supply of
+#              robustness_heuristic_upper_bound.py) across the bundled instances, instead of ad hoc timings
+#              from .bat files and spreadsheets.
+#              Every instance is simulated on fixed designs: the base grid, and --random_designs designs
+#              which upgrade a fixed fraction of the edges, drawn from a seeded generator (the same designs on
+#              every machine and every run). Large scenario sets can be cut down to a seeded sample.
+#              Reported per instance and design: the time of every scenario's cascade and its depth, the time
+#              of every step of the pipeline (build the grid, update the grid, build and solve the flow
+#              problem, detect the failures - see profiling.py), the throughput (scenarios and cascade steps
+#              per second), and the peak memory of the instance (every instance is benchmarked in a child
+#              process of its own, which sends its results back to be stored).
+#              The flow problems are solved by CPLEX, or by the model builder's least squares solve (--backend
+#              matrix, and whenever CPLEX is not installed, see model_builder.py).
+#              The results are stored (benchmark_summary, benchmark_scenarios and benchmark_steps tables of a
+#              results store, see results_store.py), labeled by the flow backend, and a run is compared
+#              to a baseline run (--baseline) to detect regressions.
+#              Usage: python benchmark_cascade.py --instances instance24,instance30 --baseline previous
+# ------------------------------------------------------------------------------
+
+import argparse
+import ctypes
+import importlib
+import multiprocessing
+import os
+import sys
+from timeit import default_timer
+import numpy
+import model_builder
+import profiling
+from instance_loader import load_instance
+from results_store import ResultsStore, output_path, set_output_directory
+from solution_vector import EdgeUniverse
+
+try:
+    import resource  # peak memory (not available on windows, see windows_peak_memory)
+except ImportError:
+    resource = None
+
+BENCHMARK_INSTANCES = ['adi_simple1', 'case30', 'instance24', 'instance30', 'instance39', 'instance57',
+                       'instance118', 'instance300', 'israel_transmission_synthetic']
+BENCHMARK_FILENAME = 'benchmark.sqlite'
+SIMULATOR_PROGRAM = 'robustness_heuristic_upper_bound.py'
+
+
+def import_simulator(backend):
+    """
+    Import the cascade simulator (the heuristic parses its arguments on import - its own outputs are disabled).
+    :param backend: cplex to solve the flow problems with CPLEX, or matrix to solve them with the model builder
+    :return: the simulator module
+    """
+    sys.argv = [SIMULATOR_PROGRAM, '--export_results_tracking', 'False', '--results_store', ':memory:',
+                '--flow_backend', backend]
+    return importlib.import_module(os.path.splitext(SIMULATOR_PROGRAM)[0])
+
+
+class ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong),
+                ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+
+def windows_peak_memory():
+    """
+    :return: the peak working set of the process in bytes (GetProcessMemoryInfo), None if unavailable
+    """
+    try:
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        return None
+
+
+def peak_memory_mb():
+    """
+    :return: the peak resident memory of the process in MB (None if unavailable)
+    """
+    if resource is None:
+        peak = windows_peak_memory() if os.name == 'nt' else None
+        return None if peak is None else peak / 1024.0**2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0**2 if sys.platform == 'darwin' else peak / 1024.0  # bytes on mac, KB elsewhere
+
+
+def benchmark_designs(universe, num_random_designs, upgrade_fraction, upgrade_capacity, establish_capacity, seed):
+    """
+    :param universe: the instance's EdgeUniverse
+    :param num_random_designs: number of upgraded designs (in addition to the base grid)
+    :param upgrade_fraction: fraction of the edges upgraded (or established) in an upgraded design
+    :param upgrade_capacity: capacity added to an upgraded existing edge
+    :param establish_capacity: capacity of an established edge
+    :param seed: the upgraded design k is drawn by numpy.random.RandomState(seed + k)
+    :return: list of (design name, capacity vector)
+    """
+    designs = [('base', universe.initial_solution())]
+    num_upgrades = max(1, int(round(upgrade_fraction*universe.num_edges)))
+    for k in range(num_random_designs):
+        generator = numpy.random.RandomState(seed + k)
+        capacities = universe.initial_solution()
+        for position in generator.choice(universe.num_edges, min(num_upgrades, universe.num_edges), replace=False):
+            capacities[position] += upgrade_capacity if capacities[position] > 0 else establish_capacity
+        designs.append(('upgraded_' + str(seed + k), capacities))
+    return designs
+
+
+def benchmark_scenarios(scenarios, max_scenarios, seed):
+    """
+    :return: the scenario names (sorted), a sample of max_scenarios of them drawn by seed if max_scenarios > 0
+    """
+    scenario_list = sorted([key[1] for key in scenarios.keys() if key[0] == 's_pr'])
+    if 0 < max_scenarios < len(scenario_list):
+        sample = numpy.random.RandomState(seed).choice(len(scenario_list), max_scenarios, replace=False)
+        scenario_list = [scenario_list[i] for i in sorted(sample)]
+    return scenario_list
+
+
+def benchmark_instance(simulator, instance_name, args, store):
+    """
+    Benchmark the simulation of an instance on its designs, and store the results.
+    :param store: a ResultsStore, or a RowCollector
+    :return: the summary rows (dictionaries) of the instance
+    """
+    instance = load_instance(os.path.join(os.getcwd(), instance_name))
+    nodes = instance.nodes()
+    edges = instance.edges()
+    scenarios = instance.scenarios()
+    scenario_list = benchmark_scenarios(scenarios, args.max_scenarios, args.seed)
+    scenario_set = set(scenario_list)
+    scenario_subset = {key: value for key, value in scenarios.items() if key[1] in scenario_set}
+    universe = EdgeUniverse(nodes, edges)
+    summaries = []
+    for design, capacities in benchmark_designs(universe, args.random_designs, args.upgrade_fraction,
+                                                args.upgrade_capacity, args.establish_capacity, args.seed):
+        for repeat in range(args.repeats):
+            labels = {'instance': instance_name, 'design': design, 'backend': args.backend, 'repeat': repeat}
+            profiling.reset()
+            with profiling.span('build_grid'):
+                power_grid = universe.to_grid(capacities)
+            # the cascade of every scenario
+            scenario_times = []
+            cascade_steps = 0
+            for cur_scenario in scenario_list:
+                start_time = default_timer()
+                failed_grid = simulator.cfe(power_grid.copy(), scenarios.get(('s', cur_scenario), []))
+                scenario_times.append(default_timer() - start_time)
+                cascade_steps += failed_grid['t']
+                store.append('benchmark_scenarios', dict(labels, scenario=cur_scenario,
+                                                         time=scenario_times[-1], cascade_depth=failed_grid['t'],
+                                                         failures=len(failed_grid['all_failed'])))
+            # the supply of the design (as evaluated by the heuristic)
+            start_time = default_timer()
+            with profiling.span('compute_current_supply'):
+                outcome = simulator.compute_current_supply(power_grid, scenario_subset)
+            supply_time = default_timer() - start_time
+            store.extend('benchmark_steps', [dict(labels, **dict(zip(profiling.REPORT_COLUMNS, row)))
+                                             for row in profiling.report()])
+            simulation_time = sum(scenario_times)
+            summary = dict(labels, num_nodes=len(universe.node_list), num_edges=universe.num_edges,
+                           num_scenarios=len(scenario_list), simulation_time=simulation_time,
+                           mean_scenario_time=simulation_time/len(scenario_list) if scenario_list else 0.0,
+                           max_scenario_time=max(scenario_times) if scenario_times else 0.0,
+                           compute_current_supply_time=supply_time, cascade_steps=cascade_steps,
+                           scenarios_per_sec=len(scenario_list)/simulation_time if simulation_time > 0 else 0.0,
+                           cascade_steps_per_sec=cascade_steps/simulation_time if simulation_time > 0 else 0.0,
+                           supply=outcome['supply'], peak_memory_mb=peak_memory_mb())
+            store.append('benchmark_summary', summary)
+            summaries.append(summary)
+            print(instance_name + " " + design + " (repeat " + str(repeat) + "): " + str(len(scenario_list)) +
+                  " scenarios in " + str(round(simulation_time, 3)) + " sec. (" +
+                  str(round(summary['scenarios_per_sec'], 1)) + " scenarios/sec., " +
+                  str(round(summary['cascade_steps_per_sec'], 1)) + " cascade steps/sec.), compute_current_supply " +
+                  str(round(supply_time, 3)) + " sec., supply " + str(round(outcome['supply'], 3)))
+    return summaries
+
+
+class RowCollector(object):
+    """
+    Collects the rows of an instance's benchmark in its child process (in place of the store, which is written by
+    the parent).
+    """
+
+    def __init__(self):
+        self.rows = []  # list of (table, row)
+
+    def append(self, table, row):
+        self.rows.append((table, row))
+
+    def extend(self, table, rows):
+        for row in rows:
+            self.append(table, row)
+
+
+def instance_worker(instance_name, args, connection):
+    """
+    Benchmark an instance in a child process (its peak memory is then the instance's own), and send the rows.
+    """
+    simulator = import_simulator(args.backend)  # already imported in a forked process
+    profiling.enable()
+    collector = RowCollector()
+    benchmark_instance(simulator, instance_name, args, collector)
+    connection.send(collector.rows)
+    connection.close()
+
+
+def benchmark_instance_process(instance_name, args, store):
+    """
+    Benchmark an instance in a child process, and store its rows.
+    """
+    connection, worker_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=instance_worker, args=(instance_name, args, worker_connection))
+    process.start()
+    worker_connection.close()
+    try:
+        rows = connection.recv()
+    except EOFError:
+        rows = None  # the process failed before sending its rows
+    process.join()
+    if rows is None:
+        store.close()
+        sys.exit("Error: the benchmark of " + instance_name + " failed (exit code " + str(process.exitcode) + ")")
+    for table, row in rows:
+        store.append(table, row)
+    store.flush()
+
+
+# ****************************************************
+# ************* Regression comparison ****************
+# ****************************************************
+
+def previous_run_id(store):
+    """
+    :return: the latest run of the store before the store's own run, which has benchmark results (None if none)
+    """
+    row = store.connection.execute('SELECT run_id FROM runs WHERE program = ? AND run_id < ? AND run_id IN '
+                                   '(SELECT run_id FROM benchmark_summary) ORDER BY run_id DESC LIMIT 1',
+                                   ('benchmark_cascade.py', store.run_id)).fetchone()
+    return None if row is None else row[0]
+
+
+def mean_scenario_times(store, run_id):
+    """
+    :return: dictionary {(instance, design): (backend, mean time per scenario over the repeats)} of a run
+    """
+    return {(instance, design): (backend, mean_time) for instance, design, backend, mean_time in
+            store.connection.execute('SELECT instance, design, backend, AVG(mean_scenario_time) FROM '
+                                     'benchmark_summary WHERE run_id = ? GROUP BY instance, design, backend',
+                                     (run_id,)).fetchall()}
+
+
+def compare_to_baseline(store, baseline_run_id, threshold):
+    """
+    Compare the mean scenario times of the store's run to those of a baseline run.
+    :param threshold: a slowdown above this ratio (e.g., 0.1 = 10%) is reported as a regression
+    :return: number of regressions
+    """
+    store.flush()
+    baseline = mean_scenario_times(store, baseline_run_id)
+    current = mean_scenario_times(store, store.run_id)
+    regressions = 0
+    print("Comparison to run " + baseline_run_id + " (mean time per scenario):")
+    for key in sorted(set(baseline.keys()) & set(current.keys())):
+        (baseline_backend, baseline_time), (current_backend, current_time) = baseline[key], current[key]
+        ratio = current_time / baseline_time if baseline_time > 0 else 1.0
+        regression = ratio > 1 + threshold
+        regressions += regression
+        print("   " + key[0] + " " + key[1] + ": " + baseline_backend + " " + str(round(baseline_time, 5)) +
+              " -> " + current_backend + " " + str(round(current_time, 5)) + " sec. (x" + str(round(ratio, 3)) +
+              ")" + (" REGRESSION" if regression else ""))
+    return regressions
+
+
+# ****************************************************
+# *************** Run the program ********************
+# ****************************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the cascade simulation across the bundled instances.")
+    parser.add_argument('--instances', help="Comma separated instance directories [default: all bundled instances]",
+                        type=str, default=",".join(BENCHMARK_INSTANCES))
+    parser.add_argument('--random_designs', help="Number of upgraded designs per instance, in addition to the base "
+                                                 "grid [default 2]", type=int, default=2)
+    parser.add_argument('--upgrade_fraction', help="Fraction of the edges upgraded in an upgraded design "
+                                                   "[default 0.1]", type=float, default=0.1)
+    parser.add_argument('--upgrade_capacity', help="Capacity added to an upgraded edge [default 5.0]",
+                        type=float, default=5.0)
+    parser.add_argument('--establish_capacity', help="Capacity of an established edge [default 5.0]",
+                        type=float, default=5.0)
+    parser.add_argument('--max_scenarios', help="Simulate a seeded sample of this many scenarios per instance "
+                                                "[default 0 = all the scenarios]", type=int, default=0)
+    parser.add_argument('--seed', help="Seed of the designs and the scenario sample [default 0]", type=int, default=0)
+    parser.add_argument('--repeats', help="Number of times each design is simulated [default 1]", type=int, default=1)
+    parser.add_argument('--backend', help="cplex to solve the flow problems with CPLEX, or matrix to solve them by "
+                                          "least squares with the model builder (the default without CPLEX)",
+                        type=str, default="cplex", choices=['cplex', 'matrix'])
+    parser.add_argument('--output_directory', help="Directory of the benchmark store [default: the "
+                                                   "GRID_CASCADE_OUTPUT environment variable, or "
+                                                   "c:/temp/grid_cascade_output on windows]", type=str, default="")
+    parser.add_argument('--results_store', help="The benchmark store, a SQLite database "
+                                                "[default: benchmark.sqlite in the output directory]",
+                        type=str, default="")
+    parser.add_argument('--baseline', help="Compare to the results of this run (a run_id of the store), or to the "
+                                           "previous run (previous) [default: no comparison]", type=str, default="")
+    parser.add_argument('--regression_threshold', help="A slowdown above this ratio is a regression [default 0.1]",
+                        type=float, default=0.1)
+    args = parser.parse_args()
+
+    simulator = import_simulator(args.backend)
+    if simulator.flow_solver is model_builder:  # the simulator's fallback without CPLEX
+        args.backend = 'matrix'
+    set_output_directory(args.output_directory)  # after the simulator's import, which sets its own
+    store = ResultsStore(args.results_store if args.results_store else output_path(BENCHMARK_FILENAME),
+                         'benchmark_cascade.py', vars(args))
+    for instance_name in args.instances.split(','):
+        benchmark_instance_process(instance_name.strip(), args, store)
+    num_regressions = 0
+    if args.baseline:
+        baseline_run_id = previous_run_id(store) if args.baseline == 'previous' else args.baseline
+        if baseline_run_id is None:
+            print("No previous benchmark run to compare to.")
+        else:
+            num_regressions = compare_to_baseline(store, baseline_run_id, args.regression_threshold)
+    print("Benchmark run " + store.run_id + " stored in " + store.filename)
+    store.close()
+    sys.exit(1 if num_regressions else 0)
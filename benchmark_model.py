@@ -0,0 +1,203 @@
+# ------------------------------------------------------------------------------
+# Name:        Model benchmark
+# Purpose:     A benchmark of building the robust optimization problem (main_program.py), separately from the
+#              speed of the simulation: the time of build_cplex_problem/create_cplex_object (or of
+#              build_benders_master with --use_benders) and the size of the model (rows, columns, non zeros),
+#              per instance and number of scenarios, and the overhead of the lazy callback - the split of its
+#              time between compute_failures (the cascade simulations), build_cfe_constraints (building the cuts)
+#              and self.add (adding them).
+#              The model is built with CPLEX, or without it by the model builder (--backend matrix, and
+#              whenever CPLEX is not installed, see model_builder.py), which records the model as matrices
+#              (--write_matrices). The lazy callback is called through a mock callback harness
+#              (model_builder.MockCallback) on seeded candidate solutions, so no branch and bound is involved.
+#              The results are stored in the benchmark_model and benchmark_model_steps tables of the benchmark
+#              store (see benchmark_cascade.py).
+#              Usage: python benchmark_model.py --instances instance24,instance30 --scenario_counts 1,10,50
+# ------------------------------------------------------------------------------
+
+import argparse
+import importlib
+import os
+import random
+import sys
+from timeit import default_timer
+import numpy
+import model_builder
+import profiling
+from benchmark_cascade import BENCHMARK_INSTANCES, BENCHMARK_FILENAME, benchmark_scenarios
+from instance_loader import load_instance
+from results_store import ResultsStore, output_path, set_output_directory
+
+PROGRAM = 'main_program.py'
+CALLBACK_SPANS = ['compute_failures', 'cut_building', 'cut_adding', 'cascade_simulation', 'flow_solve',
+                  'benders_subproblems']
+
+
+def import_program(args):
+    """
+    Import main_program.py (it parses its arguments on import - its own outputs are disabled).
+    :return: the program module
+    """
+    sys.argv = [PROGRAM, '--results_store', ':memory:', '--incumbent_display_frequency', '0',
+                '--output_directory', args.output_directory, '--budget', str(args.budget),
+                '--flow_backend', args.backend] + \
+        (['--use_benders'] if args.use_benders else []) + \
+        (['--disable_dvar_priorities'] if args.disable_priorities else [])
+    return importlib.import_module(os.path.splitext(PROGRAM)[0])
+
+
+def model_size(model):
+    """
+    :return: (rows, columns, non zeros) of a model (cplex or model_builder)
+    """
+    return model.linear_constraints.get_num(), model.variables.get_num(), \
+        model.linear_constraints.get_num_nonzeros()
+
+
+def candidate_solution(program, num_columns, upgrade_probability, generator):
+    """
+    A candidate solution of the lazy callback: edges upgraded (and established) at random, and only the scenarios'
+    initial failures failed.
+    """
+    values = [0.0]*num_columns
+    for cur_edge in program.all_edges:
+        upgraded = generator.rand() < upgrade_probability
+        values[program.dvar_pos[('c', cur_edge)]] = 1.0*upgraded
+        if ('X_', cur_edge) in program.dvar_pos:
+            values[program.dvar_pos[('X_', cur_edge)]] = 1.0*upgraded
+    for key, cur_pos in program.dvar_pos.items():
+        if key[0] == 'F' and key[1] in program.scenarios.get(('s', key[2]), []):
+            values[cur_pos] = 1.0
+        elif key[0] == 'eta':
+            values[cur_pos] = program.benders_upper_bound
+    return values
+
+
+def call_lazy_callback(program, values):
+    """
+    Call the program's lazy callback on a candidate solution, through the mock callback harness.
+    :return: the constraints added by the callback
+    """
+    callback_class = program.BendersLazy if program.args.use_benders else program.MyLazy
+    harness = model_builder.MockCallback(values)
+    call = callback_class.__call__
+    getattr(call, '__func__', call)(harness)  # the callback's code, run on the harness
+    return harness.added
+
+
+def benchmark_instance(program, instance_name, args, store):
+    """
+    Benchmark building the problem of an instance for each scenario count, and its lazy callback.
+    """
+    instance = load_instance(os.path.join(os.getcwd(), instance_name))
+    program.nodes = instance.nodes()
+    program.edges = instance.edges(program.load_capacity_factor, program.line_establish_cost_coef_scale,
+                                   program.line_upgrade_cost_coef_scale)
+    program.edge_index = program.EdgeIndex([(min(i[1], i[2]), max(i[1], i[2])) for i in program.edges.keys()
+                                            if i[0] == 'c'])
+    program.params = {'C': args.budget}
+    all_scenarios = instance.scenarios()
+    for scenario_count in [int(count) for count in args.scenario_counts.split(',')]:
+        scenario_set = set(benchmark_scenarios(all_scenarios, scenario_count, args.seed))
+        program.scenarios = {key: value for key, value in all_scenarios.items() if key[1] in scenario_set}
+        program.best_incumbent = 0
+        program.dominance_index = None
+        labels = {'instance': instance_name, 'num_scenarios': len(scenario_set), 'backend': args.backend,
+                  'formulation': 'benders' if args.use_benders else 'full'}
+        profiling.reset()
+        # building the problem
+        start_time = default_timer()
+        if args.use_benders:
+            build_results = program.build_benders_master()
+        else:
+            build_results = program.build_cplex_problem()
+        build_time = default_timer() - start_time
+        model = build_results['cplex_problem']
+        rows, columns, non_zeros = model_size(model)
+        if args.write_matrices and isinstance(model, model_builder.Cplex):
+            model.write(output_path('model_matrices', instance_name + '_' + str(len(scenario_set)) + '.npz'))
+        # the lazy callback
+        if args.use_benders:
+            program.init_benders_worker(program.nodes, program.edges, program.scenarios, program.dvar_pos,
+                                        program.edge_index, None)
+            program.benders_subproblems = program.ScenarioSubproblems(program.all_scenarios,
+                                                                      program.benders_subproblem, 1)
+        generator = numpy.random.RandomState(args.seed)
+        random.seed(args.seed)  # the partial simulations (--percent_short_runs) are drawn by random
+        profiling.reset()
+        callback_times = []
+        num_constraints = 0
+        for _ in range(args.callback_rounds):
+            values = candidate_solution(program, columns, args.upgrade_probability, generator)
+            start_time = default_timer()
+            num_constraints += len(call_lazy_callback(program, values))
+            callback_times.append(default_timer() - start_time)
+        report = {row[0]: row for row in profiling.report()}
+        store.extend('benchmark_model_steps', [dict(labels, **dict(zip(profiling.REPORT_COLUMNS, row)))
+                                               for row in report.values()])
+        summary = dict(labels, build_time=build_time, rows=rows, columns=columns, non_zeros=non_zeros,
+                       callbacks=len(callback_times), callback_time=sum(callback_times),
+                       mean_callback_time=sum(callback_times)/len(callback_times) if callback_times else 0.0,
+                       constraints_added=num_constraints)
+        for span_name in CALLBACK_SPANS:
+            summary[span_name + '_time'] = report[span_name][2] if span_name in report else 0.0
+        summary['cut_building_self_time'] = report['cut_building'][3] if 'cut_building' in report else 0.0
+        store.append('benchmark_model', summary)
+        simulation_span = 'benders_subproblems' if args.use_benders else 'compute_failures'
+        print(instance_name + " " + labels['formulation'] + " with " + str(len(scenario_set)) + " scenarios: built in " +
+              str(round(build_time, 3)) + " sec. (" + str(rows) + " rows, " + str(columns) + " columns, " +
+              str(non_zeros) + " non zeros). Lazy callback: " + str(round(summary['mean_callback_time'], 4)) +
+              " sec. per call (" + simulation_span + " " + str(round(summary[simulation_span + '_time'], 3)) +
+              ", building cuts " + str(round(summary['cut_building_self_time'], 3)) + ", adding cuts " +
+              str(round(summary['cut_adding_time'], 3)) + " sec. in total), " + str(num_constraints) +
+              " constraints added")
+
+
+# ****************************************************
+# *************** Run the program ********************
+# ****************************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark building the problem and its lazy callback.")
+    parser.add_argument('--instances', help="Comma separated instance directories [default: all bundled instances]",
+                        type=str, default=",".join(BENCHMARK_INSTANCES))
+    parser.add_argument('--scenario_counts', help="Comma separated numbers of scenarios (seeded samples of the "
+                                                  "instance's scenarios, 0 = all) [default 1,10,0]",
+                        type=str, default="1,10,0")
+    parser.add_argument('--backend', help="cplex to build the problem with CPLEX, or matrix to build it with the "
+                                          "model builder (the default without CPLEX)",
+                        type=str, default="cplex", choices=['cplex', 'matrix'])
+    parser.add_argument('--use_benders', help="Build the master problem of Bender's decomposition instead",
+                        action="store_true")
+    parser.add_argument('--budget', help="The budget constraint's right hand side [default 100]",
+                        type=float, default=100.0)
+    parser.add_argument('--disable_priorities', help="Build without the branching priorities "
+                                                     "(--disable_dvar_priorities)", action="store_true")
+    parser.add_argument('--callback_rounds', help="Number of lazy callback calls per model [default 5]",
+                        type=int, default=5)
+    parser.add_argument('--upgrade_probability', help="Probability of an edge upgrade in a candidate solution "
+                                                      "[default 0.1]", type=float, default=0.1)
+    parser.add_argument('--seed', help="Seed of the scenario samples and the candidate solutions [default 0]",
+                        type=int, default=0)
+    parser.add_argument('--write_matrices', help="Write the matrices of the models built by the model builder "
+                                                 "(model_matrices directory of the output directory)",
+                        action="store_true")
+    parser.add_argument('--output_directory', help="Directory of the benchmark store [default: the "
+                                                   "GRID_CASCADE_OUTPUT environment variable, or "
+                                                   "c:/temp/grid_cascade_output on windows]", type=str, default="")
+    parser.add_argument('--results_store', help="The benchmark store, a SQLite database "
+                                                "[default: benchmark.sqlite in the output directory]",
+                        type=str, default="")
+    args = parser.parse_args()
+
+    program = import_program(args)
+    if program.solver is model_builder:  # the program's fallback without CPLEX
+        args.backend = 'matrix'
+    set_output_directory(args.output_directory)  # after the program's import, which sets its own
+    store = ResultsStore(args.results_store if args.results_store else output_path(BENCHMARK_FILENAME),
+                         'benchmark_model.py', vars(args))
+    profiling.enable()
+    for instance_name in args.instances.split(','):
+        benchmark_instance(program, instance_name.strip(), args, store)
+        store.flush()
+    print("Benchmark run " + store.run_id + " stored in " + store.filename)
+    store.close()
@@ -0,0 +1,85 @@
+# ------------------------------------------------------------------------------
+# Name:        Benders decomposition
+# Purpose:     An integer L-shaped (combinatorial Benders) decomposition of the robust optimization problem.
+#              The master problem holds the binary investment decisions y and a value estimate eta_s of the
+#              supply in each scenario (maximizing sum_s pr(s)*eta_s). The subproblem of scenario s, given the
+#              master's design y*, is the cascade simulation of s on the upgraded grid, with supply Q_s(y*).
+#              The recourse is always feasible (the supply can drop down to 0), so only optimality cuts are
+#              required, one per scenario:
+#                  eta_s <= Q_s(y*) + (U - Q_s(y*)) * (sum_{i: y*_i = 1} (1 - y_i) + sum_{i: y*_i = 0} y_i)
+#              where U is an upper bound of the supply. The cut is tight at y* and redundant elsewhere.
+#              Subproblems of a design are solved in parallel worker processes, and cached per design.
+# ------------------------------------------------------------------------------
+
+import multiprocessing
+
+
+def optimality_cut(design_positions, design_values, value_position, value, upper_bound):
+    """
+    The optimality cut of a scenario at the master's design.
+    :param design_positions: positions of the binary design variables y
+    :param design_values: the design y* (ordered as design_positions)
+    :param value_position: position of the scenario's value estimate eta_s
+    :param value: the scenario's subproblem value at the design, Q_s(y*)
+    :param upper_bound: an upper bound U of the scenario's value
+    :return: (positions, coefficients, rhs) of the cut, with sense "L"
+    """
+    ones = [cur_pos for cur_pos, cur_value in zip(design_positions, design_values) if cur_value > 0.5]
+    zeros = [cur_pos for cur_pos, cur_value in zip(design_positions, design_values) if cur_value <= 0.5]
+    slope = upper_bound - value
+    return [value_position] + ones + zeros, [1.0] + [slope]*len(ones) + [-slope]*len(zeros), \
+        value + slope*len(ones)
+
+
+class ScenarioSubproblems(object):
+    """
+    Solves the scenario subproblems of master designs, in parallel worker processes.
+    Usage: values = subproblems.solve(design_key, master_solution); ...; subproblems.close()
+    """
+
+    def __init__(self, scenario_list, solve_chunk, num_workers=1, initializer=None, initargs=()):
+        """
+        :param scenario_list: the scenarios
+        :param solve_chunk: a (picklable, module level) function of (master solution, list of scenarios), returning
+                            a dictionary {scenario: value}
+        :param num_workers: number of worker processes (1 solves in the calling process)
+        :param initializer: initializer of the worker processes (e.g., setting the instance data as globals)
+        :param initargs: arguments of the initializer
+        """
+        self.scenario_list = list(scenario_list)
+        self.solve_chunk = solve_chunk
+        self.num_workers = max(1, min(num_workers, len(self.scenario_list)))
+        self.pool = None
+        if self.num_workers > 1:
+            self.pool = multiprocessing.Pool(self.num_workers, initializer=initializer, initargs=initargs)
+        self.cache = dict()
+        # statistics
+        self.num_solved = 0
+        self.num_cache_hits = 0
+
+    def solve(self, design_key, master_solution):
+        """
+        :param design_key: a hashable key of the master's design (e.g., the rounded binary values)
+        :param master_solution: the master solution, handed to solve_chunk
+        :return: dictionary {scenario: value}
+        """
+        if design_key in self.cache:
+            self.num_cache_hits += 1
+            return self.cache[design_key]
+        chunks = [self.scenario_list[i::self.num_workers] for i in range(self.num_workers)]
+        if self.pool is None:
+            chunk_values = [self.solve_chunk((master_solution, chunks[0]))]
+        else:
+            chunk_values = self.pool.map(self.solve_chunk, [(master_solution, cur_chunk) for cur_chunk in chunks])
+        values = dict()
+        for cur_values in chunk_values:
+            values.update(cur_values)
+        self.cache[design_key] = values
+        self.num_solved += 1
+        return values
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,102 @@
+# ------------------------------------------------------------------------------
+# Name:        Budget ledger
+# Purpose:     Incremental budget accounting for the LNS heuristic.
+#              The ledger tracks the investment cost of the working solution (a capacity vector,
+#              see solution_vector.py). Every capacity change goes through the ledger and costs O(1),
+#              instead of re-summing the upgrade and establishment costs over all edges.
+#              In debug mode every change is verified against a full recomputation.
+# ------------------------------------------------------------------------------
+
+import sys
+import numpy
+
+
+class BudgetLedger(object):
+    """
+    Tracks the cost spent by a solution vector: sum(h_ij*(c_ij - c0_ij)) + sum(H_ij*X_ij) over existing edges,
+    where X_ij indicates an edge which was established (does not exist in the original grid).
+    """
+
+    def __init__(self, universe, budget, capacities, debug=False):
+        """
+        :param universe: EdgeUniverse of the instance (original capacities and costs)
+        :param budget: the budget constraint
+        :param capacities: the solution vector which the ledger starts with
+        :param debug: verify every change against a full recomputation (slow, use for debugging only)
+        """
+        self.universe = universe
+        self.budget = budget
+        self.debug = debug
+        self.spent = self.full_cost(capacities)
+
+    def full_cost(self, capacities):
+        """
+        Recompute the cost of a solution from scratch, O(E).
+        :param capacities: a solution vector
+        :return: the total upgrade and establishment cost of the solution
+        """
+        original_capacity = self.universe.original_capacity
+        current_edges = capacities > 0
+        upgrade_costs = numpy.sum(((capacities - original_capacity) * self.universe.upgrade_cost)[current_edges])
+        establishment_costs = numpy.sum(self.universe.establish_cost[current_edges & (original_capacity == 0)])
+        return float(upgrade_costs + establishment_costs)
+
+    def left(self):
+        """
+        :return: The remaining budget to allocate (can be negative if upgrades exceed budget)
+        """
+        return self.budget - self.spent
+
+    def marginal_cost(self, capacities, edge_pos, new_capacity):
+        """
+        The cost of changing the capacity of a single edge, O(1). Negative for downgrades.
+        A capacity of 0.01 or less means that the edge is removed.
+        :param capacities: the current solution vector
+        :param edge_pos: position of the edge in universe.edge_list
+        :param new_capacity: the capacity after the change
+        :return: the change in spent budget
+        """
+        old_capacity = float(capacities[edge_pos])
+        new_capacity = float(new_capacity) if new_capacity > 0.01 else 0.0
+        cost = (new_capacity - old_capacity) * self.universe.upgrade_cost[edge_pos]
+        if self.universe.original_capacity[edge_pos] == 0:
+            if old_capacity <= 0 < new_capacity:
+                cost += self.universe.establish_cost[edge_pos]  # establishing a new edge
+            elif new_capacity <= 0 < old_capacity:
+                cost -= self.universe.establish_cost[edge_pos]  # destructing an established edge
+        return cost
+
+    def set_capacity(self, capacities, edge_pos, new_capacity):
+        """
+        Change the capacity of an edge in the solution vector and update the spent budget, O(1).
+        :param capacities: the solution vector (updated in place)
+        :param edge_pos: position of the edge in universe.edge_list
+        :param new_capacity: the capacity after the change (0.01 or less removes the edge)
+        :return: the remaining budget after the change
+        """
+        self.spent += self.marginal_cost(capacities, edge_pos, new_capacity)
+        capacities[edge_pos] = new_capacity if new_capacity > 0.01 else 0
+        if self.debug:
+            self.verify(capacities)
+        return self.left()
+
+    def verify(self, capacities):
+        """
+        Compare the incremental cost to a full recomputation and exit if they drifted apart.
+        """
+        recomputed = self.full_cost(capacities)
+        if abs(recomputed - self.spent) > 1e-6 * max(1.0, abs(recomputed)):
+            sys.exit('Error: budget ledger drifted from the solution. Ledger spent ' + str(self.spent) +
+                     ', recomputed ' + str(recomputed))
+
+    def snapshot(self):
+        """
+        :return: the ledger state, to be restored along with a copy of the solution vector
+        """
+        return self.spent
+
+    def restore(self, spent):
+        """
+        Restore a snapshot (used when the working solution is reset to the incumbent or to the original grid)
+        """
+        self.spent = spent
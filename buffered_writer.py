@@ -0,0 +1,134 @@
+# ------------------------------------------------------------------------------
+# Name:        Buffered writer
+# Purpose:     Asynchronous csv writing of frequent rows (the heuristic's registry of actions and its
+#              per iteration tracking file), instead of opening, appending and closing the file per row.
+#              Rows are put in a bounded queue (writerow blocks while the queue is full, so a slow disk
+#              slows down the search instead of filling the memory), and a background thread writes them
+#              in batches to the file, which it keeps open. The writers are flushed and closed on exit,
+#              and on SIGTERM/SIGINT (e.g., a run terminated by the batch runner's time limit).
+# ------------------------------------------------------------------------------
+
+import csv
+import os
+import sys
+import threading
+import exit_handlers
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+open_writers = []  # the writers which were not closed yet, see close_all
+
+
+def open_csv_append(filename):
+    if sys.version_info[0] == 2:
+        return open(filename, 'ab')
+    return open(filename, 'a', newline='')
+
+
+class BufferedCsvWriter(object):
+    """
+    Usage: writer = BufferedCsvWriter(filename, header); writer.writerow([...]); ...; writer.close()
+    """
+
+    def __init__(self, filename, header=None, max_queue_size=10000, batch_size=1000):
+        """
+        :param filename: the csv file (appended to)
+        :param header: a header row, written if the file is new (or empty)
+        :param max_queue_size: number of queued rows at which writerow blocks
+        :param batch_size: maximal number of rows written at a time
+        """
+        self.filename = filename
+        self.header = header
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.error = None  # an error of the writing thread, raised by the next writerow/flush
+        self.start()
+        open_writers.append(self)
+        exit_handlers.install_signal_handlers()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.rows = queue.Queue(self.max_queue_size)
+        self.thread = threading.Thread(target=self.write_rows, name='BufferedCsvWriter ' + self.filename)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_rows(self):
+        """
+        The writing thread: writes the queued rows in batches until the closing None.
+        """
+        try:
+            csv_file = open_csv_append(self.filename)
+        except (IOError, OSError) as open_error:
+            self.error = open_error
+            csv_file = None
+        writer = None if csv_file is None else csv.writer(csv_file)
+        if writer is not None and self.header is not None and csv_file.tell() == 0:
+            writer.writerow(self.header)
+            csv_file.flush()
+        closing = False
+        while not closing:
+            batch = [self.rows.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.rows.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closing = True
+                batch = batch[:batch.index(None)]
+            if writer is not None and batch:
+                try:
+                    writer.writerows(batch)
+                    csv_file.flush()
+                except (IOError, OSError) as write_error:
+                    self.error = write_error
+            for _ in range(len(batch) + closing):
+                self.rows.task_done()
+        if csv_file is not None:
+            csv_file.close()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def writerow(self, row):
+        self.check_error()
+        if self.thread is None:
+            raise ValueError('Writing to a closed writer: ' + self.filename)
+        if os.getpid() != self.pid:
+            self.header = None  # the header is written by the parent process
+            self.start()  # a forked process, which does not inherit the writing thread
+        self.rows.put(row)
+
+    def flush(self):
+        """
+        Wait until all the queued rows are written.
+        """
+        if self.thread is not None and os.getpid() == self.pid:
+            self.rows.join()
+        self.check_error()
+
+    def close(self):
+        if self.thread is not None and os.getpid() == self.pid:
+            self.rows.put(None)
+            self.thread.join()
+        self.thread = None
+        if self in open_writers:
+            open_writers.remove(self)
+        self.check_error()
+
+
+def close_all():
+    """
+    Flush and close all the open writers.
+    """
+    while open_writers:
+        open_writers[-1].close()
+
+
+exit_handlers.register(close_all)
@@ -14,14 +14,23 @@ import warnings
 import cplex
 import sys
 import collections
+from instance_loader import load_instance
+from results_store import output_path, set_output_directory
+from contingency_sampler import ContingencySampler, importance_weights_from_fail_count, \
+    estimate_from_stream
 
 parser = argparse.ArgumentParser(description="Load a gpickle power grid and compute supply")
 parser.add_argument('--instance_location', help="Provide the location for instance files (directory name)",
                     type = str, default="instance24")
 parser.add_argument('--gpickle_location', help="The location of a gpickle file",
                     type = str, default="")
-parser.add_argument('--output_file', help="Where should I save a csv with the results?",
-                    type = str, default = "c:/temp/grid_cascade_output/tmp_supply_gpickle.csv")
+parser.add_argument('--output_file', help="Where should I save a csv with the results? "
+                                          "[default: tmp_supply_gpickle.csv in the output directory]",
+                    type = str, default = "")
+parser.add_argument('--output_directory', help="Directory of the output files [default: the "
+                                               "GRID_CASCADE_OUTPUT environment variable, or "
+                                               "c:/temp/grid_cascade_output on windows]",
+                    type = str, default = "")
 parser.add_argument('--brute_force_upper_bound', help = "Compute a brute force upper bound by exhausting all"
                                                         "installments. Ignores the gpickle_location.",
                     action = "store_true")
@@ -34,18 +43,33 @@ parser.add_argument('--line_establish_capacity_coef_scale',
 parser.add_argument('--load_capacity_factor', help="The load capacity factor - "
                                                    "Change the existing capacity by this factor.",
                     type=float, default=1.0)
+parser.add_argument('--sampled_contingencies', help="Estimate the expected supply over a stream of this many sampled "
+                                                    "N-k contingencies, instead of the instance's scenarios "
+                                                    "[default 0 = use the instance's scenarios]",
+                    type=int, default=0)
+parser.add_argument('--max_failures_proportion', help="Maximal number of initial failures in a sampled contingency, "
+                                                      "as a proportion of the number of edges [default 0.1]",
+                    type=float, default=0.1)
+parser.add_argument('--importance_sampling', help="Sample contingencies proportional to the fail counts of the "
+                                                  "edges in the instance's scenarios (instead of uniformly)",
+                    action="store_true")
+parser.add_argument('--sampling_seed', help="Random seed of the contingency sampler [default 0]",
+                    type=int, default=0)
 
 # ... add additional arguments as required here ..
 global args
 args = parser.parse_args()
+set_output_directory(args.output_directory)
+if not args.output_file:
+    args.output_file = output_path('tmp_supply_gpickle.csv')
 
 def main_program():
 
     # read the scenarios
     instance_location = os.getcwd() + '\\' + args.instance_location + '\\'
 
-    scenarios = read_scenarios(instance_location + 'scenario_failures.csv',
-                               instance_location + 'scenario_probabilities.csv')
+    instance = load_instance(instance_location)
+    scenarios = instance.scenarios()
 
     if (args.gpickle_location <> "") and args.brute_force_upper_bound:
         warnings.warn("I have received both gpickle location and a brute force computation request."
@@ -56,8 +80,8 @@ def main_program():
         G = nx.read_gpickle(os.getcwd() + '\\' + args.gpickle_location)
     else:
         # load the grid from original files and install everything
-        nodes = read_nodes(instance_location + 'grid_nodes.csv')
-        original_edges = read_edges(instance_location + 'grid_edges.csv')
+        nodes = instance.nodes()
+        original_edges = instance.edges(args.load_capacity_factor)
         G = create_power_grid(nodes, original_edges)
         # edges for establishment
         establishable_edges = [(edge[1], edge[2]) for edge in original_edges if edge[0] == 'H' and original_edges[edge] > 0
@@ -76,6 +100,14 @@ def main_program():
         for edge_to_upgrade in upgradable_edges:
             G.edges[edge_to_upgrade]['capacity'] += args.line_upgrade_capacity_coef_scale
 
+    if args.sampled_contingencies > 0:
+        estimate = estimate_sampled_supply(G, scenarios)
+        with open(args.output_file, 'wb') as estimate_csv:
+            writer = csv.writer(estimate_csv)
+            writer.writerow(['measure', 'value'])
+            writer.writerows(sorted(estimate.items()))
+        return
+
     current_grid_outcome = compute_current_supply(G, scenarios)
 
     with open(args.output_file, 'wb') as scenario_stats_csv:
@@ -84,58 +116,39 @@ def main_program():
         writer.writerows(current_grid_outcome['supply_per_scenario'])
 
 
+def estimate_sampled_supply(power_grid, scenarios):
+    """
+    Estimate the expected supply (and unsupplied demand) of power_grid over a stream of sampled N-k contingencies.
+    The contingencies are never materialized, each one is simulated as it is drawn.
+    :param power_grid: power grid as a networkx object
+    :param scenarios: the instance's scenarios, used for the importance weights (fail counts)
+    :return: dictionary of the estimate and the sampling statistics
+    """
+    importance_weights = None
+    edge_list = sorted([arrange_edge_minmax(edge) for edge in power_grid.edges()])
+    if args.importance_sampling:
+        importance_weights = importance_weights_from_fail_count(
+            edge_list, compute_current_supply(power_grid, scenarios)['fail_count'])
+    sampler = ContingencySampler.from_grid(power_grid, int(args.max_failures_proportion*len(edge_list)),
+                                           importance_weights=importance_weights, seed=args.sampling_seed)
+
+    def supply_after_cascade(failed_edges):
+        failed_grid = cfe(power_grid.copy(), failed_edges)['updated_grid_copy']
+        return sum([failed_grid.nodes[cur_node]['demand'] for cur_node in power_grid.nodes])
+
+    estimate = estimate_from_stream(sampler.stream(args.sampled_contingencies), supply_after_cascade)
+    total_demand = sum([power_grid.nodes[cur_node]['demand'] for cur_node in power_grid.nodes])
+    return {'expected_supply': estimate['estimate'], 'expected_unsupplied': total_demand - estimate['estimate'],
+            'total_demand': total_demand, 'num_scenarios': estimate['num_scenarios'],
+            'effective_sample_size': estimate['effective_sample_size'], 'num_drawn': sampler.num_drawn,
+            'num_infeasible': sampler.num_infeasible}
+
+
 
 
 # ****************************************************
 # ******* Reading and writing files ******************
 # ****************************************************
-def read_nodes(filename):
-    dic = dict()
-    with open(filename, 'rb') as nodes_file:
-        nodes_reader = csv.reader(nodes_file, delimiter=',')
-        next(nodes_reader)  # assuming header, skip first line
-        for row in nodes_reader:
-            dic[('d', row[0])] = float(row[1])  # read demand
-            dic[('c', row[0])] = float(row[2])  # read capacity
-            dic[('gen_up_ub', row[0])] = float(row[3])  # max generation upgrade
-            dic[('H', row[0])] = float(row[4])  # fixed cost
-            dic[('h', row[0])] = float(row[5])  # variable cost
-    return dic
-
-
-def read_edges(filename):
-    dic = dict()
-    with open(filename, 'rb') as edges_file:
-        csv_reader = csv.reader(edges_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            cur_edge = arrange_edge_minmax(row[0], row[1])
-            dic[('c',) + cur_edge] = float(row[2])*args.load_capacity_factor  # current capacity
-            dic[('x',) + cur_edge] = float(row[3])  # reactance
-            dic[('H',) + cur_edge] = float(row[4])  # fixed cost
-            dic[('h',) + cur_edge] = float(row[5])  # variable cost
-    return dic
-
-
-def read_scenarios(filename_fail, filename_pr):
-    dic = dict()
-    with open(filename_pr, 'rb') as pr_file:
-        csv_reader = csv.reader(pr_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            dic[('s_pr', row[0])] = float(row[1])
-
-    with open(filename_fail, 'rb') as failure_file:
-        csv_reader = csv.reader(failure_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            if ('s', row[0]) in dic.keys():
-                dic[('s', row[0])] += [arrange_edge_minmax(row[1], row[2])]  # failures
-            else:
-                dic[('s', row[0])] = [arrange_edge_minmax(row[1], row[2])]  # first failure in this scenario
-    return dic
-
-
 def arrange_edge_minmax(edge_i, edge_j=None):
     if edge_j is None:
         # case edge_i contains a tuple
@@ -151,8 +164,8 @@ def arrange_edge_minmax(edge_i, edge_j=None):
 def create_power_grid(nodes, edges):
     """
     Build a power grid as a networkx object with customized keys
-    :param nodes: a dictionary of nodes, as read and output by read_nodes() function
-    :param edges: a dictionary of edges, as read and output by read_edges() function
+    :param nodes: a dictionary of nodes, as output by InstanceBundle.nodes()
+    :param edges: a dictionary of edges, as output by InstanceBundle.edges()
     :return: grid an nx.Graph() object with the proper nodes and edges.
     """
 
@@ -279,9 +292,9 @@ def grid_flow_update(power_grid, failed_edges=[], write_lp=False, return_cplex_o
     if find_flow.solution.get_status() != 1:
         find_flow.write('problem_infeasible.lp')
         print "I'm having difficulty with a flow problem - please check"
-        nx.write_gexf(power_grid, "c:/temp/exported_grid_err.gexf")
+        nx.write_gexf(power_grid, output_path("exported_grid_err.gexf"))
         sys.exit('Error: no optimal solution found while trying to solve flow problem. Writing into: '
-                 'problem_infeasible.lp and c:/temp/exported_grid_err.gexf')
+                 'problem_infeasible.lp and ' + output_path("exported_grid_err.gexf"))
 
     find_flow_vars = find_flow.solution.get_values()
 
@@ -0,0 +1,233 @@
+# ------------------------------------------------------------------------------
+# Name:        Contingency sampler
+# Purpose:     A generator of N-k contingencies (initial failure scenarios), sampled in vectorized batches.
+#              The number of failures k is uniform in 1..max_failures, and the failed edges are drawn
+#              without replacement, either uniformly or by importance sampling (proportional to edge
+#              weights, e.g., historical fail counts). Importance sampled contingencies carry a likelihood
+#              ratio, so that estimates remain unbiased w.r.t. the uniform N-k distribution.
+#              Infeasible contingencies (a connected component with demand >= generation capacity)
+#              are screened out by vectorized connected component labeling, and duplicates are
+#              optionally removed by hashing. Contingencies are yielded as a stream, so that expected
+#              supply can be estimated over many contingencies without writing them to a csv file.
+# ------------------------------------------------------------------------------
+
+import numpy
+
+
+class ContingencySampler(object):
+    """
+    Samples N-k contingencies of a grid in batches.
+    Usage: for failed_edges, weight in sampler.stream(num_scenarios): ...
+    """
+
+    def __init__(self, node_list, demand, gen_cap, edge_list, max_failures, importance_weights=None, unique=False,
+                 screen_feasibility=True, batch_size=1024, seed=None):
+        """
+        :param node_list: list of node names
+        :param demand: demand per node (ordered as node_list)
+        :param gen_cap: generation capacity per node (ordered as node_list)
+        :param edge_list: list of the (existing) edges which can fail, as (node1, node2) tuples
+        :param max_failures: the maximal number of initial failures k
+        :param importance_weights: sampling weight per edge (ordered as edge_list), None for uniform sampling
+        :param unique: drop contingencies which were already sampled (hashed). Note that with unique=True the
+                       contingencies are no longer an i.i.d. sample, use it for generating scenario files.
+        :param screen_feasibility: drop contingencies in which a component's demand is not below its generation
+        :param batch_size: number of contingencies drawn in each vectorized batch
+        :param seed: random seed
+        """
+        self.node_list = list(node_list)
+        self.edge_list = list(edge_list)
+        self.num_edges = len(self.edge_list)
+        self.max_failures = max(1, min(int(max_failures), self.num_edges))
+        node_position = {cur_node: i for i, cur_node in enumerate(self.node_list)}
+        self.edge_u = numpy.array([node_position[cur_edge[0]] for cur_edge in self.edge_list], dtype=numpy.int64)
+        self.edge_v = numpy.array([node_position[cur_edge[1]] for cur_edge in self.edge_list], dtype=numpy.int64)
+        self.demand = numpy.asarray(demand, dtype=numpy.float64)
+        self.gen_cap = numpy.asarray(gen_cap, dtype=numpy.float64)
+        if importance_weights is None:
+            self.importance_weights = None
+        else:
+            self.importance_weights = numpy.asarray(importance_weights, dtype=numpy.float64)
+            if numpy.any(self.importance_weights <= 0):
+                raise ValueError('Importance weights must be positive')
+        self.unique = unique
+        self.screen_feasibility = screen_feasibility
+        self.batch_size = batch_size
+        self.random_state = numpy.random.RandomState(seed)
+        self.sampled_keys = set()
+        # statistics
+        self.num_drawn = 0
+        self.num_infeasible = 0
+        self.num_duplicates = 0
+
+    @classmethod
+    def from_grid(cls, power_grid, max_failures, **kwargs):
+        """
+        Create a sampler over the edges of a networkx power grid (nodes with 'demand' and 'gen_cap' attributes).
+        Edges are arranged as (min, max) tuples, like the edges of the scenario files.
+        """
+        node_list = list(power_grid.nodes())
+        edge_list = sorted([(min(edge[0], edge[1]), max(edge[0], edge[1])) for edge in power_grid.edges()])
+        return cls(node_list, [power_grid.nodes[cur_node]['demand'] for cur_node in node_list],
+                   [power_grid.nodes[cur_node]['gen_cap'] for cur_node in node_list], edge_list, max_failures,
+                   **kwargs)
+
+    def draw_batch(self, batch_size):
+        """
+        Draw a batch of contingencies (before screening).
+        Importance sampling draws the k edges sequentially proportional to the weights (by Gumbel top-k),
+        and the likelihood ratio is that of the ordered draw: prod_j (1/(E-j+1)) / (w_j/(W - sum_{i<j} w_i)).
+        :return: (boolean failure matrix of batch_size x num_edges, likelihood ratio per contingency)
+        """
+        num_failures = self.random_state.randint(1, self.max_failures + 1, size=batch_size)
+        keys = self.random_state.random_sample((batch_size, self.num_edges))
+        if self.importance_weights is not None:
+            # Gumbel top-k: the order of log(w) + Gumbel noise is a sequential weighted sample without replacement
+            keys = -(numpy.log(self.importance_weights) - numpy.log(-numpy.log(keys)))
+        order = numpy.argsort(keys, axis=1)[:, :self.max_failures]
+        selected = numpy.arange(self.max_failures) < num_failures[:, None]
+        masks = numpy.zeros((batch_size, self.num_edges), dtype=bool)
+        rows = numpy.repeat(numpy.arange(batch_size), self.max_failures)
+        masks[rows[selected.ravel()], order[selected]] = True
+        if self.importance_weights is None:
+            return masks, numpy.ones(batch_size)
+        total_weight = self.importance_weights.sum()
+        drawn_weights = self.importance_weights[order]
+        remaining = total_weight - numpy.cumsum(drawn_weights, axis=1) + drawn_weights
+        log_ratio = -numpy.log(self.num_edges - numpy.arange(self.max_failures)) - \
+            numpy.log(drawn_weights) + numpy.log(remaining)
+        return masks, numpy.exp(numpy.sum(numpy.where(selected, log_ratio, 0), axis=1))
+
+    def sample_batch(self):
+        """
+        :return: (failure matrix, likelihood ratios) of the feasible (and unique) contingencies of one batch
+        """
+        masks, ratios = self.draw_batch(self.batch_size)
+        self.num_drawn += len(masks)
+        if self.screen_feasibility:
+            feasible = component_feasibility(masks, self.edge_u, self.edge_v, self.demand, self.gen_cap)
+            self.num_infeasible += int(numpy.sum(~feasible))
+            masks, ratios = masks[feasible], ratios[feasible]
+        if self.unique:
+            keep = numpy.zeros(len(masks), dtype=bool)
+            for i, packed in enumerate(numpy.packbits(masks, axis=1)):
+                key = packed.tobytes()
+                if key not in self.sampled_keys:
+                    self.sampled_keys.add(key)
+                    keep[i] = True
+            self.num_duplicates += int(numpy.sum(~keep))
+            masks, ratios = masks[keep], ratios[keep]
+        return masks, ratios
+
+    def stream(self, num_scenarios=None, max_draws=None):
+        """
+        Generate contingencies one at a time (batches are drawn lazily).
+        :param num_scenarios: number of contingencies to yield (None for an endless stream)
+        :param max_draws: stop after drawing this many contingencies (guards against an exhausted unique sample)
+        :return: a generator of (list of failed edges, likelihood ratio)
+        """
+        num_yielded = 0
+        while num_scenarios is None or num_yielded < num_scenarios:
+            if max_draws is not None and self.num_drawn >= max_draws:
+                return
+            masks, ratios = self.sample_batch()
+            for mask, ratio in zip(masks, ratios):
+                yield [self.edge_list[i] for i in numpy.flatnonzero(mask)], float(ratio)
+                num_yielded += 1
+                if num_scenarios is not None and num_yielded >= num_scenarios:
+                    return
+
+
+def component_labels(masks, edge_u, edge_v, num_nodes):
+    """
+    Vectorized connected component labeling of the grid after removing the failed edges, for all contingencies
+    of a batch at once (min-label propagation with pointer jumping).
+    :param masks: boolean matrix (contingencies x edges), True for failed edges
+    :param edge_u: first node position of every edge
+    :param edge_v: second node position of every edge
+    :param num_nodes: number of nodes
+    :return: matrix (contingencies x nodes) of component labels (the minimal node position in the component)
+    """
+    num_rows = masks.shape[0]
+    alive = ~masks
+    row_offset = (numpy.arange(num_rows) * num_nodes)[:, None]
+    flat_u = (row_offset + edge_u[None, :])[alive]
+    flat_v = (row_offset + edge_v[None, :])[alive]
+    flat_labels = numpy.tile(numpy.arange(num_nodes), num_rows)
+    while True:
+        previous = flat_labels.copy()
+        edge_labels = numpy.minimum(flat_labels[flat_u], flat_labels[flat_v])
+        numpy.minimum.at(flat_labels, flat_u, edge_labels)
+        numpy.minimum.at(flat_labels, flat_v, edge_labels)
+        # pointer jumping: a node takes the label of its label
+        labels = flat_labels.reshape(num_rows, num_nodes)
+        flat_labels = numpy.take_along_axis(labels, labels, axis=1).ravel()
+        if numpy.array_equal(previous, flat_labels):
+            break
+    return flat_labels.reshape(num_rows, num_nodes)
+
+
+def component_totals(labels, node_values):
+    """
+    :param labels: component labels, as returned by component_labels
+    :param node_values: a value per node position (e.g., demand)
+    :return: matrix (contingencies x nodes), the total value of the component labeled by each position
+             (0 for positions which are not a label)
+    """
+    num_rows, num_nodes = labels.shape
+    components = ((numpy.arange(num_rows) * num_nodes)[:, None] + labels).ravel()
+    return numpy.bincount(components, weights=numpy.tile(node_values, num_rows),
+                          minlength=num_rows * num_nodes).reshape(num_rows, num_nodes)
+
+
+def component_feasibility(masks, edge_u, edge_v, demand, gen_cap):
+    """
+    Vectorized check that in every connected component (after removing the failed edges) the demand is
+    strictly below the generation capacity.
+    :param masks: boolean matrix (contingencies x edges), True for failed edges
+    :param edge_u: first node position of every edge
+    :param edge_v: second node position of every edge
+    :param demand: demand per node position
+    :param gen_cap: generation capacity per node position
+    :return: boolean vector, True for feasible contingencies
+    """
+    num_rows, num_nodes = masks.shape[0], len(demand)
+    if num_rows == 0:
+        return numpy.zeros(0, dtype=bool)
+    labels = component_labels(masks, edge_u, edge_v, num_nodes)
+    is_component = labels == numpy.arange(num_nodes)[None, :]
+    infeasible = is_component & (component_totals(labels, demand) >= component_totals(labels, gen_cap))
+    return ~numpy.any(infeasible, axis=1)
+
+
+def importance_weights_from_fail_count(edge_list, fail_count, smoothing=1.0):
+    """
+    Importance weights which favor edges with high historical fail counts.
+    :param edge_list: the edges of the sampler
+    :param fail_count: dictionary {edge: count}, e.g., the fail_count of compute_current_supply
+    :param smoothing: added to every count, so that every edge can still be sampled
+    :return: a weight per edge
+    """
+    return numpy.array([fail_count.get(cur_edge, 0) + smoothing for cur_edge in edge_list], dtype=numpy.float64)
+
+
+def estimate_from_stream(contingency_stream, evaluate):
+    """
+    Estimate the expectation of evaluate(failed_edges) over a stream of contingencies (self-normalized by the
+    likelihood ratios, so that screening and importance sampling are both accounted for).
+    :param contingency_stream: generator of (failed edges, likelihood ratio), e.g., ContingencySampler.stream()
+    :param evaluate: function of the list of failed edges, e.g., the supply after the cascade
+    :return: dictionary {'estimate', 'num_scenarios', 'effective_sample_size'}
+    """
+    sum_ratio = 0.0
+    sum_ratio_squared = 0.0
+    sum_weighted_value = 0.0
+    num_scenarios = 0
+    for failed_edges, ratio in contingency_stream:
+        sum_ratio += ratio
+        sum_ratio_squared += ratio ** 2
+        sum_weighted_value += ratio * evaluate(failed_edges)
+        num_scenarios += 1
+    return {'estimate': sum_weighted_value / sum_ratio if sum_ratio > 0 else float('nan'),
+            'num_scenarios': num_scenarios,
+            'effective_sample_size': sum_ratio ** 2 / sum_ratio_squared if sum_ratio_squared > 0 else 0}
@@ -0,0 +1,71 @@
+# ------------------------------------------------------------------------------
+# Name:        Edge bitset
+# Purpose:     Sets of edges as bitsets (python integers) over a global edge index, so that membership,
+#              union and difference of failed edge sets cost O(E/64) word operations instead of list scans.
+#              Edges are arranged as (min, max) tuples, like the edges of the scenario files.
+# ------------------------------------------------------------------------------
+
+
+class EdgeIndex(object):
+    """
+    A global edge index: edge i is bit i of a set. Usage:
+    failed = edge_index.mask(failed_edges); edge_index.contains(failed, edge); edge_index.edges(all & ~failed)
+    """
+
+    def __init__(self, edge_list=()):
+        """
+        :param edge_list: the edges, in the order in which edges() returns them
+        """
+        self.edge_list = []
+        self.edge_bit = dict()
+        self.initial_mask = self.mask(edge_list)  # edges indexed later on (e.g., unknown failures) are not included
+
+    def add(self, edge):
+        """
+        :return: the bit of edge (a new bit if edge is not indexed yet)
+        """
+        edge = (min(edge[0], edge[1]), max(edge[0], edge[1]))
+        if edge not in self.edge_bit:
+            self.edge_bit[edge] = 1 << len(self.edge_list)
+            self.edge_list.append(edge)
+        return self.edge_bit[edge]
+
+    def mask(self, edges, add_edges=True):
+        """
+        :param edges: list of edges
+        :param add_edges: index edges which are not indexed yet, otherwise return None for an unknown edge
+        :return: the bitset of edges
+        """
+        mask = 0
+        for cur_edge in edges:
+            cur_edge = (min(cur_edge[0], cur_edge[1]), max(cur_edge[0], cur_edge[1]))
+            if cur_edge not in self.edge_bit:
+                if not add_edges:
+                    return None
+                self.add(cur_edge)
+            mask |= self.edge_bit[cur_edge]
+        return mask
+
+    def contains(self, mask, edge):
+        bit = self.edge_bit.get((min(edge[0], edge[1]), max(edge[0], edge[1])))
+        return bit is not None and (mask & bit) != 0
+
+    def edges(self, mask):
+        """
+        :return: the edges of a bitset, in index order
+        """
+        edges = []
+        position = 0
+        while mask:
+            word = mask & 0xFFFFFFFFFFFFFFFF
+            while word:
+                low_bit = word & -word
+                edges.append(self.edge_list[position + low_bit.bit_length() - 1])
+                word ^= low_bit
+            mask >>= 64
+            position += 64
+        return edges
+
+
+def popcount(mask):
+    return bin(mask).count('1')
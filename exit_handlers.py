@@ -0,0 +1,66 @@
+# ------------------------------------------------------------------------------
+# Name:        Exit handlers
+# Purpose:     The exit and termination handling shared by the modules which buffer the outputs of a run
+#              (results_store.py, buffered_writer.py): each registers a function which flushes and closes its
+#              outputs, and the functions are called on exit and when the run is terminated (SIGTERM, e.g., by
+#              the batch runner's time limit, or SIGINT).
+#              After the functions, a signal is passed to the previous handler (e.g., KeyboardInterrupt on
+#              SIGINT), or the process ends by the signal as it would without the handlers - not by a SystemExit,
+#              which the caller of the run (e.g., a batch runner worker) could catch and continue.
+# ------------------------------------------------------------------------------
+
+import atexit
+import os
+import signal
+
+registered_functions = []  # called by run_all, the last registered first
+previous_handlers = dict()  # signal number -> the handler replaced by on_signal
+
+
+def register(function):
+    """
+    :param function: called without arguments on exit and on SIGTERM/SIGINT (once the signal handlers are installed)
+    """
+    if function not in registered_functions:
+        registered_functions.append(function)
+
+
+def run_all():
+    """
+    Call the registered functions (on exit, on a signal, and by the batch runner after every run).
+    """
+    for function in reversed(registered_functions):
+        function()
+
+
+def terminate(signal_number):
+    """
+    End the process by a signal, as its default handler would.
+    """
+    signal.signal(signal_number, signal.SIG_DFL)
+    os.kill(os.getpid(), signal_number)
+
+
+def on_signal(signal_number, frame):
+    run_all()
+    previous_handler = previous_handlers.get(signal_number)
+    if callable(previous_handler):
+        previous_handler(signal_number, frame)
+    elif previous_handler != signal.SIG_IGN:
+        terminate(signal_number)
+
+
+def install_signal_handlers():
+    """
+    Call the registered functions on SIGTERM and SIGINT. Ignored outside the main thread (signal handlers can only be
+    set by the main thread, whose handlers apply to the whole process).
+    """
+    for signal_number in [signal.SIGTERM, signal.SIGINT]:
+        if signal_number not in previous_handlers:
+            try:
+                previous_handlers[signal_number] = signal.signal(signal_number, on_signal)
+            except ValueError:
+                return
+
+
+atexit.register(run_all)
@@ -13,6 +13,7 @@ import networkx as nx
 from read_grid import *
 import cplex
 from cascade_simulator_aux import *
+from results_store import output_path
 
 G = nx.Graph() # initialize empty graph
 
@@ -30,7 +31,7 @@ flow_solution = grid_flow_update(G, return_cplex_object = True)['cplex_object']
 var_names = flow_solution.variables.get_names()
 var_value = flow_solution.solution.get_values()
 
-with open('c:/temp/temp_solution.csv', 'wb') as csvfile:
+with open(output_path('temp_solution.csv'), 'wb') as csvfile:
         solutionwriter = csv.writer(csvfile, delimiter = ',')
         solutionwriter.writerow(['name', 'value'])
         solutionwriter.writerows([[var_names[i], abs(var_value[i])] for i in range(len(var_names))])
\ No newline at end of file
@@ -12,6 +12,9 @@ import sys
 import csv # for reading the AC initial solution
 import random
 import math # for rounding up using ceil
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from contingency_sampler import ContingencySampler
 
 # read instance files
 import case24_ieee_rts as instance24
@@ -70,29 +73,14 @@ def export_raw_csv_nodes(G, filename):
 
 def export_scenarios(G, directory):
     # Create scenarios by randomizing failing edges from G (for simplicity, only existing edges are considered)
+    # The contingency sampler draws unique scenarios which have an initial flow solution, i.e.,
+    # the demand does not exceed generation capacity in each component (see contingency_sampler.py)
     prc_fail = 0.1
     global num_iters
-    random.seed(0)
-    tabu_list_scenarios = [] # defined to avoid repeating scenarios
-    internal_counter = 0
-    while (internal_counter < num_iters):
-        init_omit_num = random.randint(1, int(
-            prc_fail * G.number_of_edges()))  # Set number of edges to fail in current batch under current instance
-        tmp_rand = random.sample(G.edges(), init_omit_num)
-        # make sure current starting conditions were not tested so far
-        # WARNING: the counter increases only when new option is found.
-        # in small instances * small choice of failures this might lead to an infinite loop
-        # Also check that this scenario has an initial flow solution, i.e.,
-        # the demand does not exceed generation capacity in each component
-        omittedG = G.copy()
-        omittedG.remove_edges_from(tmp_rand)
-        component_wise_demand = [sum([omittedG.node[node_i]['demand'] for node_i in subGr]) <
-                          sum([omittedG.node[node_i]['gen_cap'] for node_i in subGr])
-                          for subGr in nx.connected_components(omittedG)]
-        if not tmp_rand in tabu_list_scenarios and all(component_wise_demand):
-            internal_counter += 1
-            tabu_list_scenarios += [
-                tmp_rand]  # update the tabu list to include the current iteration (represented as a tuple)
+    sampler = ContingencySampler.from_grid(G, int(prc_fail * G.number_of_edges()), unique=True, seed=0)
+    # WARNING: in small instances * small choice of failures there might be less than num_iters unique scenarios,
+    # so the number of draws is bounded
+    tabu_list_scenarios = [failed_edges for failed_edges, ratio in sampler.stream(num_iters, max_draws=1000*num_iters)]
     # export scenario probabilities
     failure_probabilities = [[i, 1.0/len(tabu_list_scenarios)] for i in range(len(tabu_list_scenarios))]
     with open(directory + 'scenario_probabilities.csv', 'wb') as fd:
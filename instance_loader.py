@@ -0,0 +1,329 @@
+# ------------------------------------------------------------------------------
+# Name:        Instance loader
+# Purpose:     A single loader for instance directories (grid_nodes.csv, grid_edges.csv,
+#              scenario_failures.csv, scenario_probabilities.csv).
+#              The csv files are compiled once into a versioned binary bundle - a directory of
+#              .npy arrays (memory mapped when loaded) and a manifest holding the bundle version
+#              and a content hash of the source files. The bundle is recompiled automatically
+#              whenever the source files change, or when the bundle version is bumped.
+#              The tuple keyed dictionaries used across the scripts (nodes, edges, scenarios)
+#              are created from the arrays.
+#              Scenario variants (scenario_failures_VARIANT.csv, scenario_probabilities_VARIANT.csv) are
+#              compiled into bundles of their own, and share the already loaded base grid.
+#              Instances can be preloaded into memory, for all the runs of a batch (see batch_runner.py).
+# ------------------------------------------------------------------------------
+
+import array
+import csv
+import hashlib
+import json
+import os
+import numpy
+
+BUNDLE_VERSION = 1
+BUNDLE_DIRECTORY = '_instance_bundle'
+SOURCE_FILES = ['grid_nodes.csv', 'grid_edges.csv', 'scenario_failures.csv', 'scenario_probabilities.csv']
+SCENARIO_ARRAYS = ['scenario_names', 'scenario_probabilities', 'scenario_offsets', 'failure_edge_ids', 'failure_edges']
+BUNDLE_ARRAYS = ['node_names', 'node_data', 'edge_nodes', 'edge_data'] + SCENARIO_ARRAYS
+
+loaded_instances = dict()  # {(instance location, content hash): InstanceBundle}, see preload_instance
+
+
+def arrange_edge_minmax(edge_i, edge_j):
+    return min(edge_i, edge_j), max(edge_i, edge_j)
+
+
+def to_str(value):
+    """
+    Array elements of names are numpy strings (bytes when a bundle is read by python 3), convert to str
+    """
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def string_array(values, width=1):
+    """
+    A fixed width string array (memory mappable, unlike object arrays)
+    """
+    if len(values) == 0:
+        return numpy.zeros((0,) if width == 1 else (0, width), dtype='S1')
+    return numpy.array(values, dtype=str)
+
+
+def variant_files(variant):
+    """
+    :return: the source files of a scenario variant (failures, probabilities)
+    """
+    return ['scenario_failures_' + variant + '.csv', 'scenario_probabilities_' + variant + '.csv']
+
+
+def source_hash(instance_location, source_files=SOURCE_FILES):
+    """
+    :return: sha1 of the names and contents of the instance's source files
+    """
+    content_hash = hashlib.sha1()
+    for filename in source_files:
+        content_hash.update(filename.encode('utf-8'))
+        with open(os.path.join(instance_location, filename), 'rb') as source_file:
+            for block in iter(lambda: source_file.read(1 << 20), b''):
+                content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def read_csv_rows(filename):
+    """
+    Iterate the rows of a csv file, skipping the header
+    """
+    with open(filename, 'r') as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        next(csv_reader)  # assuming header, skip first line
+        for row in csv_reader:
+            if row:
+                yield row
+
+
+def compile_instance(instance_location):
+    """
+    Parse the csv files of an instance into arrays.
+    :param instance_location: the instance directory
+    :return: dictionary {array name: numpy array}
+    """
+    arrays = dict()
+    node_rows = list(read_csv_rows(os.path.join(instance_location, 'grid_nodes.csv')))
+    arrays['node_names'] = string_array([row[0] for row in node_rows])
+    # demand, generation capacity, max generation upgrade, fixed cost, variable cost
+    arrays['node_data'] = numpy.array([[float(value) for value in row[1:6]] for row in node_rows],
+                                      dtype=numpy.float64).reshape(-1, 5)
+
+    edge_rows = list(read_csv_rows(os.path.join(instance_location, 'grid_edges.csv')))
+    arrays['edge_nodes'] = string_array([arrange_edge_minmax(row[0], row[1]) for row in edge_rows], 2)
+    # capacity, susceptance, fixed (establish) cost, variable (upgrade) cost
+    arrays['edge_data'] = numpy.array([[float(value) for value in row[2:6]] for row in edge_rows],
+                                      dtype=numpy.float64).reshape(-1, 4)
+
+    arrays.update(compile_scenarios(os.path.join(instance_location, 'scenario_failures.csv'),
+                                    os.path.join(instance_location, 'scenario_probabilities.csv')))
+    return arrays
+
+
+def compile_scenarios(failures_filename, probabilities_filename):
+    """
+    Parse the scenario files into arrays.
+    :return: dictionary {array name: numpy array} of the SCENARIO_ARRAYS
+    """
+    arrays = dict()
+    # scenarios, in order of first appearance (probabilities first), failures grouped per scenario
+    scenario_position = dict()
+    scenario_names = []
+    probabilities = []
+    for row in read_csv_rows(probabilities_filename):
+        scenario_position[row[0]] = len(probabilities)
+        scenario_names.append(row[0])
+        probabilities.append(float(row[1]))
+    scenario_offsets, failure_edge_ids, failure_edges = \
+        read_scenario_failures(failures_filename, scenario_position, scenario_names, probabilities)
+    arrays['scenario_names'] = string_array(scenario_names)
+    arrays['scenario_probabilities'] = numpy.array(probabilities, dtype=numpy.float64)
+    arrays['scenario_offsets'] = scenario_offsets
+    arrays['failure_edge_ids'] = failure_edge_ids
+    arrays['failure_edges'] = string_array(failure_edges, 2)
+    return arrays
+
+
+def read_scenario_failures(filename, scenario_position, scenario_names, probabilities):
+    """
+    Stream the scenario failures file in a single pass, and group the failures per scenario in CSR form:
+    the failures of scenario i are failure_edges[failure_edge_ids[scenario_offsets[i]:scenario_offsets[i+1]]].
+    Each row costs O(1) and is kept as two integers, so millions of sampled scenarios can be read.
+    The rows of a scenario do not have to be contiguous, the order of failures within a scenario is retained.
+    :param filename: the scenario failures file (scenario, node1, node2)
+    :param scenario_position: dictionary {scenario name: position}, scenarios which appear only in the
+                              failures file are added (along with their names and a nan probability)
+    :param scenario_names: list of scenario names by position
+    :param probabilities: list of scenario probabilities by position
+    :return: (scenario_offsets, failure_edge_ids, failure_edges) - int64 and int32 arrays, and a list of edges
+    """
+    row_scenarios = array.array('i')
+    row_edges = array.array('i')
+    failure_edge_position = dict()
+    failure_edges = []
+    for row in read_csv_rows(filename):
+        cur_scenario = scenario_position.get(row[0])
+        if cur_scenario is None:
+            # failures of a scenario without probability
+            cur_scenario = scenario_position[row[0]] = len(scenario_names)
+            scenario_names.append(row[0])
+            probabilities.append(numpy.nan)
+        cur_edge = arrange_edge_minmax(row[1], row[2])
+        edge_id = failure_edge_position.get(cur_edge)
+        if edge_id is None:
+            edge_id = failure_edge_position[cur_edge] = len(failure_edges)
+            failure_edges.append(cur_edge)
+        row_scenarios.append(cur_scenario)
+        row_edges.append(edge_id)
+    row_scenarios = numpy.frombuffer(row_scenarios, dtype=numpy.intc) if row_scenarios else \
+        numpy.zeros(0, dtype=numpy.intc)
+    row_edges = numpy.frombuffer(row_edges, dtype=numpy.intc) if row_edges else numpy.zeros(0, dtype=numpy.intc)
+    # a stable counting sort of the rows by scenario
+    order = numpy.argsort(row_scenarios, kind='mergesort')
+    scenario_offsets = numpy.zeros(len(scenario_names) + 1, dtype=numpy.int64)
+    scenario_offsets[1:] = numpy.cumsum(numpy.bincount(row_scenarios, minlength=len(scenario_names)))
+    return scenario_offsets, row_edges[order].astype(numpy.int32), failure_edges
+
+
+def write_bundle(bundle_location, arrays, content_hash, array_names=BUNDLE_ARRAYS):
+    if not os.path.isdir(bundle_location):
+        os.makedirs(bundle_location)
+    for name in array_names:
+        numpy.save(os.path.join(bundle_location, name + '.npy'), arrays[name])
+    # the manifest is written last, so a partially written bundle is never considered valid
+    with open(os.path.join(bundle_location, 'manifest.json'), 'w') as manifest_file:
+        json.dump({'version': BUNDLE_VERSION, 'content_hash': content_hash, 'arrays': array_names}, manifest_file)
+
+
+def read_manifest(bundle_location):
+    try:
+        with open(os.path.join(bundle_location, 'manifest.json'), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class InstanceBundle(object):
+    """
+    The arrays of a compiled instance, and conversion to the dictionaries used by the scripts:
+    nodes {('d'|'c'|'gen_up_ub'|'H'|'h', node): value}, edges {('c'|'x'|'H'|'h', node1, node2): value},
+    scenarios {('s_pr', scenario): probability, ('s', scenario): [failed edges]}
+    """
+
+    def __init__(self, arrays, content_hash):
+        self.arrays = arrays
+        self.content_hash = content_hash
+
+    def with_scenarios(self, scenario_arrays, content_hash):
+        """
+        :return: an InstanceBundle of the same grid (the node and edge arrays are shared) with other scenarios
+        """
+        arrays = dict(self.arrays)
+        arrays.update(scenario_arrays)
+        return InstanceBundle(arrays, content_hash)
+
+    def nodes(self):
+        dic = dict()
+        for name, row in zip(self.arrays['node_names'], self.arrays['node_data']):
+            name = to_str(name)
+            dic[('d', name)] = float(row[0])  # read demand
+            dic[('c', name)] = float(row[1])  # read capacity
+            dic[('gen_up_ub', name)] = float(row[2])  # max generation upgrade
+            dic[('H', name)] = float(row[3])  # fixed cost
+            dic[('h', name)] = float(row[4])  # variable cost
+        return dic
+
+    def edges(self, capacity_factor=1.0, establish_cost_scale=1.0, upgrade_cost_scale=1.0):
+        """
+        :param capacity_factor: the load capacity factor multiplying the capacity
+        :param establish_cost_scale: coefficient of the fixed (establishment) cost
+        :param upgrade_cost_scale: coefficient of the variable (upgrade) cost
+        """
+        dic = dict()
+        for edge_nodes, row in zip(self.arrays['edge_nodes'], self.arrays['edge_data']):
+            cur_edge = (to_str(edge_nodes[0]), to_str(edge_nodes[1]))
+            dic[('c',) + cur_edge] = float(row[0])*capacity_factor  # current capacity
+            dic[('x',) + cur_edge] = float(row[1])  # susceptance
+            dic[('H',) + cur_edge] = float(row[2])*establish_cost_scale  # fixed cost
+            dic[('h',) + cur_edge] = float(row[3])*upgrade_cost_scale  # variable cost
+        return dic
+
+    def num_scenarios(self):
+        return len(self.arrays['scenario_names'])
+
+    def scenario_failure_ids(self, position):
+        """
+        :return: the ids (positions in arrays['failure_edges']) of the failures of the scenario at position
+        """
+        return self.arrays['failure_edge_ids'][self.arrays['scenario_offsets'][position]:
+                                               self.arrays['scenario_offsets'][position + 1]]
+
+    def scenarios(self):
+        failure_edges = [(to_str(cur_edge[0]), to_str(cur_edge[1])) for cur_edge in self.arrays['failure_edges']]
+        # plain lists, indexing memory mapped arrays element by element is slow
+        offsets = self.arrays['scenario_offsets'].tolist()
+        edge_ids = self.arrays['failure_edge_ids'].tolist()
+        probabilities = self.arrays['scenario_probabilities'].tolist()
+        dic = dict()
+        for i, name in enumerate(self.arrays['scenario_names']):
+            name = to_str(name)
+            if probabilities[i] == probabilities[i]:  # nan for scenarios without probability
+                dic[('s_pr', name)] = probabilities[i]
+            if offsets[i + 1] > offsets[i]:
+                dic[('s', name)] = [failure_edges[edge_id] for edge_id in edge_ids[offsets[i]:offsets[i + 1]]]
+        return dic
+
+
+def load_bundle(bundle_location, content_hash, array_names, compile_arrays, write_cache):
+    """
+    Load arrays from a bundle, compiling (and caching) them if the bundle is missing or stale.
+    :param compile_arrays: a function compiling the arrays from the source files
+    :return: dictionary {array name: numpy array}
+    """
+    manifest = read_manifest(bundle_location)
+    if manifest is not None and manifest.get('version') == BUNDLE_VERSION and \
+            manifest.get('content_hash') == content_hash:
+        return {name: numpy.load(os.path.join(bundle_location, name + '.npy'), mmap_mode='r') for name in array_names}
+    arrays = compile_arrays()
+    if write_cache:
+        try:
+            write_bundle(bundle_location, arrays, content_hash, array_names)
+        except (IOError, OSError):
+            pass  # e.g., a read only instance directory, the compiled arrays are used without caching
+    return arrays
+
+
+def load_instance(instance_location, write_cache=True):
+    """
+    Load an instance from its bundle, compiling (and caching) the bundle if it is missing or stale.
+    :param instance_location: the instance directory
+    :param write_cache: write the compiled bundle into the instance directory (ignored if it is not writable)
+    :return: an InstanceBundle
+    """
+    content_hash = source_hash(instance_location)
+    if (instance_location, content_hash) in loaded_instances:
+        return loaded_instances[(instance_location, content_hash)]
+    arrays = load_bundle(os.path.join(instance_location, BUNDLE_DIRECTORY), content_hash, BUNDLE_ARRAYS,
+                         lambda: compile_instance(instance_location), write_cache)
+    return InstanceBundle(arrays, content_hash)
+
+
+def preload_instance(instance_location):
+    """
+    Load an instance into memory (its arrays are read out of their memory maps), and keep it for later
+    load_instance calls of this process (e.g., the runs of a batch_runner.py worker).
+    :param instance_location: the instance directory, exactly as the scripts pass it to load_instance
+    :return: an InstanceBundle
+    """
+    instance = load_instance(instance_location)
+    instance.arrays = {name: numpy.array(values) for name, values in instance.arrays.items()}
+    loaded_instances[(instance_location, instance.content_hash)] = instance
+    return instance
+
+
+def load_variant(instance, instance_location, variant, write_cache=True):
+    """
+    Load a scenario variant of an instance, against the instance's (already loaded) grid.
+    :param instance: the InstanceBundle of the instance, as returned by load_instance
+    :param instance_location: the instance directory
+    :param variant: the variant name, i.e., scenario_failures_VARIANT.csv and scenario_probabilities_VARIANT.csv
+                    (an empty name is the instance's own scenarios)
+    :param write_cache: write the compiled variant bundle into the instance directory
+    :return: an InstanceBundle sharing the grid arrays of instance
+    """
+    if not variant:
+        return instance
+    failures_filename, probabilities_filename = [os.path.join(instance_location, filename)
+                                                 for filename in variant_files(variant)]
+    content_hash = source_hash(instance_location, variant_files(variant))
+    arrays = load_bundle(os.path.join(instance_location, BUNDLE_DIRECTORY, 'variant_' + variant), content_hash,
+                         SCENARIO_ARRAYS, lambda: compile_scenarios(failures_filename, probabilities_filename),
+                         write_cache)
+    return instance.with_scenarios(arrays, content_hash)
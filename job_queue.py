@@ -0,0 +1,121 @@
+# ------------------------------------------------------------------------------
+# Name:        Job queue
+# Purpose:     A durable queue of experiment runs (jobs), kept in a local SQLite database, so that a batch
+#              campaign survives a crash or a reboot of the machine running it.
+#              Every job is pending, running, or finished (completed, failed or timeout). A job is claimed
+#              (marked running) before it starts, and finished when it ends. Jobs which are still marked
+#              running when the queue is opened again were interrupted - they are returned to pending,
+#              and resume from their checkpoint (see batch_runner.py).
+# ------------------------------------------------------------------------------
+
+import json
+import sqlite3
+import time
+
+JOB_COLUMNS = ['job_id', 'program', 'arguments', 'status', 'attempts', 'checkpoint', 'start_time', 'end_time',
+               'wall_time', 'exit_code', 'result']
+
+
+class JobQueue(object):
+    """
+    Usage: queue = JobQueue(filename); queue.add(runs); job = queue.claim(); ...; queue.finish(job['job_id'], ...)
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: the SQLite database (created if missing)
+        """
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                       job_id INTEGER PRIMARY KEY,
+                                       program TEXT NOT NULL,
+                                       arguments TEXT NOT NULL,
+                                       status TEXT NOT NULL DEFAULT 'pending',
+                                       attempts INTEGER NOT NULL DEFAULT 0,
+                                       checkpoint TEXT NOT NULL DEFAULT '',
+                                       start_time REAL,
+                                       end_time REAL,
+                                       wall_time REAL,
+                                       exit_code INTEGER,
+                                       result TEXT NOT NULL DEFAULT '')""")
+        self.connection.commit()
+
+    def add(self, runs):
+        """
+        :param runs: list of (program, list of arguments)
+        :return: the ids of the added jobs
+        """
+        job_ids = []
+        with self.connection:
+            for program, arguments in runs:
+                cursor = self.connection.execute("INSERT INTO jobs (program, arguments) VALUES (?, ?)",
+                                                 (program, json.dumps(list(arguments))))
+                job_ids.append(cursor.lastrowid)
+        return job_ids
+
+    def recover(self):
+        """
+        Return the jobs interrupted while running (e.g., by a crash) to pending.
+        :return: number of recovered jobs
+        """
+        with self.connection:
+            cursor = self.connection.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+        return cursor.rowcount
+
+    def claim(self):
+        """
+        Mark the next pending job as running.
+        :return: the job as a dictionary (see JOB_COLUMNS, arguments as a list), None if no job is pending
+        """
+        with self.connection:
+            row = self.connection.execute("SELECT " + ", ".join(JOB_COLUMNS) + " FROM jobs WHERE status = 'pending' "
+                                          "ORDER BY job_id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, start_time = ? "
+                                    "WHERE job_id = ?", (time.time(), row[0]))
+        job = dict(zip(JOB_COLUMNS, row))
+        job['arguments'] = json.loads(job['arguments'])
+        job['status'] = 'running'
+        job['attempts'] += 1
+        return job
+
+    def pending_runs(self):
+        """
+        :return: list of (program, list of arguments) of the pending jobs
+        """
+        return [(program, json.loads(arguments)) for program, arguments in
+                self.connection.execute("SELECT program, arguments FROM jobs WHERE status = 'pending' "
+                                        "ORDER BY job_id").fetchall()]
+
+    def set_checkpoint(self, job_id, checkpoint):
+        with self.connection:
+            self.connection.execute("UPDATE jobs SET checkpoint = ? WHERE job_id = ?", (checkpoint, job_id))
+
+    def finish(self, job_id, status, exit_code=None, wall_time=None, result=''):
+        """
+        :param status: completed, failed or timeout
+        """
+        with self.connection:
+            self.connection.execute("UPDATE jobs SET status = ?, end_time = ?, exit_code = ?, wall_time = ?, "
+                                    "result = ? WHERE job_id = ?",
+                                    (status, time.time(), exit_code, wall_time, result, job_id))
+
+    def retry(self, statuses=('failed', 'timeout')):
+        """
+        Return finished jobs of the given statuses to pending (e.g., timeouts, to be continued from their checkpoint).
+        :return: number of jobs returned to pending
+        """
+        with self.connection:
+            cursor = self.connection.execute("UPDATE jobs SET status = 'pending' WHERE status IN (" +
+                                             ", ".join(['?']*len(statuses)) + ")", tuple(statuses))
+        return cursor.rowcount
+
+    def counts(self):
+        """
+        :return: dictionary {status: number of jobs}
+        """
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def close(self):
+        self.connection.close()
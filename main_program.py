@@ -15,13 +15,18 @@
 # ************************************************
 # ********* Import relevant libraries ************
 # ************************************************
-import cplex
-from cplex.callbacks import LazyConstraintCallback # import class for lazy callbacks
-from cplex.callbacks import HeuristicCallback
+try:
+    import cplex
+    from cplex.callbacks import LazyConstraintCallback # import class for lazy callbacks
+    from cplex.callbacks import HeuristicCallback
+except ImportError:
+    cplex = None # the problem is built by the model builder instead, see --flow_backend
+import model_builder
 import sys
 import os
 import csv
 import networkx as nx
+import multiprocessing
 from time import gmtime, strftime, clock, time # for placing timestamp on debug solution files, and checking run time
 
 
@@ -29,18 +34,43 @@ from time import gmtime, strftime, clock, time # for placing timestamp on debug
 # ******* Parse from command line args ***********
 # ************************************************
 import argparse
+from instance_loader import load_instance, load_variant
+from edge_bitset import EdgeIndex
+from scenario_reduction import scenario_signatures, cluster_scenarios, reduce_scenarios, reduction_report
+from scenario_dominance import ScenarioDominanceIndex
+from benders_decomposition import optimality_cut, ScenarioSubproblems
+from results_store import open_results_store, output_path, set_output_directory
+from telemetry import metrics, start_reporting
+import profiling
+from profiling import span, profiled
 parser = argparse.ArgumentParser(description = "Run a Power Grid Robust Optimization of full cascade depth (PGRO2) with Lazy constraints callback.")
 parser.add_argument('--instance_location', help = "Provide the location for instance files (directory name)", type = str, default = "case30")
 parser.add_argument('--time_limit', help = "Set a time limit for CPLEX run (in hours)", type = float, default = 1)
 parser.add_argument('--opt_gap', help = "Optimality gap for CPLEX run", type = float, default = 0.01) # 0.01 = 1%
 parser.add_argument('--budget', help = "Budget constraint for optimization problem", type = float, default = 0.0)
-parser.add_argument('--print_lp', help = "Export c:/temp/grid_cascade_output/tmp_robust_1_cascade.lp", action = "store_true")
+parser.add_argument('--print_lp', help = "Export tmp_robust_lp.lp into the output directory", action = "store_true")
 parser.add_argument('--print_debug_function_tracking', help = "Print a message upon entering each function", action = "store_true")
 parser.add_argument('--export_results_file', help = "Save the solution file with variable names", action = "store_true")
+parser.add_argument('--flow_backend', help = "Build the problem and solve the flow problems of the cascade simulation with CPLEX (cplex), or with the model builder (matrix, see model_builder.py: the problem is built but not solved, e.g., by benchmark_model.py). Without CPLEX, cplex falls back to matrix with a warning", type = str, default = "cplex", choices = ['cplex', 'matrix'])
 parser.add_argument('--disable_cplex_messages', help = "Disables CPLEX's log, warning, error and results message streams", action = "store_true")
 parser.add_argument('--penalize_failures', help = "Attach penalization coefficient to first order cascade failures (specify value)", type = float, default = 0.0)
-parser.add_argument('--use_benders', help = "Use Bender's decomposition", action = "store_true")
-parser.add_argument('--scenario_variant', help = "*** NOT IMPLEMENTED YET *** Select a scenario variant for given instance, i.e. load scenario_failures_VARIANTNAME.csv and scenario_probabilities_VARIANTNAME.csv", type = str, default = "")
+parser.add_argument('--use_benders', help = "Use Bender's decomposition: a master problem with the investment variables and a supply estimate per scenario, cut by the scenarios' cascade simulations (see benders_decomposition.py)", action = "store_true")
+parser.add_argument('--benders_workers', help = "Number of processes solving the scenario subproblems in Bender's decomposition [0 = number of cores]", type = int, default = 0)
+parser.add_argument('--scenario_variant', help = "Select a scenario variant for given instance, i.e. load scenario_failures_VARIANTNAME.csv and scenario_probabilities_VARIANTNAME.csv. "
+                                                 "Several variants can be given, separated by commas, and are solved one after the other against the same grid (an empty name is the instance's own scenarios)", type = str, default = "")
+parser.add_argument('--scenario_reduction', help = "Simulate every scenario on the base grid and build the problem over representatives of scenarios with equivalent cascades (aggregated probabilities)", action = "store_true")
+parser.add_argument('--reduction_tolerance', help = "Maximal Jaccard distance between the cascade failures of merged scenarios (0 merges identical cascades only)", type = float, default = 0.0)
+parser.add_argument('--scenario_dominance', help = "In complete simulations, skip scenarios whose initial failures are the failures of another scenario's cascade up to some step (their outcome is determined)", action = "store_true")
+parser.add_argument('--mip_start', help = "Start CPLEX from a grid saved as a gpickle (e.g., by robustness_heuristic_upper_bound.py --export_final_grid): "
+                                         "the grid is mapped to the investment variables, and completed by its cascade simulation and flows into a MIP start", type = str, default = "")
+parser.add_argument('--output_directory', help = "Directory of the output files and the results store "
+                                                "[default: the GRID_CASCADE_OUTPUT environment variable, or c:/temp/grid_cascade_output on windows]", type = str, default = "")
+parser.add_argument('--results_store', help = "The results store, a SQLite database [default: results.sqlite in the output directory]", type = str, default = "")
+parser.add_argument('--metrics_file', help = "Write live progress metrics (see telemetry.py) as a json snapshot to this file [default: no snapshots]", type = str, default = "")
+parser.add_argument('--metrics_port', help = "Serve live progress metrics at http://127.0.0.1:<port>/metrics [default: 0, no endpoint]", type = int, default = 0)
+parser.add_argument('--metrics_interval', help = "Seconds between metrics snapshots", type = float, default = 30.0)
+parser.add_argument('--profile', help = "Time the spans of the pipeline (see profiling.py), report them on screen and in the profile table of the results store", action = "store_true")
+parser.add_argument('--profile_trace', help = "Also write the profile as folded stacks (for flamegraph.pl or speedscope) to this file [default: none]", type = str, default = "")
 parser.add_argument('--print_debug', help = "Should I print the screen output to a file instead? (mainly used for debugging)", action = "store_true")
 parser.add_argument('--print_debug_verbose', help = "Should I print out a verbose output of the lazy constraints steps?", action = "store_true")
 parser.add_argument('--write_mid_run_results_files', help = "Should I track and save the results in each lazy iteration?", action = "store_true")
@@ -63,7 +93,7 @@ parser.add_argument('--load_capacity_factor', help = "The load capacity factor -
                                                      "Change the existing capacity by this factor.",
                     type = float, default = 1.0)
 parser.add_argument('--dump_file', help="Save the final objective outcome (number of run), "
-                                          "saved to c:/temp/grid_cascade_output/dump.csv",
+                                          "saved to the dump table of the results store",
                     type=float, default=0.0)
 parser.add_argument('--variable_select_strategy', type = int, default = 0,
                     help = "Sets the rule for selecting the branching variable at the node "
@@ -112,6 +142,11 @@ parser.add_argument('--mip_emphasis', type = int, default = 0,
 # ... add additional arguments as required here ..
 args = parser.parse_args()
 
+solver = model_builder.select_solver(args.flow_backend, cplex) # the module which builds (and solves) the problems
+solver_available = (solver is cplex)
+if not solver_available: # the callbacks are called through the model builder's mock callback (see benchmark_model.py)
+    LazyConstraintCallback = model_builder.MockCallback
+    HeuristicCallback = model_builder.MockCallback
 
 
 # **************************************************
@@ -141,13 +176,13 @@ time_spent_cascade_sim = 0 # total time spent on cascade simulator
 instance_location = os.getcwd() + '\\' + args.instance_location + '\\'
 
 from time import strftime, clock, gmtime
-append_solution_statistics = "c:\\temp\\grid_cascade_output\\" + strftime('%d-%m-%Y %H-%M-%S-', gmtime()) + str(round(clock(), 3)) + ' - ' + args.instance_location + '_solution_statistics.csv'
-with open(append_solution_statistics, 'ab') as f:
-    writer = csv.writer(f)
-    writer.writerow(["line_upgrade_cost_coef_scale", "line_establish_cost_coef_scale",
-                     "line_upgrade_capacity_coef_scale", "line_establish_capacity_coef_scale",
-                     "set_decision_var_priorities", "runtime", "net_runtime_simulations", "best_incumbent"])
+# results are written into the results store (see results_store.py), opened (and its run registered) by main_program()
+set_output_directory(args.output_directory)
+results_store = None
+append_solution_statistics = True # track the solution statistics (the solution_statistics table of the results store)
+profiling.enable(args.profile or bool(args.profile_trace)) # timing spans (see profiling.py)
 
+dominance_index = None # scenario dominance index (--scenario_dominance), built once the scenarios are read
 best_incumbent = 0 # the best solution reached so far - to be used in the heuristic callback
 run_heuristic_callback = False # default is not to run heuristic callback until the lazy callback indicates a new incumbent
 incumbent_solution_from_lazy = {} # incumbent solution (dictionary): solution by cplex with failures.
@@ -185,35 +220,96 @@ load_capacity_factor = args.load_capacity_factor # change the existing capacity
 # ******* The main program ***************************
 # ****************************************************
 def main_program():
-    start_time = time()
+    if not solver_available:
+        sys.exit("Error: CPLEX is required to solve the problem (--flow_backend cplex), the model builder only builds it, see benchmark_model.py")
+    global results_store
+    results_store = open_results_store('main_program.py', vars(args), args.results_store)
+    start_reporting(args.metrics_file, args.metrics_port, args.metrics_interval) # live progress metrics (see telemetry.py)
     timestamp = strftime('%d-%m-%Y %H-%M-%S-', gmtime()) + str(round(clock(), 3)) + ' - '
 
-    if print_debug:
-        import sys # for directing print output to a file instead of writing to screen
+    if print_debug: # direct the print output to a file instead of writing to screen
         orig_stdout = sys.stdout
-        f = open('c:/TEMP/grid_cascade_output/callback debug/' + timestamp + 'print_output.txt', 'w')
+        f = open(output_path('callback debug', timestamp + 'print_output.txt'), 'w')
         sys.stdout = f
 
     # Read required data and declare as global for use across module
     global nodes
     global edges
-    global scenarios
     global params
-    nodes = read_nodes(instance_location + 'grid_nodes.csv')
-    edges = read_edges(instance_location + 'grid_edges.csv')
-    scenarios = read_scenarios(instance_location + 'scenario_failures.csv', instance_location + 'scenario_probabilities.csv')
+    instance = load_instance(instance_location)  # compiled once into a binary bundle, see instance_loader.py
+    nodes = instance.nodes()
+    edges = instance.edges(load_capacity_factor, line_establish_cost_coef_scale, line_upgrade_cost_coef_scale)
+    global edge_index # failed edge sets are bitsets over this index (see edge_bitset.py)
+    edge_index = EdgeIndex([(min(i[1],i[2]), max(i[1],i[2])) for i in edges.keys() if i[0] == 'c'])
     params = {'C': args.budget}
 
+    # the grid is read once, and shared by all scenario variants
+    for variant in [cur_variant.strip() for cur_variant in args.scenario_variant.split(',')]:
+        if args.scenario_variant:
+            print "Scenario variant:", (variant if variant else "(instance scenarios)")
+        solve_scenario_variant(load_variant(instance, instance_location, variant), variant, timestamp)
+
+    # Cancel print to file (initiated for debug purposes).
+    if print_debug:
+        sys.stdout = orig_stdout
+        f.close()
+
+
+def solve_scenario_variant(instance, variant, timestamp):
+    """
+    Build and solve the problem for the scenarios of a variant, and export its results (keyed by the variant).
+    :param instance: the InstanceBundle of the variant (see instance_loader.load_variant)
+    :param variant: the variant name (empty for the instance's own scenarios)
+    :param timestamp: prefix of the exported files
+    """
+    start_time = time()
+    global scenarios
+    global best_incumbent
+    global run_heuristic_callback
+    global incumbent_solution_from_lazy
+    global time_spent_cascade_sim
+    scenarios = instance.scenarios()
+    best_incumbent = 0
+    run_heuristic_callback = False
+    incumbent_solution_from_lazy = {}
+    time_spent_cascade_sim = 0
+    variant_key = ('_' + variant) if variant else ''
+    metrics.set('variant', variant)
+    metrics.set('incumbent', best_incumbent)
+    profiling.reset() # the profile is per variant
+
+    if args.scenario_reduction:
+        scenarios = reduce_scenario_set(scenarios, variant_key)
+    global dominance_index
+    if args.scenario_dominance:
+        dominance_index = ScenarioDominanceIndex(scenarios)
+
     # build problem
-    build_results = build_cplex_problem()
+    with span('model_build'):
+        if args.use_benders:
+            build_results = build_benders_master()
+        else:
+            build_results = build_cplex_problem()
     robust_opt_cplex = build_results['cplex_problem']
     dvar_pos = build_results['cplex_location_dictionary'] # useful for debugging
 
     if print_lp:
-        robust_opt_cplex.write("c:/temp/grid_cascade_output/tmp_robust_lp.lp")
+        robust_opt_cplex.write(output_path("tmp_robust_lp" + variant_key + ".lp"))
+
+    if args.use_benders:
+        # the scenario subproblems are solved by worker processes, which get the instance upon initialization
+        global benders_subproblems
+        benders_subproblems = ScenarioSubproblems(all_scenarios, benders_subproblem,
+                                                  args.benders_workers if args.benders_workers > 0 else multiprocessing.cpu_count(),
+                                                  initializer = init_benders_worker,
+                                                  initargs = (nodes, edges, scenarios, dvar_pos, edge_index, dominance_index))
+        robust_opt_cplex.register_callback(BendersLazy)
+    else:
+        robust_opt_cplex.register_callback(MyLazy) # register the lazy callback
+        robust_opt_cplex.register_callback(IncumbentHeuristic)
 
-    robust_opt_cplex.register_callback(MyLazy) # register the lazy callback
-    robust_opt_cplex.register_callback(IncumbentHeuristic)
+    if args.mip_start:
+        add_mip_start(robust_opt_cplex, nx.read_gpickle(args.mip_start))
 
     time_spent_total = clock() # initialize solving time
     robust_opt_cplex.parameters.mip.tolerances.mipgap.set(epgap) # set target optimality gap
@@ -225,10 +321,15 @@ def main_program():
     # enable multithread search
     #robust_opt_cplex.parameters.threads.set(robust_opt_cplex.get_num_cores())
 
-    robust_opt_cplex.solve()  #solve the model
+    with span('mip_solve'):
+        robust_opt_cplex.solve()  #solve the model
 
     elapsed_time = time() - start_time  # total time the model was run.
 
+    if args.use_benders:
+        benders_subproblems.close()
+        print "Bender's decomposition: designs evaluated", benders_subproblems.num_solved, "cache hits", benders_subproblems.num_cache_hits
+
     print "Solution status = " , robust_opt_cplex.solution.get_status(), ":",
     # the following line prints the corresponding status string
     print robust_opt_cplex.solution.status[robust_opt_cplex.solution.get_status()]
@@ -241,8 +342,14 @@ def main_program():
         current_solution = robust_opt_cplex.solution.get_values() + [robust_opt_cplex.solution.get_objective_value(), robust_opt_cplex.solution.MIP.get_mip_relative_gap()]
         current_var_names = robust_opt_cplex.variables.get_names() + ['Objective', 'Opt. Gap.']
 
-        tot_supply = [sum([current_solution[dvar_pos[wkey]] for wkey in dvar_pos.keys() if wkey[0] == 'w' if wkey[2] == cur_scenario[1]]) for cur_scenario in scenarios.keys() if cur_scenario[0] == 's_pr']
-        tot_unsupplied = [scenarios[cur_scenario]*sum([nodes[('d', wkey[1])]-current_solution[dvar_pos[wkey]] for wkey in dvar_pos.keys() if wkey[0] == 'w' if wkey[2] == cur_scenario[1]]) for cur_scenario in scenarios.keys() if cur_scenario[0] == 's_pr']
+        if args.use_benders:
+            # the master's supply estimates are exact at the final design (no optimality cut is violated)
+            tot_demand = sum([nodes[i] for i in nodes.keys() if i[0] == 'd'])
+            tot_supply = [current_solution[dvar_pos[('eta', cur_scenario[1])]] for cur_scenario in scenarios.keys() if cur_scenario[0] == 's_pr']
+            tot_unsupplied = [scenarios[cur_scenario]*(tot_demand - current_solution[dvar_pos[('eta', cur_scenario[1])]]) for cur_scenario in scenarios.keys() if cur_scenario[0] == 's_pr']
+        else:
+            tot_supply = [sum([current_solution[dvar_pos[wkey]] for wkey in dvar_pos.keys() if wkey[0] == 'w' if wkey[2] == cur_scenario[1]]) for cur_scenario in scenarios.keys() if cur_scenario[0] == 's_pr']
+            tot_unsupplied = [scenarios[cur_scenario]*sum([nodes[('d', wkey[1])]-current_solution[dvar_pos[wkey]] for wkey in dvar_pos.keys() if wkey[0] == 'w' if wkey[2] == cur_scenario[1]]) for cur_scenario in scenarios.keys() if cur_scenario[0] == 's_pr']
         tot_supply_sce = ['supply_s' + cur_scenario[1] for cur_scenario in scenarios.keys() if cur_scenario[0] == 's_pr']
         tot_supply_missed = ['un_supplied_s' + cur_scenario[1] for cur_scenario in scenarios.keys() if cur_scenario[0] == 's_pr']
 
@@ -257,79 +364,64 @@ def main_program():
         if write_res_file:
             timestamp = strftime('%d-%m-%Y %H-%M-%S-', gmtime()) + str(round(clock(), 3)) + ' - '
             write_names_values(current_solution, current_var_names,
-                               'c:/temp/grid_cascade_output/' + timestamp + '-' +
-                               str(args.dump_file) + '-' + 'temp_sol.csv')
-
-
-    # Cancel print to file (initiated for debug purposes).
-    if print_debug:
-        sys.stdout = orig_stdout
-        f.close()
+                               output_path(timestamp + '-' + str(args.dump_file) + variant_key + '-' + 'temp_sol.csv'))
 
 
     # Add final line for results file
     if append_solution_statistics:
-            with open(append_solution_statistics, 'ab') as f:
-                best_incumbent = robust_opt_cplex.solution.get_objective_value()
-                writer = csv.writer(f)
-                writer.writerow([line_upgrade_cost_coef_scale, line_establish_cost_coef_scale,
-                                 line_upgrade_capacity_coef_scale, line_establish_capacity_coef_scale,
-                                 set_decision_var_priorities, clock(), "NA", best_incumbent])
+        best_incumbent = robust_opt_cplex.solution.get_objective_value()
+        write_solution_statistics(clock(), None, variant)
 
-    with open("c:/temp/grid_cascade_output/dump.csv", 'ab') as dump_file:
-        writer = csv.writer(dump_file)
-        writer.writerow([args.dump_file, best_incumbent, elapsed_time])
-    write_names_values(current_solution, current_var_names,
-                       'c:/temp/grid_cascade_output/detailed_results/' + str(args.dump_file) + '.csv')
+    results_store.append('dump', {'dump_file': args.dump_file, 'objective': best_incumbent, 'elapsed_time': elapsed_time, 'variant': variant})
+    results_store.extend('detailed_results', [{'dump_file': args.dump_file, 'variant': variant, 'name': current_var_names[i], 'value': current_solution[i]} for i in xrange(len(current_var_names))])
+
+    if profiling.enabled:
+        profiling.print_report()
+        results_store.extend('profile', [dict(zip(profiling.REPORT_COLUMNS, row), dump_file = args.dump_file, variant = variant) for row in profiling.report()])
+        if args.profile_trace:
+            profiling.write_folded(args.profile_trace + variant_key)
 
 
 # ****************************************************
-# ********** Read files ******************************
+# ********** Scenario reduction **********************
 # ****************************************************
-def read_nodes(filename):
-    dic = dict()
-    with open(filename, 'rb') as nodesfile:
-        nodes_reader = csv.reader(nodesfile, delimiter = ',')
-        next(nodes_reader) # assuimng header, skip first line
-        for row in nodes_reader:
-            dic[('d', row[0])] = float(row[1]) # read demand
-            dic[('c', row[0])] = float(row[2]) # read capacity
-            dic[('gen_up_ub', row[0])] = float(row[3]) # max generation upgrade
-            dic[('H', row[0])] = float(row[4])  # fixed cost
-            dic[('h', row[0])] = float(row[5])  # variable cost
-    return dic
+def simulate_base_grid(failed_edges):
+    """
+    Run a complete cascade of the initial failures on the base grid (no upgrades, no new edges).
+    :param failed_edges: list of initially failed edges
+    :return: (list of all failed edges, total supply)
+    """
+    base_grid = build_base_nx_grid(nodes, edges)
+    cfe_result = cfe(base_grid, failed_edges, write_solution_file = False, simulation_complete_run = True)
+    result_grid = cfe_result['updated_grid_copy']
+    return(cfe_result['all_failed'], sum([result_grid.node[cur_node]['demand'] for cur_node in result_grid.nodes()]))
 
-def read_edges(filename):
-    dic = dict()
-    with open(filename, 'rb') as edgesfile:
-        csv_reader = csv.reader(edgesfile, delimiter = ',')
-        next(csv_reader) # assuimng header, skip first line
-        for row in csv_reader:
-            cur_edge = arrange_edge_minmax(row[0], row[1])
-            dic[('c',) + cur_edge] = float(row[2])*load_capacity_factor  # current capacity
-            dic[('x',) + cur_edge] = float(row[3]) # susceptance
-            dic[('H',) + cur_edge] = float(row[4])*line_establish_cost_coef_scale  # fixed cost
-            dic[('h',) + cur_edge] = float(row[5])*line_upgrade_cost_coef_scale  # variable cost
-    return dic
 
-def read_scenarios(filename_fail, filename_pr):
-    dic = dict()
-    with open(filename_pr, 'rb') as prfile:
-        csv_reader = csv.reader(prfile, delimiter = ',')
-        next(csv_reader) # assuming header, skip first line
-        for row in csv_reader:
-            dic[('s_pr', row[0])] = float(row[1])
+def reduce_scenario_set(scenarios, variant_key = ''):
+    """
+    Cluster scenarios with identical (or near identical, up to --reduction_tolerance) cascades on the base grid,
+    and keep a representative of each cluster with the cluster's aggregated probability.
+    :param scenarios: the scenarios dictionary
+    :param variant_key: the scenario variant (as a file name suffix)
+    :return: the reduced scenarios dictionary
+    """
+    signatures = scenario_signatures(scenarios, simulate_base_grid)
+    clusters = cluster_scenarios(scenarios, signatures, args.reduction_tolerance)
+    report = reduction_report(scenarios, signatures, clusters)
+    print "Scenario reduction:", report['num_scenarios'], "scenarios ->", report['num_representatives'], "representatives"
+    print "   Expected supply on base grid (full/reduced):", report['expected_supply'], "/", report['reduced_expected_supply'], \
+        "error:", report['supply_error'], "max supply deviation:", report['max_supply_deviation'], \
+        "max Jaccard distance:", report['max_jaccard_distance'], "merged probability:", report['merged_probability']
+    if write_res_file:
+        results_store.extend('scenario_reduction', [{'variant': variant_key.lstrip('_'), 'scenario': cur_scenario, 'representative': representative,
+                                                     'probability': scenarios[('s_pr', cur_scenario)], 'base_grid_supply': signatures[cur_scenario][1]}
+                                                    for representative, members in sorted(clusters.items()) for cur_scenario in members])
+    return(reduce_scenarios(scenarios, clusters))
 
-    with open(filename_fail, 'rb') as failurefile:
-        csv_reader = csv.reader(failurefile, delimiter = ',')
-        next(csv_reader) # assuimng header, skip first line
-        for row in csv_reader:
-            if ('s', row[0]) in dic.keys():
-                dic[('s', row[0])] += [arrange_edge_minmax(row[1], row[2])] # failures
-            else:
-                dic[('s', row[0])] = [arrange_edge_minmax(row[1], row[2])] # first failure in this scenario
-    return dic
 
+# ****************************************************
+# ********** Read files ******************************
+# ****************************************************
 def read_additional_param(filename):
     dic = dict()
     with open(filename, 'rb') as paramfile:
@@ -354,6 +446,19 @@ def arrange_edge_minmax(edge_i, edge_j = []):
 # ****************************************************
 # ****** Export files ********************************
 # ****************************************************
+def write_solution_statistics(runtime, net_runtime_simulations, variant = ''):
+    """
+    Append the current statistics (runtime, time spent on simulations and the best incumbent) to the results store.
+    """
+    results_store.append('solution_statistics', {'instance_location': args.instance_location, 'variant': variant,
+                                                 'line_upgrade_cost_coef_scale': line_upgrade_cost_coef_scale,
+                                                 'line_establish_cost_coef_scale': line_establish_cost_coef_scale,
+                                                 'line_upgrade_capacity_coef_scale': line_upgrade_capacity_coef_scale,
+                                                 'line_establish_capacity_coef_scale': line_establish_capacity_coef_scale,
+                                                 'set_decision_var_priorities': set_decision_var_priorities, 'runtime': runtime,
+                                                 'net_runtime_simulations': net_runtime_simulations, 'best_incumbent': best_incumbent})
+
+
 def write_names_values(current_solution, variable_names, csvfilename):
     #if variable_names != []:
     var_row = [[variable_names[i], current_solution[i]] for i in range(len(variable_names))]
@@ -505,7 +610,7 @@ def create_cplex_object():
     if print_debug_function_tracking:
         print "ENTERED: create_cplex_object()"
     # initialize cplex object
-    robust_opt = cplex.Cplex()
+    robust_opt = solver.Cplex()
     robust_opt.objective.set_sense(robust_opt.objective.sense.maximize) # maximize supplied energy "=" minimize expected loss of load
 
     # building the decision variables within object
@@ -606,6 +711,76 @@ def create_cplex_object():
             gen_cap_lhs_coef = [1, -bigM]
             robust_opt.linear_constraints.add(lin_expr = [[gen_cap_lhs, gen_cap_lhs_coef]], senses = "L", rhs = [0])
 
+    add_investment_constraints(robust_opt)
+
+    return robust_opt
+
+
+
+
+
+def build_benders_master():
+    """
+    Build the master problem of Bender's decomposition (--use_benders): the investment variables (c, X, Z) and
+    a supply estimate eta per scenario. The flow, phase angle and failure variables of the scenarios are replaced by
+    the scenario subproblems - cascade simulations of the master's design - which add optimality cuts on eta
+    in the lazy callback (BendersLazy). The model size does not depend on scenarios x edges.
+    Z does not affect the simulated grid (see build_nx_grid), hence it is not part of the cuts.
+    Returns the same dictionary as build_cplex_problem.
+    """
+    if print_debug_function_tracking:
+        print "ENTERED: build_benders_master()"
+    global dvar_pos
+    global dvar_name
+    global all_edges
+    global all_nodes
+    global all_scenarios
+    global benders_design_positions # the binary design variables of the optimality cuts
+    global benders_upper_bound # an upper bound of the supply in any scenario
+
+    all_scenarios = [i[1] for i in scenarios.keys() if i[0] == 's']
+    all_nodes = [i[1] for i in nodes.keys() if i[0] == 'd']
+    all_edges = [(min(i[1],i[2]), max(i[1],i[2])) for i in edges.keys() if i[0] == 'c']
+    new_edges = [(min(i[1],i[2]), max(i[1],i[2])) for i in edges.keys() if i[0] == 'H' and edges[i] > 0]
+    if any([nodes[('gen_up_ub', cur_node)] > 0 for cur_node in all_nodes]):
+        sys.exit("Error: Bender's decomposition supports binary investments only (gen_upgrade_ub must be 0)")
+    tot_demand = sum([nodes[('d', cur_node)] for cur_node in all_nodes])
+    benders_upper_bound = min(tot_demand, sum([nodes[('c', cur_node)] for cur_node in all_nodes]))
+
+    dvar_name = []
+    dvar_pos = dict()
+    dvar_obj_coef = []
+    dvar_lb = []
+    dvar_ub = []
+    dvar_type = []
+    # (name, position key, objective coefficient, lower bound, upper bound, type)
+    master_variables = [('c_' + cur_node, ('c', cur_node), 0, 0, nodes[('gen_up_ub', cur_node)], 'C') for cur_node in all_nodes] + \
+                       [('Z_' + cur_node, ('Z', cur_node), 0, 0, 1, 'B') for cur_node in all_nodes] + \
+                       [('c_' + cur_edge[0] + '_' + cur_edge[1], ('c', cur_edge), 0, 0, 1, 'B') for cur_edge in all_edges] + \
+                       [('X_' + cur_edge[0] + '_' + cur_edge[1], ('X_', cur_edge), 0, 0, 1, 'B') for cur_edge in all_edges if cur_edge in new_edges] + \
+                       [('eta_s' + cur_scenario, ('eta', cur_scenario), scenarios[('s_pr', cur_scenario)], 0, benders_upper_bound, 'C') for cur_scenario in all_scenarios]
+    for name, position_key, obj_coef, lb, ub, var_type in master_variables:
+        dvar_name.append(name)
+        dvar_pos[position_key] = len(dvar_name)-1
+        dvar_obj_coef.append(obj_coef)
+        dvar_lb.append(lb)
+        dvar_ub.append(ub)
+        dvar_type.append(var_type)
+    benders_design_positions = [dvar_pos[('c', cur_edge)] for cur_edge in all_edges] + [dvar_pos[('X_', cur_edge)] for cur_edge in all_edges if ('X_', cur_edge) in dvar_pos]
+
+    robust_opt = solver.Cplex()
+    robust_opt.objective.set_sense(robust_opt.objective.sense.maximize) # maximize supplied energy "=" minimize expected loss of load
+    robust_opt.variables.add(obj = dvar_obj_coef, lb = dvar_lb, ub = dvar_ub, types = dvar_type, names = dvar_name)
+    add_investment_constraints(robust_opt)
+
+    return {'cplex_problem': robust_opt, 'cplex_location_dictionary': dvar_pos}
+
+
+def add_investment_constraints(robust_opt):
+    """
+    Add the constraints of the investment variables (c, X, Z): the link between establishing and upgrading an edge,
+    and the budget. Used by create_cplex_object and by build_benders_master.
+    """
     # Make sure that the establishment of edge ('X_', cur_edge) is directly linked to the decision ('c', cur_edge)
     # If edge was upgraded than it has necessarily been established
     # X_ij - c_ij >= -epsilon
@@ -621,11 +796,6 @@ def create_cplex_object():
                  [edges[('H',)+(i[1], i[2])] for i in edges.keys() if i[0] == 'H' and edges[i] > 0]
     robust_opt.linear_constraints.add(lin_expr = [[budget_lhs, budget_lhs_coef]], senses = "L", rhs = [params['C']])
 
-    return robust_opt
-
-
-
-
 
 # ****************************************************
 # ****** Add CPLEX lazy constraints ******************
@@ -660,16 +830,60 @@ class MyLazy(LazyConstraintCallback):
         timestampstr = strftime('%d-%m-%Y %H-%M-%S-', gmtime()) + str(round(clock(), 3)) + ' - '
 
         if write_mid_run_res_files:
-            write_names_values(current_solution, dvar_name, 'c:/temp/grid_cascade_output/callback debug/' + timestampstr + 'current_callback_solution.csv')
+            write_names_values(current_solution, dvar_name, output_path('callback debug', timestampstr + 'current_callback_solution.csv'))
 
         if not print_cfe_results==False:
             print_cfe_results = timestampstr
 
         cfe_constraints = build_cfe_constraints(current_solution, timestampstr = print_cfe_results)
+        metrics.inc('lazy_callbacks')
+        metrics.inc('lazy_constraints', len(cfe_constraints['positions']))
+
+        with span('cut_adding'):
+            [self.add(constraint = solver.SparsePair(cfe_constraints['positions'][i], cfe_constraints['coefficients'][i]), sense = "L", rhs = cfe_constraints['rhs'][i]) for i in xrange(len(cfe_constraints['positions']))]
+
+
+class BendersLazy(LazyConstraintCallback):
+    """
+    The lazy callback of Bender's decomposition: solves the scenario subproblems of the master's design (in parallel),
+    and adds an optimality cut for every scenario whose supply estimate exceeds its simulated supply.
+    """
+    def __call__(self):
+        global best_incumbent
+        global time_spent_cascade_sim
+        global time_spent_total
+
+        current_solution = self.get_values()
+        design_values = [current_solution[cur_pos] for cur_pos in benders_design_positions]
+
+        cfe_time_start = clock()
+        with span('benders_subproblems'):
+            scenario_supply = benders_subproblems.solve(tuple([int(round(cur_value)) for cur_value in design_values]), current_solution)
+        time_spent_cascade_sim += clock() - cfe_time_start
+        metrics.inc('lazy_callbacks')
+        metrics.set('benders_designs_evaluated', benders_subproblems.num_solved)
+        metrics.set('benders_cache_hit_rate', float(benders_subproblems.num_cache_hits)/(benders_subproblems.num_solved + benders_subproblems.num_cache_hits))
+        set_time_metrics()
+
+        expected_supply = sum([scenarios[('s_pr', cur_scenario)]*scenario_supply[cur_scenario] for cur_scenario in all_scenarios])
+        if expected_supply > best_incumbent:
+            best_incumbent = expected_supply
+            metrics.inc('incumbents')
+            metrics.set('incumbent', best_incumbent)
+            time_spent_total = clock()
+            print "Curr sol=", expected_supply, "Incumb=", best_incumbent, "Time on sim=", round(time_spent_cascade_sim), "Tot time", round(time_spent_total)
 
-        [self.add(constraint = cplex.SparsePair(cfe_constraints['positions'][i], cfe_constraints['coefficients'][i]), sense = "L", rhs = cfe_constraints['rhs'][i]) for i in xrange(len(cfe_constraints['positions']))]
+        for cur_scenario in all_scenarios:
+            if current_solution[dvar_pos[('eta', cur_scenario)]] > scenario_supply[cur_scenario] + epsilon:
+                with span('cut_building'):
+                    cut_positions, cut_coefficients, cut_rhs = optimality_cut(benders_design_positions, design_values,
+                                                                              dvar_pos[('eta', cur_scenario)],
+                                                                              scenario_supply[cur_scenario], benders_upper_bound)
+                with span('cut_adding'):
+                    self.add(constraint = solver.SparsePair(cut_positions, cut_coefficients), sense = "L", rhs = cut_rhs)
 
 
+@profiled('cut_building')
 def build_cfe_constraints(current_solution, timestampstr):
     """
     The function uses input from the cfe simulation (simulation_failures) and the grid, to build
@@ -699,12 +913,8 @@ def build_cfe_constraints(current_solution, timestampstr):
     simulation_failures = compute_failures(nodes, edges, scenarios, current_solution, dvar_pos)
     if not timestampstr == False:
         # print simlation results as a file with timestampstr in the filename
-        current_failures = [[sce, edge_failed[0], edge_failed[1]] for sce in simulation_failures.keys() for edge_failed in simulation_failures[sce]['all_failed']]
-        sim_fail_filename = 'c:/temp/grid_cascade_output/simulation_failures/' + timestampstr + 'current_simulation_failures.csv'
-        with open(sim_fail_filename, 'wb') as csvfile:
-            simulation_fail_out = csv.writer(csvfile, delimiter = ',')
-            simulation_fail_out.writerow(['scenario', 'edge_1', 'edge_2'])
-            simulation_fail_out.writerows(current_failures)
+        results_store.extend('simulation_failures', [{'callback': timestampstr, 'scenario': sce, 'edge_1': edge_failed[0], 'edge_2': edge_failed[1]}
+                                                     for sce in simulation_failures.keys() for edge_failed in simulation_failures[sce]['all_failed']])
 
     # set the X variables
     X_established = [cur_pos for xkey, cur_pos in dvar_pos.iteritems() if xkey[0] == 'X_' and current_solution[dvar_pos[xkey]] > 0.999]
@@ -745,7 +955,7 @@ def build_cfe_constraints(current_solution, timestampstr):
         # the non failed edges are all the edges which are not in prev_failures
         # another condition is that the simulation that this is based on was not a "short run" (short run = only first cascade)
         if simulation_complete_run:
-            non_failed_edges = [cur_edge for cur_edge in all_edges if cur_edge not in failure_dict['all_failed']]
+            non_failed_edges = edge_index.edges(edge_index.initial_mask & ~failure_dict['all_failed_mask'])
             for curr_non_failed_edge in non_failed_edges: # <- convert later on to list comprehention
                 str_flag = "ok"
                 if current_solution[dvar_pos[('F', curr_non_failed_edge, cur_scenario)]] > 0.999:
@@ -799,6 +1009,7 @@ def write_sim_steps(filename, failed_edges, flow_per_stage):
 
 
 
+@profiled()
 def update_grid(G, failed_edges):
     """
     Function to update the existing graph by omitting failed_edges from it and re-computing demand and generation in each component.
@@ -851,7 +1062,8 @@ def update_grid(G, failed_edges):
         tot_generated = sum([G.node[i]['generated'] for i in component.node.keys()])
 
 
-def cfe(G, init_fail_edges, write_solution_file = False, simulation_complete_run = True, fails_per_scenario = []):
+@profiled('cascade_simulation')
+def cfe(G, init_fail_edges, write_solution_file = False, simulation_complete_run = True, fails_per_scenario = 0):
     """
     Simulates a cascade failure evolution (the CFE - algorithm 1 in paper)
     Input is an initial fail of edges (F),
@@ -868,6 +1080,7 @@ def cfe(G, init_fail_edges, write_solution_file = False, simulation_complete_run
 
     # initialize flow dictionary for high resolution of solution (output of flow at each step)
     tot_failed = [] + init_fail_edges # iniclude initial failures in all_failed
+    tot_failed_mask = edge_index.mask(init_fail_edges) # the same, as a bitset (see edge_bitset.py)
     # initialize flow
     #current_flow = compute_flow(G)
     # loop
@@ -886,22 +1099,24 @@ def cfe(G, init_fail_edges, write_solution_file = False, simulation_complete_run
         tmp_grid_flow_update = grid_flow_update(G, F[i], False, True, tmp_grid_flow_update['cplex_object'])
         F[i+1] =  tmp_grid_flow_update['failed_edges']
         tot_failed += F[i+1]
+        tot_failed_mask |= edge_index.mask(F[i+1])
         i += 1
         # update if a contradiction has been found, but only contradctions of the following type:
         # "did not fail in the current solution but should have failed according to the iterations so far"
         #print "fails_per_scenario =", fails_per_scenario
-        should_fail_contradictions = [sim_failed_edge for sim_failed_edge in tot_failed if sim_failed_edge not in fails_per_scenario]
-        #print "should_fail_contradictions =", should_fail_contradictions
-        if (should_fail_contradictions != []) and (not simulation_complete_run):
+        should_fail_contradictions = tot_failed_mask & ~fails_per_scenario
+        #print "should_fail_contradictions =", edge_index.edges(should_fail_contradictions)
+        if should_fail_contradictions and (not simulation_complete_run):
             contradiction_found = True
             #print"setting contradiction_found =", contradiction_found
 
     tmpG = G.copy()
     #print "returning tot_failed =", tot_failed
     # return computed values and exit function
-    return({'F': F, 't':i, 'all_failed': tot_failed, 'updated_grid_copy': tmpG})#, 'tot_supplied': tot_unsupplied})
+    return({'F': F, 't':i, 'all_failed': tot_failed, 'all_failed_mask': tot_failed_mask, 'updated_grid_copy': tmpG})#, 'tot_supplied': tot_unsupplied})
 
 
+@profiled('flow_update')
 def grid_flow_update(G, failed_edges = [], write_lp = False, return_cplex_object = False, previous_find_flow = None):
     """
     The following function modifies G after failure of edges in failed_edges,
@@ -921,7 +1136,7 @@ def grid_flow_update(G, failed_edges = [], write_lp = False, return_cplex_object
     if print_debug_function_tracking:
         print "Number of connected components in G = ", nx.number_connected_components(G)
     # Initialize cplex internal flow problem
-    find_flow = cplex.Cplex() # create cplex instance
+    find_flow = solver.Cplex() # create cplex instance
     find_flow.objective.set_sense(find_flow.objective.sense.minimize) # doesn't matter
 
     # Initialize decision variables (demand, supply, theta, and flow)
@@ -979,19 +1194,21 @@ def grid_flow_update(G, failed_edges = [], write_lp = False, return_cplex_object
 
     # Solve problem
     find_flow.set_problem_type(find_flow.problem_type.LP) # This is a regular linear problem, avoid code 1017 error.
-    find_flow.solve()
+    with span('flow_solve'):
+        find_flow.solve()
 
     # Check to make sure that an optimal solution has been reached or exit otherwise
     if find_flow.solution.get_status() != 1:
         find_flow.write('problem_infeasible.lp')
         print "I'm having difficulty with a flow problem - please check"
-        nx.write_gexf(G, "c:/temp/exported_grid_err.gexf")
-        sys.exit('Error: no optimal solution found while trying to solve flow problem. Writing into: problem_infeasible.lp and c:/temp/exported_grid_err.gexf')
+        nx.write_gexf(G, output_path("exported_grid_err.gexf"))
+        sys.exit('Error: no optimal solution found while trying to solve flow problem. Writing into: problem_infeasible.lp and ' + output_path("exported_grid_err.gexf"))
 
     find_flow_vars = find_flow.solution.get_values()
 
     # Set the failed edges
-    new_failed_edges = [edge for edge in sorted_edges(G.edges()) if abs(find_flow_vars[dvar_pos_flow[('f', edge)]]) > G.edges[edge[0],edge[1]]['capacity']]
+    with span('failure_detection'):
+        new_failed_edges = [edge for edge in sorted_edges(G.edges()) if abs(find_flow_vars[dvar_pos_flow[('f', edge)]]) > G.edges[edge[0],edge[1]]['capacity']]
 
     # just in case you want an lp file - for debugging purposes.
 
@@ -1031,6 +1248,7 @@ def sorted_edges(edges_list):
     return(sorted_edges_list)
 
 
+@profiled()
 def compute_failures(nodes, edges, scenarios, current_solution, dvar_pos):
     """
     Function builds grid based on original grid and infrastructure decisions from dvar_pos
@@ -1060,16 +1278,31 @@ def compute_failures(nodes, edges, scenarios, current_solution, dvar_pos):
         simulation_complete_run = True # the simulation is going to be complete
 
     # extract all failed edges per scenario
-    all_failures_per_scenario = {cur_scenario: [cur_edge for cur_edge in all_edges if current_solution[dvar_pos[('F', cur_edge, cur_scenario)]] > 0.99] for cur_scenario in scenario_list}
+    all_failures_per_scenario = {cur_scenario: edge_index.mask([cur_edge for cur_edge in all_edges if current_solution[dvar_pos[('F', cur_edge, cur_scenario)]] > 0.99]) for cur_scenario in scenario_list}
 
     cfe_time_start = clock() # measure time spent on cascade simulation
 
     # Run the CFE
-    cfe_dict_results = {cur_scenario: cfe(init_grid.copy(), initial_failures_to_cfe[cur_scenario], write_solution_file = False, simulation_complete_run = simulation_complete_run, fails_per_scenario = all_failures_per_scenario[cur_scenario]) for cur_scenario in scenario_list}
+    if dominance_index is not None and simulation_complete_run:
+        # scenarios determined by the cascade of another scenario are not simulated
+        num_simulated = dominance_index.num_simulated
+        cfe_dict_results = dominance_index.evaluate(scenario_list, lambda cur_scenario: cfe(init_grid.copy(), initial_failures_to_cfe[cur_scenario], write_solution_file = False, simulation_complete_run = True))
+        metrics.inc('simulations', dominance_index.num_simulated - num_simulated)
+    else:
+        cfe_dict_results = {cur_scenario: cfe(init_grid.copy(), initial_failures_to_cfe[cur_scenario], write_solution_file = False, simulation_complete_run = simulation_complete_run, fails_per_scenario = all_failures_per_scenario[cur_scenario]) for cur_scenario in scenario_list}
+        metrics.inc('simulations', len(scenario_list))
 
     # finish up time measurement
     cfe_time_total = clock() - cfe_time_start
     time_spent_cascade_sim += cfe_time_total
+    if not simulation_complete_run:
+        metrics.inc('partial_simulations', len(scenario_list))
+    for cur_scenario in scenario_list:
+        metrics.observe('cascade_depth', cfe_dict_results[cur_scenario]['t'])
+    if dominance_index is not None:
+        metrics.set('simulations_dominated', dominance_index.num_determined)
+        metrics.set('dominance_hit_rate', float(dominance_index.num_determined)/max(1, dominance_index.num_simulated + dominance_index.num_determined))
+    set_time_metrics()
 
     tmpGs = {cur_scenario: cfe_dict_results[cur_scenario]['updated_grid_copy'] for cur_scenario in scenario_list}
 
@@ -1079,16 +1312,15 @@ def compute_failures(nodes, edges, scenarios, current_solution, dvar_pos):
         best_incumbent = sum(sup_demand) # update best incumbent solution
         run_heuristic_callback = True
         incumbent_solution_from_lazy = {'current_solution': current_solution, 'simulation_results': cfe_dict_results}
+        metrics.inc('incumbents')
+        metrics.set('incumbent', best_incumbent)
+    metrics.set('last_solution', sum(sup_demand))
 
     # print the best incumbent for incumbent_display_frequency% cases (if tick is < display frequency).
     if random.random() <= incumbent_display_frequency:
         time_spent_total = clock()
         if append_solution_statistics:
-            with open(append_solution_statistics, 'ab') as f:
-                writer = csv.writer(f)
-                writer.writerow([line_upgrade_cost_coef_scale, line_establish_cost_coef_scale,
-                                 line_upgrade_capacity_coef_scale, line_establish_capacity_coef_scale,
-                                 set_decision_var_priorities, time_spent_total, time_spent_cascade_sim, best_incumbent])
+            write_solution_statistics(time_spent_total, time_spent_cascade_sim)
         print "Curr sol=", sum(sup_demand), "Incumb=", best_incumbent, "Time on sim=", round(time_spent_cascade_sim), "Tot time", round(time_spent_total), "(", round(time_spent_cascade_sim/time_spent_total*100), "%) on sim"
         print "   Node  Left     Objective  IInf  Best Integer    Cuts/Bound    ItCnt     Gap         Variable B NodeID Parent  Depth"
         # consider later on to add: write incumbent solution to file.
@@ -1096,6 +1328,53 @@ def compute_failures(nodes, edges, scenarios, current_solution, dvar_pos):
     return(cfe_dict_results)
 
 
+def set_time_metrics():
+    """
+    Update the metrics of the time split between the cascade simulations and the rest of the solver (branch and bound)
+    """
+    time_total = clock()
+    metrics.set('time_total', time_total)
+    metrics.set('time_cascade_sim', time_spent_cascade_sim)
+    metrics.set('time_branch_and_bound', time_total - time_spent_cascade_sim)
+    metrics.set('cascade_sim_time_share', time_spent_cascade_sim/time_total if time_total > 0 else 0.0)
+
+
+def init_benders_worker(worker_nodes, worker_edges, worker_scenarios, worker_dvar_pos, worker_edge_index, worker_dominance_index):
+    """
+    Initialize a worker process of the Bender's scenario subproblems with the instance and the master's positions
+    """
+    global nodes
+    global edges
+    global scenarios
+    global dvar_pos
+    global edge_index
+    global dominance_index
+    nodes = worker_nodes
+    edges = worker_edges
+    scenarios = worker_scenarios
+    dvar_pos = worker_dvar_pos
+    edge_index = worker_edge_index
+    dominance_index = worker_dominance_index
+
+
+def benders_subproblem(task):
+    """
+    Solve the Bender's subproblems of a chunk of scenarios: simulate the complete cascade of each scenario on the grid
+    of the master's design.
+    :param task: (master solution, list of scenarios)
+    :return: dictionary {scenario: supply}
+    """
+    current_solution, scenario_chunk = task
+    init_grid = build_nx_grid(nodes, edges, current_solution, dvar_pos)
+    simulate = lambda cur_scenario: cfe(init_grid.copy(), scenarios[('s', cur_scenario)], write_solution_file = False, simulation_complete_run = True)
+    if dominance_index is not None:
+        cfe_dict_results = dominance_index.evaluate(scenario_chunk, simulate)
+    else:
+        cfe_dict_results = {cur_scenario: simulate(cur_scenario) for cur_scenario in scenario_chunk}
+    return({cur_scenario: sum([result['updated_grid_copy'].node[cur_node]['demand'] for cur_node in result['updated_grid_copy'].nodes()]) for cur_scenario, result in cfe_dict_results.iteritems()})
+
+
+@profiled()
 def build_nx_grid(nodes, edges, current_solution, dvar_pos):
     """
     Create the initial grid as an networkx object.
@@ -1140,6 +1419,24 @@ def build_nx_grid(nodes, edges, current_solution, dvar_pos):
     return(G)
 
 
+@profiled()
+def build_base_nx_grid(nodes, edges):
+    """
+    Create the base grid as an networkx object: the original capacities, without upgrades and new edges.
+    """
+    G = nx.Graph() # initialize empty graph
+
+    node_list = [node[1] for node in nodes.keys() if node[0] == 'd']
+    G.add_nodes_from([(cur_node, {'demand': nodes[('d', cur_node)], 'gen_cap': nodes[('c', cur_node)], 'generated': 0, 'un_sup_cost': 0, 'gen_cost': 0, 'original_demand': nodes[('d', cur_node)]}) for cur_node in node_list])
+
+    # only the existing edges (new edges have 0 capacity until established)
+    edge_list = [(min(edge[1], edge[2]), max(edge[1], edge[2])) for edge in edges if edge[0] == 'c']
+    G.add_edges_from([(cur_edge[0], cur_edge[1], {'capacity': edges[('c',) + cur_edge], 'susceptance': edges[('x',) + cur_edge]})
+                      for cur_edge in edge_list if edges[('c',) + cur_edge] > 0])
+
+    return(G)
+
+
 # ****************************************************
 # *******Define the incumbent heuristic **************
 # ****************************************************
@@ -1154,29 +1451,14 @@ class IncumbentHeuristic(HeuristicCallback):
 
             # the failures/non-failures part:
             # extract all failed equivalent to keys of the dvar_pos
-            all_failed_keys = [('F', cur_edge, cur_scenario) for cur_scenario in incumbent_solution_from_lazy['simulation_results'].keys() for cur_edge in incumbent_solution_from_lazy['simulation_results'][cur_scenario]['all_failed']]
-            heuristic_solution_failures = [[pos, (name in all_failed_keys)*1] for name, pos in dvar_pos.iteritems() if name[0]=='F']
+            all_failed_masks = {cur_scenario: simulation_result['all_failed_mask'] for cur_scenario, simulation_result in incumbent_solution_from_lazy['simulation_results'].iteritems()}
+            heuristic_solution_failures = [[pos, edge_index.contains(all_failed_masks[name[2]], name[1])*1] for name, pos in dvar_pos.iteritems() if name[0]=='F']
             heuristic_sol_var_fail = [i[0] for i in heuristic_solution_failures]
             heuristic_sol_val_fail = [i[1] for i in heuristic_solution_failures]
 
-            # prep for insertion into the cplex
-            heuristic_vars = heuristic_solution_var_infra + heuristic_sol_var_fail
-            heuristic_vals = map(round, heuristic_solution_val_infra + heuristic_sol_val_fail)
-            heuristic_lin_expr = [[[cur_var], [1.0]] for cur_var in heuristic_vars]
-            N_preset = len(heuristic_vars)
-
-            # create a new problem, equivalent to the main problem:
-            sub_problem_heuristic = create_cplex_object()
-
-            # add constraints to preset infrastructure values:
-            sub_problem_heuristic.linear_constraints.add(lin_expr = heuristic_lin_expr, senses = "E"*N_preset, rhs = heuristic_vals)
-
-            # supress subproblem's output stream
-            sub_problem_heuristic.set_log_stream(None)
-            sub_problem_heuristic.set_results_stream(None)
-
-            # find sub problem's solution
-            sub_problem_heuristic.solve()
+            # find the flows of the infrastructure and failures (solve the problem with these values preset)
+            sub_problem_heuristic = solve_preset_problem(heuristic_solution_var_infra + heuristic_sol_var_fail,
+                                                         heuristic_solution_val_infra + heuristic_sol_val_fail)
 
             heuristic_solution_push = sub_problem_heuristic.solution.get_values()
             heuristic_solution_objective = sub_problem_heuristic.solution.get_objective_value()
@@ -1195,6 +1477,104 @@ class IncumbentHeuristic(HeuristicCallback):
 
 
 
+@profiled('heuristic_subsolve')
+def solve_preset_problem(preset_positions, preset_values):
+    """
+    Solve the problem with some of the variables preset (e.g., the infrastructure and failures of a known solution),
+    which leaves the flows, phase angles and unsupplied demand to be found.
+    :param preset_positions: positions of the preset variables
+    :param preset_values: their values (rounded, the preset variables are binary)
+    :return: the solved cplex object
+    """
+    preset_lin_expr = [[[cur_var], [1.0]] for cur_var in preset_positions]
+    N_preset = len(preset_positions)
+
+    # create a new problem, equivalent to the main problem:
+    sub_problem = create_cplex_object()
+
+    # add constraints to preset infrastructure values:
+    sub_problem.linear_constraints.add(lin_expr = preset_lin_expr, senses = "E"*N_preset, rhs = map(round, preset_values))
+
+    # supress subproblem's output stream
+    sub_problem.set_log_stream(None)
+    sub_problem.set_results_stream(None)
+
+    # find sub problem's solution
+    sub_problem.solve()
+    return(sub_problem)
+
+
+# ****************************************************
+# *************** MIP start from a given grid ********
+# ****************************************************
+def design_from_grid(power_grid):
+    """
+    Map a power grid (e.g., a heuristic solution) to the investment variables: an edge is established (X) if it does
+    not exist in the original grid, and upgraded (c) if its capacity exceeds the original (and established) capacity.
+    A node's generation capacity upgrade is c, and its backup is established (Z) if the upgrade is positive.
+    The upgrades are binary, so a capacity which is not exactly one upgrade step above the original is rounded.
+    :param power_grid: networkx grid with 'capacity' edge attributes and 'gen_cap' node attributes
+    :return: (dictionary {dvar_pos key: value}, number of edges whose capacity was rounded)
+    """
+    design = dict()
+    num_rounded = 0
+    for cur_edge in all_edges:
+        edge_data = power_grid.get_edge_data(cur_edge[0], cur_edge[1])
+        capacity = edge_data['capacity'] if edge_data is not None else 0
+        original_capacity = edges[('c',) + cur_edge]
+        if ('X_', cur_edge) in dvar_pos:
+            design[('X_', cur_edge)] = 1 if (capacity > epsilon and original_capacity <= 0) else 0
+            original_capacity += design[('X_', cur_edge)]*line_establish_capacity_coef_scale
+        design[('c', cur_edge)] = 1 if capacity - original_capacity > epsilon else 0
+        if abs(original_capacity + design[('c', cur_edge)]*line_upgrade_capacity_coef_scale - capacity) > epsilon and (edge_data is not None):
+            num_rounded += 1
+    grid_nodes = dict(power_grid.nodes(data = True))
+    for cur_node in all_nodes:
+        gen_cap = grid_nodes[cur_node]['gen_cap'] if cur_node in grid_nodes else nodes[('c', cur_node)]
+        design[('c', cur_node)] = min(max(gen_cap - nodes[('c', cur_node)], 0), nodes[('gen_up_ub', cur_node)])
+        design[('Z', cur_node)] = 1 if design[('c', cur_node)] > epsilon else 0
+    return design, num_rounded
+
+
+def add_mip_start(robust_opt, power_grid):
+    """
+    Add a MIP start from a given grid: its investment variables (see design_from_grid), the failures of its cascade
+    simulation in every scenario, and the flows of the problem with the investment and failures preset
+    (in Bender's decomposition, the supply estimate of every scenario instead of the failures and flows).
+    The best incumbent is initialized to the grid's supply, so that the heuristic callback only fires on better solutions.
+    :param robust_opt: the cplex object (after build_cplex_problem or build_benders_master)
+    :param power_grid: the grid, e.g., the gpickle exported by robustness_heuristic_upper_bound.py
+    """
+    global best_incumbent
+    design, num_rounded = design_from_grid(power_grid)
+    design_solution = [0]*len(dvar_pos)
+    for key, value in design.iteritems():
+        design_solution[dvar_pos[key]] = value
+    init_grid = build_nx_grid(nodes, edges, design_solution, dvar_pos)
+    scenario_list = [cur_sce[1] for cur_sce in scenarios.keys() if cur_sce[0] == 's_pr']
+    cfe_dict_results = {cur_scenario: cfe(init_grid.copy(), scenarios[('s', cur_scenario)], write_solution_file = False, simulation_complete_run = True) for cur_scenario in scenario_list}
+    supply = {cur_scenario: sum([result['updated_grid_copy'].node[cur_node]['demand'] for cur_node in all_nodes]) for cur_scenario, result in cfe_dict_results.iteritems()}
+    design_positions = [dvar_pos[key] for key in design.keys()]
+    design_values = [design[key] for key in design.keys()]
+
+    if args.use_benders:
+        start_positions = design_positions + [dvar_pos[('eta', cur_scenario)] for cur_scenario in scenario_list]
+        start_values = design_values + [supply[cur_scenario] for cur_scenario in scenario_list]
+    else:
+        failure_keys = [name for name in dvar_pos.keys() if name[0] == 'F']
+        failure_values = [edge_index.contains(cfe_dict_results[name[2]]['all_failed_mask'], name[1])*1 for name in failure_keys]
+        sub_problem = solve_preset_problem(design_positions + [dvar_pos[name] for name in failure_keys], design_values + failure_values)
+        if not sub_problem.solution.is_primal_feasible():
+            print "MIP start ignored: the grid is infeasible (e.g., exceeds the budget)."
+            return
+        start_values = sub_problem.solution.get_values()
+        start_positions = range(len(start_values))
+
+    robust_opt.MIP_starts.add(solver.SparsePair(ind = start_positions, val = start_values), robust_opt.MIP_starts.effort_level.check_feasibility, "mip_start")
+    best_incumbent = sum([scenarios[('s_pr', cur_scenario)]*supply[cur_scenario] for cur_scenario in scenario_list])
+    print "MIP start added from", args.mip_start, "- expected supply", best_incumbent, "(" + str(num_rounded), "edge capacities rounded to the binary upgrades)"
+
+
 # ****************************************************
 # *************** Run the program ********************
 # ****************************************************
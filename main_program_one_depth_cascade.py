@@ -29,18 +29,22 @@ import time # for placing timestamps: use functions time.gmtime, time.strftime,
 # ******* Parse from command line args ***********
 # ************************************************
 import argparse
+from instance_loader import load_instance, load_variant
+from edge_bitset import EdgeIndex
+from results_store import open_results_store, output_path, set_output_directory
 parser = argparse.ArgumentParser(description = "Run a Power Grid Robust Optimization of 1-cascade depth (PGRO1).")
 parser.add_argument('--instance_location', help = "Provide the location for instance files (directory name)", type = str, default = "instance30")
 parser.add_argument('--time_limit', help = "Set a time limit for CPLEX run (in hours)", type = float, default = 1)
 parser.add_argument('--opt_gap', help = "Optimality gap for CPLEX run", type = float, default = 0.01) # 0.01 = 1%
 parser.add_argument('--budget', help = "Budget constraint for optimization problem", type = float, default = 100.0)
-parser.add_argument('--print_lp', help = "Export c:/temp/grid_cascade_output/tmp_robust_1_cascade.lp", action = "store_true")
+parser.add_argument('--print_lp', help = "Export tmp_robust_1_cascade.lp into the output directory", action = "store_true")
 parser.add_argument('--print_debug_function_tracking', help = "Print a message upon entering each function", action = "store_true")
 parser.add_argument('--export_results_file', help = "Save the solution file with variable names", action = "store_true")
 parser.add_argument('--disable_cplex_messages', help = "Disables CPLEX's log, warning, error and results message streams", action = "store_true")
 parser.add_argument('--penalize_failures', help = "Attach penalization coefficient to first order cascade failures (specify value)", type = float, default = 0.0)
-parser.add_argument('--use_benders', help = "Use Bender's decomposition", action = "store_true")
-parser.add_argument('--scenario_variant', help = "*** NOT IMPLEMENTED YET *** Select a scenario variant for given instance, i.e. load scenario_failures_VARIANTNAME.csv and scenario_probabilities_VARIANTNAME.csv", type = str, default = "")
+parser.add_argument('--use_benders', help = "Use CPLEX's Bender's decomposition, with a subproblem per scenario", action = "store_true")
+parser.add_argument('--scenario_variant', help = "Select a scenario variant for given instance, i.e. load scenario_failures_VARIANTNAME.csv and scenario_probabilities_VARIANTNAME.csv. "
+                                                 "Several variants can be given, separated by commas, and are solved one after the other against the same grid (an empty name is the instance's own scenarios)", type = str, default = "")
 parser.add_argument('--load_capacity_factor', help = "The load capacity factor - "
                                                      "Change the existing capacity by this factor.",
                     type = float, default = 1.0)
@@ -53,8 +57,11 @@ parser.add_argument('--line_upgrade_cost_coef_scale', help = "Coefficient to add
 parser.add_argument('--line_establish_cost_coef_scale', help = "Coefficient for scaling cost for establishing a transmission line",
                     type = float, default = 1.0)
 parser.add_argument('--dump_file', help="Save the final objective outcome (number of run), "
-                                          "saved to c:/temp/grid_cascade_output/dump.csv",
+                                          "saved to the dump table of the results store",
                     type=float, default=0.0)
+parser.add_argument('--output_directory', help = "Directory of the output files and the results store "
+                                                "[default: the GRID_CASCADE_OUTPUT environment variable, or c:/temp/grid_cascade_output on windows]", type = str, default = "")
+parser.add_argument('--results_store', help = "The results store, a SQLite database [default: results.sqlite in the output directory]", type = str, default = "")
 
 
 # ... add additional arguments as required here ..
@@ -67,22 +74,49 @@ args = parser.parse_args()
 epsilon = 1e-3
 bigM = 10000
 instance_location = os.getcwd() + '\\' + args.instance_location + '\\'
+# results are written into the results store (see results_store.py), opened (and its run registered) by main_program()
+set_output_directory(args.output_directory)
+results_store = None
 
 # ****************************************************
 # ******* The main program ***************************
 # ****************************************************
 def main_program():
+    global results_store
+    results_store = open_results_store('main_program_one_depth_cascade.py', vars(args), args.results_store)
 
     # Read required data and declare as global for use across module
     global nodes
     global edges
-    global scenarios
     global params
-    global current_solution
 
-    nodes = read_nodes(instance_location + 'grid_nodes.csv')
-    edges = read_edges(instance_location + 'grid_edges.csv')
-    scenarios = read_scenarios(instance_location + 'scenario_failures.csv', instance_location + 'scenario_probabilities.csv')
+    instance = load_instance(instance_location)  # compiled once into a binary bundle, see instance_loader.py
+    nodes = instance.nodes()
+    edges = instance.edges(args.load_capacity_factor, args.line_establish_cost_coef_scale,
+                           args.line_upgrade_cost_coef_scale)
+    global edge_index # failed edge sets are bitsets over this index (see edge_bitset.py)
+    edge_index = EdgeIndex([(min(i[1],i[2]), max(i[1],i[2])) for i in edges.keys() if i[0] == 'c'])
+
+    # the grid is read once, and shared by all scenario variants. Results are keyed by the variant name
+    variant_results = dict()
+    for variant in [cur_variant.strip() for cur_variant in args.scenario_variant.split(',')]:
+        if args.scenario_variant:
+            print "Scenario variant:", (variant if variant else "(instance scenarios)")
+        variant_results[variant] = solve_scenario_variant(load_variant(instance, instance_location, variant), variant)
+    return(variant_results)
+
+
+def solve_scenario_variant(instance, variant):
+    """
+    Build and solve the problem for the scenarios of a variant, and export its results (keyed by the variant).
+    :param instance: the InstanceBundle of the variant (see instance_loader.load_variant)
+    :param variant: the variant name (empty for the instance's own scenarios)
+    :return: dictionary with the simulation results and the solution (None if no solution was found)
+    """
+    global scenarios
+    global current_solution
+    scenarios = instance.scenarios()
+    variant_key = ('_' + variant) if variant else ''
 
     # build problem
     build_results = build_cplex_problem()
@@ -90,7 +124,7 @@ def main_program():
     dvar_pos = build_results['cplex_location_dictionary'] # useful for debugging
 
     if args.print_lp:
-        robust_opt_cplex.write("c:/temp/grid_cascade_output/tmp_robust_1_cascade.lp")
+        robust_opt_cplex.write(output_path("tmp_robust_1_cascade" + variant_key + ".lp"))
 
     time_spent_total = time.clock() # initialize solving time
     robust_opt_cplex.parameters.mip.tolerances.mipgap.set(args.opt_gap) # set target optimality gap
@@ -107,17 +141,21 @@ def main_program():
         robust_opt_cplex.set_results_stream(None)
 
     # set Bender's decomposition, code adopted from benders.py example of cplex
+    # the continuous variables of each scenario (generation, supply, phase angles and flows) form a separate
+    # subproblem, so that CPLEX solves (and cuts) per scenario. The investment variables - including the continuous
+    # generation upgrades - and the (binary) failure indicators remain in the master.
     if args.use_benders:
         anno = robust_opt_cplex.long_annotations
         idx = anno.add(name=anno.benders_annotation, defval=anno.benders_mastervalue)
         ctypes = robust_opt_cplex.variables.get_types()
         objtype = anno.object_type.variable
         continuous = robust_opt_cplex.variables.type.continuous
+        scenario_subproblem = {cur_scenario: anno.benders_mastervalue + 1 + i for i, cur_scenario in enumerate(all_scenarios)}
         robust_opt_cplex.long_annotations.set_values(idx, objtype,
-                                        [(i, anno.benders_mastervalue+1)
+                                        [(i, scenario_subproblem[dvar_name[i].rsplit('_s', 1)[1]])
                                         for i, j
                                         in enumerate(ctypes)
-                                        if j == continuous])
+                                        if j == continuous and '_s' in dvar_name[i]])
 
     start_time = time.time()
     robust_opt_cplex.solve()  #solve the model
@@ -148,7 +186,7 @@ def main_program():
 
         # for comparison, compute the "real" loss of load using the cascade simulation and the infrastructure
         init_grid = build_nx_grid(nodes, edges, current_solution, dvar_pos)
-        cfe_dict_results = {cur_scenario: cfe(init_grid.copy(), scenarios[('s', cur_scenario)], write_solution_file = False, simulation_complete_run = True, fails_per_scenario = []) for cur_scenario in all_scenarios}
+        cfe_dict_results = {cur_scenario: cfe(init_grid.copy(), scenarios[('s', cur_scenario)], write_solution_file = False, simulation_complete_run = True, fails_per_scenario = 0) for cur_scenario in all_scenarios}
 
         print "\n\nComparison to cascade simulation:"
         print     "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
@@ -166,8 +204,8 @@ def main_program():
         if args.export_results_file:
             timestamp = time.strftime('%d-%m-%Y %H-%M-%S-', time.gmtime()) + str(round(time.clock(), 3)) + ' - '
             write_names_values(current_solution, current_var_names,
-                               'c:/temp/grid_cascade_output/' + timestamp + '-' + str(args.dump_file) + '-' + 'temp_sol.csv')
-            with open('c:/temp/grid_cascade_output/' + timestamp + 'supply.csv', 'wb') as csvfile:
+                               output_path(timestamp + '-' + str(args.dump_file) + variant_key + '-' + 'temp_sol.csv'))
+            with open(output_path(timestamp + 'supply' + variant_key + '.csv'), 'wb') as csvfile:
                 solutionwriter = csv.writer(csvfile, delimiter=',')
                 solutionwriter.writerow(['scenario', 'type', 'value'])
                 solutionwriter.writerows([[i, '1depth', tot_supply_sce[i]] for i in tot_supply_sce.keys()])
@@ -178,11 +216,8 @@ def main_program():
         print "*** Program completed ***"
         # objective in "total supplied average"
         objective_value_full_cascade = sum([tot_supply_sce_cascade[i] * scenarios[('s_pr', i)] for i in all_scenarios])
-        with open("c:/temp/grid_cascade_output/dump.csv", 'ab') as dump_file:
-            writer = csv.writer(dump_file)
-            writer.writerow([args.dump_file, objective_value_full_cascade, elapsed_time])
-        write_names_values(current_solution, current_var_names,
-                           'c:/temp/grid_cascade_output/detailed_results/' + str(args.dump_file) + '.csv')
+        results_store.append('dump', {'dump_file': args.dump_file, 'objective': objective_value_full_cascade, 'elapsed_time': elapsed_time, 'variant': variant})
+        results_store.extend('detailed_results', [{'dump_file': args.dump_file, 'variant': variant, 'name': current_var_names[i], 'value': current_solution[i]} for i in xrange(len(current_var_names))])
         return({'cfe_dict_results': cfe_dict_results, 'current_solution': current_solution})
     else:
         print "*** Program completed *** ERROR: No solution found."
@@ -192,50 +227,6 @@ def main_program():
 # ****************************************************
 # ********** Read files ******************************
 # ****************************************************
-def read_nodes(filename):
-    dic = dict()
-    with open(filename, 'rb') as nodesfile:
-        nodes_reader = csv.reader(nodesfile, delimiter = ',')
-        next(nodes_reader) # assuimng header, skip first line
-        for row in nodes_reader:
-            dic[('d', row[0])] = float(row[1]) # read demand
-            dic[('c', row[0])] = float(row[2]) # read capacity
-            dic[('gen_up_ub', row[0])] = float(row[3]) # max generation upgrade
-            dic[('H', row[0])] = float(row[4]) # fixed cost
-            dic[('h', row[0])] = float(row[5]) # variable cost
-    return dic
-
-def read_edges(filename):
-    dic = dict()
-    with open(filename, 'rb') as edgesfile:
-        csv_reader = csv.reader(edgesfile, delimiter = ',')
-        next(csv_reader) # assuimng header, skip first line
-        for row in csv_reader:
-            cur_edge = arrange_edge_minmax(row[0], row[1])
-            dic[('c',) + cur_edge] = float(row[2])*args.load_capacity_factor  # current capacity
-            dic[('x',) + cur_edge] = float(row[3]) # susceptance
-            dic[('H',) + cur_edge] = float(row[4])*args.line_establish_cost_coef_scale  # fixed cost
-            dic[('h',) + cur_edge] = float(row[5])*args.line_upgrade_cost_coef_scale  # variable cost
-    return dic
-
-def read_scenarios(filename_fail, filename_pr):
-    dic = dict()
-    with open(filename_pr, 'rb') as prfile:
-        csv_reader = csv.reader(prfile, delimiter = ',')
-        next(csv_reader) # assuming header, skip first line
-        for row in csv_reader:
-            dic[('s_pr', row[0])] = float(row[1])
-
-    with open(filename_fail, 'rb') as failurefile:
-        csv_reader = csv.reader(failurefile, delimiter = ',')
-        next(csv_reader) # assuming header, skip first line
-        for row in csv_reader:
-            if ('s', row[0]) in dic.keys():
-                dic[('s', row[0])] += [arrange_edge_minmax(row[1], row[2])] # failures
-            else:
-                dic[('s', row[0])] = [arrange_edge_minmax(row[1], row[2])] # first failure in this scenario
-    return dic
-
 def read_additional_param(filename):
     """
     Read additional parameters. Deprecated.
@@ -617,7 +608,7 @@ class MyLazy(LazyConstraintCallback):
         timestampstr = strftime('%d-%m-%Y %H-%M-%S-', gmtime()) + str(round(clock(), 3)) + ' - '
 
         if write_mid_run_res_files:
-            write_names_values(current_solution, dvar_name, 'c:/temp/grid_cascade_output/callback debug/' + timestampstr + 'current_callback_solution.csv')
+            write_names_values(current_solution, dvar_name, output_path('callback debug', timestampstr + 'current_callback_solution.csv'))
 
         if not print_cfe_results==False:
             print_cfe_results = timestampstr
@@ -656,12 +647,8 @@ def build_cfe_constraints(current_solution, timestampstr):
     simulation_failures = compute_failures(nodes, edges, scenarios, current_solution, dvar_pos)
     if not timestampstr == False:
         # print simlation results as a file with timestampstr in the filename
-        current_failures = [[sce, edge_failed[0], edge_failed[1]] for sce in simulation_failures.keys() for edge_failed in simulation_failures[sce]['all_failed']]
-        sim_fail_filename = 'c:/temp/grid_cascade_output/simulation_failures/' + timestampstr + 'current_simulation_failures.csv'
-        with open(sim_fail_filename, 'wb') as csvfile:
-            simulation_fail_out = csv.writer(csvfile, delimiter = ',')
-            simulation_fail_out.writerow(['scenario', 'edge_1', 'edge_2'])
-            simulation_fail_out.writerows(current_failures)
+        results_store.extend('simulation_failures', [{'callback': timestampstr, 'scenario': sce, 'edge_1': edge_failed[0], 'edge_2': edge_failed[1]}
+                                                     for sce in simulation_failures.keys() for edge_failed in simulation_failures[sce]['all_failed']])
 
     # set the X variables
     X_established = [cur_pos for xkey, cur_pos in dvar_pos.iteritems() if xkey[0] == 'X_' and current_solution[dvar_pos[xkey]] > 0.999]
@@ -702,7 +689,7 @@ def build_cfe_constraints(current_solution, timestampstr):
         # the non failed edges are all the edges which are not in prev_failures
         # another condition is that the simulation that this is based on was not a "short run" (short run = only first cascade)
         if simulation_complete_run:
-            non_failed_edges = [cur_edge for cur_edge in all_edges if cur_edge not in failure_dict['all_failed']]
+            non_failed_edges = edge_index.edges(edge_index.initial_mask & ~failure_dict['all_failed_mask'])
             for curr_non_failed_edge in non_failed_edges: # <- convert later on to list comprehention
                 str_flag = "ok"
                 if current_solution[dvar_pos[('F', curr_non_failed_edge, cur_scenario)]] > 0.999:
@@ -808,7 +795,7 @@ def update_grid(G, failed_edges):
         tot_generated = sum([G.node[i]['generated'] for i in component.node.keys()])
 
 
-def cfe(G, init_fail_edges, write_solution_file = False, simulation_complete_run = True, fails_per_scenario = []):
+def cfe(G, init_fail_edges, write_solution_file = False, simulation_complete_run = True, fails_per_scenario = 0):
     """
     Simulates a cascade failure evolution (the CFE - algorithm 1 in paper)
     Input is an initial fail of edges (F),
@@ -825,6 +812,7 @@ def cfe(G, init_fail_edges, write_solution_file = False, simulation_complete_run
 
     # initialize flow dictionary for high resolution of solution (output of flow at each step)
     tot_failed = [] + init_fail_edges # iniclude initial failures in all_failed
+    tot_failed_mask = edge_index.mask(init_fail_edges) # the same, as a bitset (see edge_bitset.py)
     # initialize flow
     #current_flow = compute_flow(G)
     # loop
@@ -843,20 +831,21 @@ def cfe(G, init_fail_edges, write_solution_file = False, simulation_complete_run
         tmp_grid_flow_update = grid_flow_update(G, F[i], False, True, tmp_grid_flow_update['cplex_object'])
         F[i+1] =  tmp_grid_flow_update['failed_edges']
         tot_failed += F[i+1]
+        tot_failed_mask |= edge_index.mask(F[i+1])
         i += 1
         # update if a contradiction has been found, but only contradctions of the following type:
         # "did not fail in the current solution but should have failed according to the iterations so far"
         #print "fails_per_scenario =", fails_per_scenario
-        should_fail_contradictions = [sim_failed_edge for sim_failed_edge in tot_failed if sim_failed_edge not in fails_per_scenario]
-        #print "should_fail_contradictions =", should_fail_contradictions
-        if (should_fail_contradictions != []) and (not simulation_complete_run):
+        should_fail_contradictions = tot_failed_mask & ~fails_per_scenario
+        #print "should_fail_contradictions =", edge_index.edges(should_fail_contradictions)
+        if should_fail_contradictions and (not simulation_complete_run):
             contradiction_found = True
             #print"setting contradiction_found =", contradiction_found
 
     tmpG = G.copy()
     #print "returning tot_failed =", tot_failed
     # return computed values and exit function
-    return({'F': F, 't':i, 'all_failed': tot_failed, 'updated_grid_copy': tmpG})#, 'tot_supplied': tot_unsupplied})
+    return({'F': F, 't':i, 'all_failed': tot_failed, 'all_failed_mask': tot_failed_mask, 'updated_grid_copy': tmpG})#, 'tot_supplied': tot_unsupplied})
 
 
 def grid_flow_update(G, failed_edges = [], write_lp = False, return_cplex_object = False, previous_find_flow = None):
@@ -942,8 +931,8 @@ def grid_flow_update(G, failed_edges = [], write_lp = False, return_cplex_object
     if find_flow.solution.get_status() != 1:
         find_flow.write('problem_infeasible.lp')
         print "I'm having difficulty with a flow problem - please check"
-        nx.write_gexf(G, "c:/temp/exported_grid_err.gexf")
-        sys.exit('Error: no optimal solution found while trying to solve flow problem. Writing into: problem_infeasible.lp and c:/temp/exported_grid_err.gexf')
+        nx.write_gexf(G, output_path("exported_grid_err.gexf"))
+        sys.exit('Error: no optimal solution found while trying to solve flow problem. Writing into: problem_infeasible.lp and ' + output_path("exported_grid_err.gexf"))
 
     find_flow_vars = find_flow.solution.get_values()
 
@@ -1017,7 +1006,7 @@ def compute_failures(nodes, edges, scenarios, current_solution, dvar_pos):
         simulation_complete_run = True # the simulation is going to be complete
 
     # extract all failed edges per scenario
-    all_failures_per_scenario = {cur_scenario: [cur_edge for cur_edge in all_edges if current_solution[dvar_pos[('F', cur_edge, cur_scenario)]] > 0.99] for cur_scenario in scenario_list}
+    all_failures_per_scenario = {cur_scenario: edge_index.mask([cur_edge for cur_edge in all_edges if current_solution[dvar_pos[('F', cur_edge, cur_scenario)]] > 0.99]) for cur_scenario in scenario_list}
 
     cfe_time_start = clock() # measure time spent on cascade simulation
 
@@ -1107,8 +1096,8 @@ class IncumbentHeuristic(HeuristicCallback):
 
             # the failures/non-failures part:
             # extract all failed equivalent to keys of the dvar_pos
-            all_failed_keys = [('F', cur_edge, cur_scenario) for cur_scenario in incumbent_solution_from_lazy['simulation_results'].keys() for cur_edge in incumbent_solution_from_lazy['simulation_results'][cur_scenario]['all_failed']]
-            heuristic_solution_failures = [[pos, (name in all_failed_keys)*1] for name, pos in dvar_pos.iteritems() if name[0]=='F']
+            all_failed_masks = {cur_scenario: simulation_result['all_failed_mask'] for cur_scenario, simulation_result in incumbent_solution_from_lazy['simulation_results'].iteritems()}
+            heuristic_solution_failures = [[pos, edge_index.contains(all_failed_masks[name[2]], name[1])*1] for name, pos in dvar_pos.iteritems() if name[0]=='F']
             heuristic_sol_var_fail = [i[0] for i in heuristic_solution_failures]
             heuristic_sol_val_fail = [i[1] for i in heuristic_solution_failures]
 
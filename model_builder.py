@@ -0,0 +1,272 @@
+# ------------------------------------------------------------------------------
+# Name:        Model builder
+# Purpose:     A solver free backend of the model building code of main_program.py: Cplex, SparsePair and
+#              the callbacks, with the subset of the cplex API used to build the problems, which records the
+#              model as matrices instead of passing it to CPLEX. The programs select it explicitly (--flow_backend
+#              matrix, see select_solver - it is also their fallback, with a warning, when CPLEX is not installed),
+#              e.g., benchmark_model.py measures the model (rows, columns, non zeros) and its building time on
+#              machines without CPLEX.
+#              The recorded model is emitted as matrices (to_matrices, or write - a .npz file): the constraint
+#              matrix in compressed sparse row form, and the objective, bounds, types, senses and right hand sides.
+#              Only systems of linear equations over free variables are solved (by least squares) - this covers
+#              the dc flow problems of the cascade simulation (grid_flow_update), so the lazy callback runs end
+#              to end. Problems with inequalities, bounds or integer variables require CPLEX.
+#              MockCallback replaces the cplex callbacks: it is constructed with the candidate solution, and
+#              records the constraints added by the callback.
+# ------------------------------------------------------------------------------
+
+import sys
+import numpy
+
+FREE_BOUND = 1e20  # bounds of this magnitude (or more) are infinite, as in cplex
+
+
+class SparsePair(object):
+    def __init__(self, ind=None, val=None):
+        self.ind = list(ind) if ind is not None else []
+        self.val = list(val) if val is not None else []
+
+
+def sparse_pair(expression):
+    """
+    :param expression: a SparsePair, or a pair of lists [positions, coefficients]
+    :return: (positions, coefficients)
+    """
+    if isinstance(expression, SparsePair):
+        return expression.ind, expression.val
+    return list(expression[0]), list(expression[1])
+
+
+class ObjectiveSense(object):
+    minimize = 1
+    maximize = -1
+
+
+class BranchDirection(object):
+    default = 0
+    down = -1
+    up = 1
+
+
+class ProblemType(object):
+    LP = 0
+    MILP = 1
+
+
+class Objective(object):
+    sense = ObjectiveSense
+
+    def __init__(self):
+        self.direction = ObjectiveSense.minimize
+
+    def set_sense(self, sense):
+        self.direction = sense
+
+
+class Variables(object):
+    def __init__(self):
+        self.obj = []
+        self.lb = []
+        self.ub = []
+        self.types = []
+        self.names = []
+
+    def add(self, obj=None, lb=None, ub=None, types='', names=None):
+        """
+        :return: the positions of the added variables
+        """
+        count = max([len(values) for values in [obj or [], lb or [], ub or [], types or '', names or []]])
+        start = len(self.obj)
+        self.obj += list(obj) if obj else [0.0]*count
+        self.lb += list(lb) if lb else [0.0]*count
+        self.ub += list(ub) if ub else [FREE_BOUND]*count
+        self.types += list(types) if types else ['C']*count
+        self.names += list(names) if names else ['x' + str(i) for i in range(start, start + count)]
+        return range(start, start + count)
+
+    def get_num(self):
+        return len(self.obj)
+
+    def get_names(self):
+        return list(self.names)
+
+
+class LinearConstraints(object):
+    def __init__(self):
+        self.positions = []
+        self.coefficients = []
+        self.senses = []
+        self.rhs = []
+
+    def add(self, lin_expr=None, senses='', rhs=None, names=None):
+        """
+        :return: the positions of the added constraints
+        """
+        start = len(self.rhs)
+        for expression in lin_expr or []:
+            positions, coefficients = sparse_pair(expression)
+            self.positions.append(positions)
+            self.coefficients.append(coefficients)
+        count = len(self.positions) - start
+        self.senses += list(senses) if senses else ['E']*count
+        self.rhs += list(rhs) if rhs else [0.0]*count
+        return range(start, start + count)
+
+    def get_num(self):
+        return len(self.rhs)
+
+    def get_num_nonzeros(self):
+        return sum([len(positions) for positions in self.positions])
+
+
+class Order(object):
+    branch_direction = BranchDirection
+
+    def __init__(self):
+        self.priorities = []
+
+    def set(self, priorities):
+        """
+        :param priorities: list of (variable, priority, direction)
+        """
+        self.priorities = list(priorities)
+
+
+class Solution(object):
+    status = {1: 'optimal', 3: 'infeasible'}
+
+    def __init__(self):
+        self.status_code = None
+        self.values = []
+
+    def get_status(self):
+        return self.status_code
+
+    def get_values(self):
+        return list(self.values)
+
+    def is_primal_feasible(self):
+        return self.status_code == 1
+
+
+class Cplex(object):
+    """
+    Records a model built through the cplex API. Usage: model = Cplex(); model.variables.add(...);
+    model.linear_constraints.add(...); model.to_matrices()
+    """
+    problem_type = ProblemType
+
+    def __init__(self):
+        self.objective = Objective()
+        self.variables = Variables()
+        self.linear_constraints = LinearConstraints()
+        self.order = Order()
+        self.solution = Solution()
+        self.type = None
+
+    def set_log_stream(self, stream):
+        pass
+
+    def set_error_stream(self, stream):
+        pass
+
+    def set_warning_stream(self, stream):
+        pass
+
+    def set_results_stream(self, stream):
+        pass
+
+    def set_problem_type(self, problem_type):
+        self.type = problem_type
+
+    def num_nonzeros(self):
+        return self.linear_constraints.get_num_nonzeros()
+
+    def to_matrices(self):
+        """
+        :return: dictionary of numpy arrays: the constraint matrix in csr form (indptr, indices, data), and the
+                 objective (obj, sense), bounds (lb, ub), types, senses and rhs
+        """
+        constraints = self.linear_constraints
+        return {'indptr': numpy.cumsum([0] + [len(positions) for positions in constraints.positions]),
+                'indices': numpy.array([cur_pos for positions in constraints.positions for cur_pos in positions],
+                                       dtype=numpy.int64),
+                'data': numpy.array([cur_coef for coefficients in constraints.coefficients
+                                     for cur_coef in coefficients], dtype=numpy.float64),
+                'senses': numpy.array(constraints.senses), 'rhs': numpy.array(constraints.rhs, dtype=numpy.float64),
+                'obj': numpy.array(self.variables.obj, dtype=numpy.float64),
+                'sense': numpy.array(self.objective.direction),
+                'lb': numpy.array(self.variables.lb, dtype=numpy.float64),
+                'ub': numpy.array(self.variables.ub, dtype=numpy.float64),
+                'types': numpy.array(self.variables.types)}
+
+    def write(self, filename):
+        """
+        Write the model's matrices (see to_matrices) as a .npz file.
+        """
+        with open(filename, 'wb') as model_file:
+            numpy.savez(model_file, **self.to_matrices())
+
+    def solve(self):
+        """
+        Solve a system of linear equations over free continuous variables (e.g., a dc flow problem), by least squares.
+        The status is 1 (optimal) if the system is consistent, otherwise 3 (infeasible).
+        """
+        variables = self.variables
+        if any([sense != 'E' for sense in self.linear_constraints.senses]) or \
+                any([var_type != 'C' for var_type in variables.types]) or \
+                any([abs(bound) < FREE_BOUND for bound in variables.lb + variables.ub]):
+            raise NotImplementedError("Without CPLEX, only systems of linear equations over free variables are solved")
+        matrix = numpy.zeros((self.linear_constraints.get_num(), variables.get_num()))
+        for row, (positions, coefficients) in enumerate(zip(self.linear_constraints.positions,
+                                                            self.linear_constraints.coefficients)):
+            for cur_pos, cur_coef in zip(positions, coefficients):
+                matrix[row, cur_pos] += cur_coef
+        rhs = numpy.array(self.linear_constraints.rhs, dtype=numpy.float64)
+        if matrix.size:
+            values = numpy.linalg.lstsq(matrix, rhs, rcond=-1)[0]
+        else:
+            values = numpy.zeros(variables.get_num())
+        residual = numpy.abs(matrix.dot(values) - rhs).max() if len(rhs) else 0.0
+        scale = 1 + (numpy.abs(rhs).max() if len(rhs) else 0.0)
+        self.solution.status_code = 1 if residual <= 1e-6*scale else 3
+        self.solution.values = values.tolist()
+
+
+class MockCallback(object):
+    """
+    Stand-in of the cplex callbacks (LazyConstraintCallback, HeuristicCallback): constructed with the candidate
+    solution (returned by get_values), and records the added constraints and the set solution.
+    Usage: callback = MyLazy(candidate_values); callback(); callback.added
+    """
+
+    def __init__(self, values=None):
+        self.values = list(values) if values is not None else []
+        self.added = []  # list of (constraint, sense, rhs)
+        self.solution = None
+
+    def get_values(self):
+        return list(self.values)
+
+    def add(self, constraint, sense, rhs):
+        self.added.append((constraint, sense, rhs))
+
+    def set_solution(self, solution, objective_value=None):
+        self.solution = (solution, objective_value)
+
+
+def select_solver(backend, cplex_module):
+    """
+    Select the module which builds (and solves) the problems of a program (its --flow_backend option).
+    :param backend: cplex to use CPLEX, or matrix to use this module
+    :param cplex_module: the cplex module, None if CPLEX is not installed
+    :return: the selected module. When cplex is selected but not installed, this module - with a warning, as only
+             the flow problems of the cascade simulation can be solved by it
+    """
+    if backend == 'cplex' and cplex_module is not None:
+        return cplex_module
+    if backend == 'cplex':
+        sys.stderr.write("WARNING: CPLEX is not installed, the problems are built by the model builder instead "
+                         "(model_builder.py): flow problems are solved by least squares, and the problem of "
+                         "main_program.py can only be built. Use --flow_backend matrix to select it explicitly.\n")
+    return sys.modules[__name__]
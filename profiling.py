@@ -0,0 +1,146 @@
+# ------------------------------------------------------------------------------
+# Name:        Profiling
+# Purpose:     Named timing spans across the simulation pipeline (building the grid, updating it after
+#              failures, solving the flow, detecting the failures, building and adding cuts, heuristic
+#              sub-solves, ...), to see where each instance actually spends its time.
+#              A span is timed by `with span('flow_solve'):` or by decorating a function with
+#              @profiled('build_nx_grid'). Spans nest: the time of a span is aggregated per call path
+#              (e.g., compute_failures;cascade_simulation;flow_update;flow_solve), and its self time excludes
+#              the spans nested in it. Profiling is off unless enabled (--profile), and a disabled span costs
+#              a single check.
+#              The aggregate of a run is reported per span name (report), and can be written as folded stacks
+#              (write_folded), the input of flamegraph.pl and speedscope.
+# ------------------------------------------------------------------------------
+
+import functools
+import threading
+from timeit import default_timer
+
+REPORT_COLUMNS = ['span', 'calls', 'total_time', 'self_time', 'mean_time', 'share']
+
+enabled = False
+open_spans = threading.local()  # the stack of open spans of each thread (e.g., of the solver's callback threads)
+totals = dict()  # call path (tuple of span names) -> [calls, total time, time of the nested spans]
+totals_lock = threading.Lock()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    with totals_lock:
+        totals.clear()
+
+
+def span_stack():
+    if not hasattr(open_spans, 'stack'):
+        open_spans.stack = []
+    return open_spans.stack
+
+
+class Span(object):
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            span_stack().append(self.name)
+            self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is None:
+            return False
+        elapsed = default_timer() - self.start
+        stack = span_stack()
+        path = tuple(stack)
+        stack.pop()
+        with totals_lock:
+            record = totals.setdefault(path, [0, 0.0, 0.0])
+            record[0] += 1
+            record[1] += elapsed
+            if len(path) > 1:
+                totals.setdefault(path[:-1], [0, 0.0, 0.0])[2] += elapsed
+        return False
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_span = NullSpan()
+
+
+def span(name):
+    """
+    :return: a context manager timing its block as the span name (nested in the open spans)
+    """
+    return Span(name) if enabled else null_span
+
+
+def profiled(name=None):
+    """
+    Decorator timing every call of a function as a span (named after the function by default).
+    """
+    def decorator(function):
+        span_name = name if name is not None else function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report():
+    """
+    :return: rows of REPORT_COLUMNS, a row per span name (aggregated over its call paths), by decreasing total time.
+             share is the span's share of the total time of the outermost spans
+    """
+    with totals_lock:
+        items = [(path, list(record)) for path, record in totals.items()]
+    by_name = dict()
+    for path, (calls, total_time, nested_time) in items:
+        aggregate = by_name.setdefault(path[-1], [0, 0.0, 0.0])
+        aggregate[0] += calls
+        aggregate[2] += total_time - nested_time
+        if path[-1] not in path[:-1]:  # the time of a recursive span is counted once, by its outermost call
+            aggregate[1] += total_time
+    profiled_time = sum([record[1] for path, record in items if len(path) == 1])
+    rows = [[name, calls, total_time, self_time, total_time / calls if calls else 0.0,
+             total_time / profiled_time if profiled_time > 0 else 0.0]
+            for name, (calls, total_time, self_time) in by_name.items()]
+    return sorted(rows, key=lambda row: -row[2])
+
+
+def write_folded(filename):
+    """
+    Write the self time (in microseconds) of every call path as folded stacks ("a;b;c 1234" per line), for
+    flamegraph.pl or speedscope.
+    """
+    with totals_lock:
+        items = sorted([(path, list(record)) for path, record in totals.items()])
+    with open(filename, 'w') as folded_file:
+        for path, (calls, total_time, nested_time) in items:
+            self_time = int(round((total_time - nested_time) * 1e6))
+            if self_time > 0:
+                folded_file.write(';'.join(path) + ' ' + str(self_time) + '\n')
+
+
+def print_report(limit=15):
+    print('Profile (seconds):')
+    print('   ' + '  '.join(['%-24s' % REPORT_COLUMNS[0]] + ['%12s' % column for column in REPORT_COLUMNS[1:]]))
+    for row in report()[:limit]:
+        print('   ' + '  '.join(['%-24s' % row[0], '%12d' % row[1]] + ['%12.4f' % value for value in row[2:]]))
@@ -0,0 +1,180 @@
+# ------------------------------------------------------------------------------
+# Name:        Results store
+# Purpose:     A single store for the results of all runs, instead of csv files scattered under
+#              c:/temp/grid_cascade_output (dump.csv, detailed_results/*.csv, *_solution_statistics.csv,
+#              simulation_failures/*.csv, ...).
+#              The store is a SQLite database (results.sqlite in the output directory). Every run is registered
+#              in the runs table (run_id, program, start time, arguments), and every row of the other tables
+#              carries its run_id. Tables and columns are created when first written. Rows are buffered in
+#              memory and written in batches (a transaction per flush): every 1000 rows or 10 seconds, on exit,
+#              and when the run is terminated (SIGTERM, e.g., by the batch runner's time limit, or SIGINT).
+#              The output directory is portable: --output_directory, the GRID_CASCADE_OUTPUT environment
+#              variable, or c:/temp/grid_cascade_output on windows (the system's temporary directory elsewhere).
+#              Reading a table in R: read_results_table("dump"), see analysis/results_store.R
+# ------------------------------------------------------------------------------
+
+import json
+import numbers
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import exit_handlers
+
+RESULTS_FILENAME = 'results.sqlite'
+
+output_directory_setting = ''  # set by set_output_directory (--output_directory)
+open_stores = []  # the stores opened by open_results_store, see close_all
+
+
+def set_output_directory(directory):
+    global output_directory_setting
+    output_directory_setting = directory
+
+
+def output_directory():
+    """
+    :return: the output directory: --output_directory, the GRID_CASCADE_OUTPUT environment variable, or the default
+    """
+    if output_directory_setting:
+        return output_directory_setting
+    if os.environ.get('GRID_CASCADE_OUTPUT'):
+        return os.environ['GRID_CASCADE_OUTPUT']
+    if os.name == 'nt':
+        return 'c:/temp/grid_cascade_output'
+    return os.path.join(tempfile.gettempdir(), 'grid_cascade_output')
+
+
+def output_path(*parts):
+    """
+    :return: a path under the output directory (its parent directory is created if missing)
+    """
+    path = os.path.join(output_directory(), *parts)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
+
+def column_type(value):
+    if isinstance(value, numbers.Integral):
+        return 'INTEGER'
+    if isinstance(value, numbers.Real):
+        return 'REAL'
+    return 'TEXT'
+
+
+def column_value(value):
+    if value is None:
+        return None
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    return str(value)
+
+
+class ResultsStore(object):
+    """
+    Buffered writer of result rows (dictionaries {column: value}) into tables of a SQLite database. Only the process
+    which opened the store writes it: processes forked from it (e.g., the parallel tempering and Benders pools)
+    inherit its buffer and connection, and their flush and close do nothing.
+    Usage: store = ResultsStore(filename, 'main_program.py', vars(args)); store.append('dump', {...}); store.close()
+    """
+
+    def __init__(self, filename, program, arguments, buffer_size=1000, flush_interval=10.0):
+        """
+        :param filename: the SQLite database (created if missing)
+        :param program: name of the program creating the run
+        :param arguments: dictionary of the run's arguments
+        :param buffer_size: number of buffered rows which triggers a flush
+        :param flush_interval: seconds since the last flush after which an appended row triggers a flush
+        """
+        self.filename = filename
+        self.pid = os.getpid()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        self.buffer = []  # list of (table, row)
+        self.columns = dict()  # table -> set of its columns
+        self.run_id = time.strftime('%Y%m%d-%H%M%S-', time.gmtime()) + str(os.getpid()) + '-' + \
+            str(random.SystemRandom().randint(0, 10**6 - 1)).zfill(6)
+        self.connection = sqlite3.connect(filename, timeout=60)  # several runs may share the store
+        self.append('runs', {'program': program, 'start_time': time.time(),
+                             'arguments': json.dumps(arguments, sort_keys=True, default=str)})
+        self.flush()
+
+    def append(self, table, row):
+        """
+        :param table: the table name
+        :param row: dictionary {column: value} (the run_id column is added)
+        """
+        self.buffer.append((table, row))
+        if len(self.buffer) >= self.buffer_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def extend(self, table, rows):
+        for row in rows:
+            self.append(table, row)
+
+    def flush(self):
+        """
+        Write the buffered rows, in a single transaction.
+        """
+        self.last_flush = time.time()
+        if not self.buffer or os.getpid() != self.pid:
+            return  # a sqlite connection can not be used across a fork, and the rows are the parent's
+        buffered, self.buffer = self.buffer, []
+        with self.connection:
+            for table, row in buffered:
+                self.prepare_table(table, row)
+                columns = ['run_id'] + sorted(row.keys())
+                self.connection.execute('INSERT INTO "' + table + '" (' + ', '.join(['"' + column + '"' for column in columns]) +
+                                        ') VALUES (' + ', '.join(['?']*len(columns)) + ')',
+                                        [self.run_id] + [column_value(row[column]) for column in columns[1:]])
+
+    def prepare_table(self, table, row):
+        """
+        Create the table, and add missing columns, for a row.
+        """
+        if table not in self.columns:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS "' + table + '" (run_id TEXT NOT NULL)')
+            self.columns[table] = set([info[1] for info in self.connection.execute('PRAGMA table_info("' + table + '")')])
+        for column in sorted(set(row.keys()) - self.columns[table]):
+            try:
+                self.connection.execute('ALTER TABLE "' + table + '" ADD COLUMN "' + column + '" ' +
+                                        column_type(row[column]))
+            except sqlite3.OperationalError:
+                pass  # the column was added meanwhile by another run sharing the store
+            self.columns[table].add(column)
+
+    def close(self):
+        if self.connection is not None and os.getpid() == self.pid:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+
+def open_results_store(program, arguments, filename=''):
+    """
+    Open the store of a run (flushed and closed on exit, SIGTERM and SIGINT).
+    :param program: name of the program creating the run
+    :param arguments: dictionary of the run's arguments
+    :param filename: the SQLite database [default results.sqlite in the output directory]
+    :return: a ResultsStore
+    """
+    store = ResultsStore(filename if filename else output_path(RESULTS_FILENAME), program, arguments)
+    open_stores.append(store)
+    exit_handlers.install_signal_handlers()
+    return store
+
+
+def close_all():
+    """
+    Flush and close all the stores opened by open_results_store.
+    """
+    while open_stores:
+        open_stores.pop().close()
+
+
+exit_handlers.register(close_all)
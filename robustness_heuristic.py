@@ -23,6 +23,8 @@ import time
 import collections
 import random
 import numpy
+from instance_loader import load_instance
+from results_store import output_path, set_output_directory
 
 
 # ************************************************
@@ -37,12 +39,12 @@ parser.add_argument('--time_limit', help="Set a time limit (stopping criteria),
 parser.add_argument('--budget', help="Budget constraint for optimization problem [default 100]",
                     type=float, default=100.0)
 parser.add_argument('--export_results_tracking', help="Location of solution output file "
-                                                      "(default c:/temp/grid_cascade_output/heuristic_results.csv)"
+                                                      "(default heuristic_results.csv in the output directory)"
                                                       "To suppress set as False",
-                    type=str, default="c:/temp/grid_cascade_output/heuristic_results.csv")
+                    type=str, default="")
 parser.add_argument('--export_final_grid', help="Location to which the final power grid will be saved, as a gpickle"
-                                                "(default c:/temp/grid_cascade_output/"
-                                                "YYYY-MM-DD-hh-mm_heuristic_sol_*instance*.gpickle"
+                                                "(default the output directory's "
+                                                "YYYY-MM-DD-hh-mm_heuristic_sol_*instance*.gpickle)"
                                                 "Set as False to skip saving",
                     type=str, default="timestamped")
 parser.add_argument('--opt_gap', help="Gap from full demand [default 0.01=1%%]",
@@ -77,6 +79,10 @@ parser.add_argument('--overall_improvement_ratio_threshold',
                          "were searched, then a search criteria is met, and the search is stopped."
                          "The overall improvement ratio threshold's default [default 0.01 = 1%%]",
                     type=float, default=0.01)
+parser.add_argument('--output_directory', help="Directory of the output files [default: the "
+                                               "GRID_CASCADE_OUTPUT environment variable, or "
+                                               "c:/temp/grid_cascade_output on windows]",
+                    type=str, default="")
 
 # ... add additional arguments as required here ..
 args = parser.parse_args()
@@ -92,6 +98,9 @@ global full_destruct_probability  # the probability for full destruction of an e
 full_destruct_probability = args.full_destruct_probability
 global upgrade_selection_bias
 upgrade_selection_bias = args.upgrade_selection_bias
+set_output_directory(args.output_directory)
+if not args.export_results_tracking:
+    args.export_results_tracking = output_path('heuristic_results.csv')
 
 
 # ****************************************************
@@ -119,11 +128,11 @@ def main_program():
     # get the start time
     start_time = time.time()
     current_time = time.time()
-    nodes = read_nodes(instance_location + 'grid_nodes.csv')
-    edges = read_edges(instance_location + 'grid_edges.csv')
+    instance = load_instance(instance_location)  # compiled once into a binary bundle, see instance_loader.py
+    nodes = instance.nodes()
+    edges = instance.edges()
 
-    scenarios = read_scenarios(instance_location + 'scenario_failures.csv',
-                               instance_location + 'scenario_probabilities.csv')
+    scenarios = instance.scenarios()
 
     # compute the total demand in the grid
     total_demand = sum([nodes[node_key] for node_key in nodes.keys() if node_key[0] == 'd'])
@@ -236,10 +245,11 @@ def main_program():
     if args.export_final_grid != "False":
         if args.export_final_grid == "timestamped" and 'last_optimal_sol_time' in locals():
             time_stamp = time.gmtime(last_optimal_sol_time)
-            filename = "c:/temp/grid_cascade_output/" + str(time_stamp[0]) + '-' + str(time_stamp[1]).zfill(2) + \
-                       '-' + str(time_stamp[2]).zfill(2) + '-' + str(time_stamp[3]).zfill(2) + '-' + \
-                       str(time_stamp[4]).zfill(2) + '-' + \
-                       str(time_stamp[5]).zfill(2) + ' - ' + args.instance_location + 'heuristic_sol.gpickle'
+            filename = output_path(str(time_stamp[0]) + '-' + str(time_stamp[1]).zfill(2) + \
+                                   '-' + str(time_stamp[2]).zfill(2) + '-' + str(time_stamp[3]).zfill(2) + '-' + \
+                                   str(time_stamp[4]).zfill(2) + '-' + \
+                                   str(time_stamp[5]).zfill(2) + ' - ' + args.instance_location + \
+                                   'heuristic_sol.gpickle')
         else:
             filename = args.export_final_grid
         nx.write_gpickle(current_grid, filename)
@@ -345,53 +355,6 @@ def downgrade(power_grid, original_edges, left_budget):
 # ****************************************************
 # ******* Reading and writing files ******************
 # ****************************************************
-def read_nodes(filename):
-    dic = dict()
-    with open(filename, 'rb') as nodes_file:
-        nodes_reader = csv.reader(nodes_file, delimiter=',')
-        next(nodes_reader)  # assuming header, skip first line
-        for row in nodes_reader:
-            dic[('d', row[0])] = float(row[1])  # read demand
-            dic[('c', row[0])] = float(row[2])  # read capacity
-            dic[('gen_up_ub', row[0])] = float(row[3])  # max generation upgrade
-            dic[('H', row[0])] = float(row[4])  # fixed cost
-            dic[('h', row[0])] = float(row[5])  # variable cost
-    return dic
-
-
-def read_edges(filename):
-    dic = dict()
-    with open(filename, 'rb') as edges_file:
-        csv_reader = csv.reader(edges_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            cur_edge = arrange_edge_minmax(row[0], row[1])
-            dic[('c',) + cur_edge] = float(row[2])  # current capacity
-            dic[('x',) + cur_edge] = float(row[3])  # reactance
-            dic[('H',) + cur_edge] = float(row[4])  # fixed cost
-            dic[('h',) + cur_edge] = float(row[5])  # variable cost
-    return dic
-
-
-def read_scenarios(filename_fail, filename_pr):
-    dic = dict()
-    with open(filename_pr, 'rb') as pr_file:
-        csv_reader = csv.reader(pr_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            dic[('s_pr', row[0])] = float(row[1])
-
-    with open(filename_fail, 'rb') as failure_file:
-        csv_reader = csv.reader(failure_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            if ('s', row[0]) in dic.keys():
-                dic[('s', row[0])] += [arrange_edge_minmax(row[1], row[2])]  # failures
-            else:
-                dic[('s', row[0])] = [arrange_edge_minmax(row[1], row[2])]  # first failure in this scenario
-    return dic
-
-
 def arrange_edge_minmax(edge_i, edge_j=None):
     if edge_j is None:
         # case edge_i contains a tuple
@@ -407,8 +370,8 @@ def arrange_edge_minmax(edge_i, edge_j=None):
 def create_power_grid(nodes, edges):
     """
     Build a power grid as a networkx object with customized keys
-    :param nodes: a dictionary of nodes, as read and output by read_nodes() function
-    :param edges: a dictionary of edges, as read and output by read_edges() function
+    :param nodes: a dictionary of nodes, as output by InstanceBundle.nodes()
+    :param edges: a dictionary of edges, as output by InstanceBundle.edges()
     :return: grid an nx.Graph() object with the proper nodes and edges.
     """
 
@@ -535,9 +498,9 @@ def grid_flow_update(power_grid, failed_edges=[], write_lp=False, return_cplex_o
     if find_flow.solution.get_status() != 1:
         find_flow.write('problem_infeasible.lp')
         print "I'm having difficulty with a flow problem - please check"
-        nx.write_gexf(power_grid, "c:/temp/exported_grid_err.gexf")
+        nx.write_gexf(power_grid, output_path("exported_grid_err.gexf"))
         sys.exit('Error: no optimal solution found while trying to solve flow problem. Writing into: '
-                 'problem_infeasible.lp and c:/temp/exported_grid_err.gexf')
+                 'problem_infeasible.lp and ' + output_path("exported_grid_err.gexf"))
 
     find_flow_vars = find_flow.solution.get_values()
 
@@ -14,15 +14,37 @@
 # ************************************************
 # ********* Import relevant libraries ************
 # ************************************************
-import cplex
+try:
+    import cplex
+except ImportError:
+    cplex = None  # the flow problems are solved by the model builder instead, see --flow_backend
 import sys
 import os
 import csv
 import networkx as nx
 import time
 import collections
+import math
 import random
 import numpy
+import model_builder
+from instance_loader import load_instance
+from weighted_sampler import FenwickSampler
+from solution_vector import EdgeUniverse, save_solution
+from budget_ledger import BudgetLedger
+from adaptive_operators import AdaptiveOperatorSelector, cpu_time
+from acceptance_criteria import create_acceptance_criterion, SimulatedAnnealingAcceptance, tempering_ladder, \
+    swap_probability
+from surrogate_screening import RidgeSurrogate, fail_count_vector
+from supply_estimator import SupplyEstimator
+from scenario_dominance import ScenarioDominanceIndex, island_supply_bound
+from search_checkpoint import SearchState, load_search_state
+from results_store import open_results_store, output_path, set_output_directory
+import buffered_writer
+from telemetry import metrics, start_reporting
+import profiling
+from profiling import span, profiled
+import multiprocessing
 
 
 # ************************************************
@@ -37,12 +59,12 @@ parser.add_argument('--time_limit', help="Set a time limit (stopping criteria),
 parser.add_argument('--budget', help="Budget constraint for optimization problem [default 100]",
                     type=float, default=100.0)
 parser.add_argument('--export_results_tracking', help="Location of solution output file "
-                                                      "(default c:/temp/grid_cascade_output/heuristic_results.csv)"
+                                                      "(default heuristic_results.csv in the output directory)"
                                                       "To suppress set as False",
-                    type=str, default="c:/temp/grid_cascade_output/heuristic_results.csv")
+                    type=str, default="")
 parser.add_argument('--export_final_grid', help="Location to which the final power grid will be saved, as a gpickle"
-                                                "(default c:/temp/grid_cascade_output/"
-                                                "YYYY-MM-DD-hh-mm_heuristic_sol_*instance*.gpickle"
+                                                "(timestamped = the output directory's "
+                                                "YYYY-MM-DD-hh-mm_heuristic_sol_*instance*.gpickle)"
                                                 "Set as False to skip saving (default)",
                     type=str, default="False")
 parser.add_argument('--opt_gap', help="Gap from full demand [default 0.01=1%%]",
@@ -93,11 +115,132 @@ parser.add_argument('--line_establish_capacity_coef_scale',
                     help = "Coefficient for scaling capacity of newely established transmission lines",
                     type = float, default = 5.0)
 parser.add_argument('--dump_file', help="Save the final objective outcome (number of run), "
-                                          "saved to c:/temp/grid_cascade_output/dump.csv",
+                                          "saved to the dump table of the results store",
                     type=float, default=0.0)
+parser.add_argument('--output_directory', help="Directory of the output files and the results store [default: the "
+                                               "GRID_CASCADE_OUTPUT environment variable, or "
+                                               "c:/temp/grid_cascade_output on windows]",
+                    type=str, default="")
+parser.add_argument('--results_store', help="The results store, a SQLite database "
+                                            "[default: results.sqlite in the output directory]",
+                    type=str, default="")
+parser.add_argument('--metrics_file', help="Write live progress metrics (see telemetry.py) as a json snapshot to "
+                                           "this file [default: no snapshots]",
+                    type=str, default="")
+parser.add_argument('--metrics_port', help="Serve live progress metrics at http://127.0.0.1:<port>/metrics "
+                                           "[default: 0, no endpoint]",
+                    type=int, default=0)
+parser.add_argument('--metrics_interval', help="Seconds between metrics snapshots",
+                    type=float, default=30.0)
+parser.add_argument('--profile', help="Time the spans of the search (see profiling.py), report them on screen and "
+                                      "in the profile table of the results store",
+                    action="store_true")
+parser.add_argument('--profile_trace', help="Also write the profile as folded stacks (for flamegraph.pl or "
+                                            "speedscope) to this file [default: none]",
+                    type=str, default="")
 parser.add_argument('--create_registry_file', help="Create a registry file which tracks all actions of the algorithm,"
                                                    "Enter full path of file name, omit argument for no tracking.",
                     type=str, default = "False")
+parser.add_argument('--debug_budget_ledger', help="Verify the incremental budget accounting against a full "
+                                                  "recomputation after every upgrade/downgrade (slow, for debugging)",
+                    action="store_true")
+parser.add_argument('--adaptive_operators', help="Select the upgrade (destroy) and downgrade (repair) operators by an "
+                                                 "adaptive roulette wheel (ALNS), weighted by the improvements per "
+                                                 "CPU-second of each operator. Otherwise use the fixed mix set by "
+                                                 "UPGRADE_SELECTION_BIAS and FULL_DESTRUCT_PROBABILITY",
+                    action="store_true")
+parser.add_argument('--operator_segment_length', help="Number of iterations between operator weight updates "
+                                                      "[default 25]",
+                    type=int, default=25)
+parser.add_argument('--operator_reaction_factor', help="Reaction factor of the operator weights to the last segment "
+                                                       "(0 = static weights, 1 = only last segment) [default 0.2]",
+                    type=float, default=0.2)
+parser.add_argument('--acceptance_criterion', help="Which neighbors replace the current solution: improvement "
+                                                   "(only improving neighbors, default), annealing (simulated "
+                                                   "annealing), late_acceptance (late acceptance hill climbing) or "
+                                                   "threshold (threshold accepting)",
+                    type=str, default="improvement",
+                    choices=["improvement", "annealing", "late_acceptance", "threshold"])
+parser.add_argument('--acceptance_temperature', help="Initial temperature of annealing (or the threshold of threshold "
+                                                     "accepting), as a proportion of the total demand. "
+                                                     "Also the hottest temperature of parallel tempering "
+                                                     "[default 0.001=0.1%% of demand]",
+                    type=float, default=0.001)
+parser.add_argument('--acceptance_cooling_rate', help="Multiplier of the temperature (threshold) after every "
+                                                      "iteration [default 0.995]",
+                    type=float, default=0.995)
+parser.add_argument('--late_acceptance_length', help="History length of late acceptance hill climbing [default 50]",
+                    type=int, default=50)
+parser.add_argument('--parallel_tempering', help="Number of parallel tempering replicas, each runs simulated annealing "
+                                                 "at a fixed temperature in a separate process, and states are "
+                                                 "exchanged between neighboring temperatures. 0 to disable (default)",
+                    type=int, default=0)
+parser.add_argument('--tempering_min_temperature', help="Coldest temperature of parallel tempering, as a proportion "
+                                                        "of the total demand [default 0.00001]",
+                    type=float, default=0.00001)
+parser.add_argument('--tempering_exchange_interval', help="Iterations each replica runs between state exchanges "
+                                                          "[default 10]",
+                    type=int, default=10)
+parser.add_argument('--surrogate_screening', help="Pre-screen neighbors with an online ridge regression surrogate of "
+                                                  "the cascade simulation, and fully simulate only the most "
+                                                  "promising ones",
+                    action="store_true")
+parser.add_argument('--surrogate_candidates', help="Number of neighbors created per iteration when screening "
+                                                   "[default 5]",
+                    type=int, default=5)
+parser.add_argument('--surrogate_keep_fraction', help="Fraction of the top ranked neighbors which are fully simulated "
+                                                      "[default 0.2]",
+                    type=float, default=0.2)
+parser.add_argument('--surrogate_audit_probability', help="Probability of simulating a screened out neighbor anyway, "
+                                                          "used to report the improvements filtered out by the "
+                                                          "surrogate [default 0.05]",
+                    type=float, default=0.05)
+parser.add_argument('--surrogate_warm_up', help="Number of simulated neighbors before the surrogate starts screening "
+                                                "[default 30]",
+                    type=int, default=30)
+parser.add_argument('--supply_estimator', help="Evaluate solutions exactly over all scenarios (exact), or by a "
+                                               "Monte-Carlo estimate with importance sampling toward edges with "
+                                               "high fail counts (importance) or stratified by the first-step loss "
+                                               "(stratified), with a first-step loss control variate. An estimate "
+                                               "improves on the incumbent only beyond its confidence interval, and "
+                                               "the final incumbent is evaluated exactly [default exact]",
+                    type=str, default="exact", choices=["exact", "importance", "stratified"])
+parser.add_argument('--estimator_half_width', help="Target half width of the estimate's confidence interval, as a "
+                                                   "proportion of the total demand [default 0.001]",
+                    type=float, default=0.001)
+parser.add_argument('--estimator_confidence', help="Confidence level of the estimate (0.9, 0.95 or 0.99) "
+                                                   "[default 0.95]",
+                    type=float, default=0.95)
+parser.add_argument('--estimator_min_samples', help="Minimal number of sampled scenarios per estimate, smaller "
+                                                    "scenario sets are evaluated exactly [default 30]",
+                    type=int, default=30)
+parser.add_argument('--estimator_max_samples', help="Maximal number of sampled scenarios per estimate "
+                                                    "[default 0 = the number of scenarios]",
+                    type=int, default=0)
+parser.add_argument('--scenario_dominance', help="Skip the simulation of scenarios whose initial failures are the "
+                                                 "failures of another scenario's cascade up to some step (their "
+                                                 "outcome is determined), and with the improvement acceptance "
+                                                 "criterion stop evaluating a neighbor once its island supply bound "
+                                                 "can not improve the incumbent",
+                    action="store_true")
+parser.add_argument('--surrogate_ridge_lambda', help="Regularization coefficient of the surrogate [default 1.0]",
+                    type=float, default=1.0)
+parser.add_argument('--checkpoint_file', help="Checkpoint the search state periodically (and at the end of the run) "
+                                              "into this file, and if it already exists resume the search from it. "
+                                              "With parallel tempering the checkpoint is written at the end of the "
+                                              "run only [default False = no checkpoints]",
+                    type=str, default="False")
+parser.add_argument('--checkpoint_every', help="Seconds between checkpoints [default 600]",
+                    type=float, default=600)
+parser.add_argument('--resume_from', help="Resume the search from the state saved in this checkpoint file, e.g., to "
+                                          "extend a finished run with a longer --time_limit (the time limit includes "
+                                          "the time spent before the checkpoint). The search options must be the "
+                                          "ones the checkpoint was saved with [default False = a new search]",
+                    type=str, default="False")
+parser.add_argument('--flow_backend', help="Solve the flow problems of the cascade simulation with CPLEX (cplex), or "
+                                           "by least squares with the model builder (matrix, see model_builder.py). "
+                                           "Without CPLEX, cplex falls back to matrix with a warning [default cplex]",
+                    type=str, default="cplex", choices=['cplex', 'matrix'])
 
 # ... add additional arguments as required here ..
 args = parser.parse_args()
@@ -115,56 +258,114 @@ global upgrade_selection_bias
 upgrade_selection_bias = args.upgrade_selection_bias
 global create_registry
 create_registry = (args.create_registry_file != "False")
+global flow_solver  # the module which builds and solves the flow problems: cplex or model_builder (--flow_backend)
+flow_solver = model_builder.select_solver(args.flow_backend, cplex)
+global supply_estimator  # None for an exact evaluation of solutions (see evaluate_grid)
+supply_estimator = None
+# the arguments which may differ between a checkpoint and the run resuming it, all other arguments define the search
+RESUMABLE_OPTIONS = ['time_limit', 'opt_gap', 'export_results_tracking', 'export_final_grid', 'dump_file',
+                     'output_directory', 'results_store', 'metrics_file', 'metrics_port', 'metrics_interval', 'profile',
+                     'profile_trace', 'create_registry_file', 'debug_budget_ledger', 'checkpoint_file',
+                     'checkpoint_every', 'resume_from']
+global dominance_index  # None unless --scenario_dominance (see compute_dominated_supply)
+dominance_index = None
+# results are written into the results store (see results_store.py), opened (and its run registered) by main_program()
+set_output_directory(args.output_directory)
+global results_store
+results_store = None
+if not args.export_results_tracking:
+    args.export_results_tracking = output_path('heuristic_results.csv')
+profiling.enable(args.profile or bool(args.profile_trace))  # timing spans
 
 
 # ****************************************************
 # **************** Track decisions *******************
 # ****************************************************
+# the registry and the tracking file are written by background threads (see buffered_writer.py),
+# flushed on exit and when the run is terminated
+global registry_writer
+registry_writer = None
+if create_registry:
+    registry_writer = buffered_writer.BufferedCsvWriter(args.create_registry_file + '.csv',
+                                                        ['act_desc', 'edge', 'derived_val', 'current_time'])
+
+
 def write_track(action_description, edge, derived_value):
-    with open(args.create_registry_file + '.csv', 'ab') as registry_track_file:
-        reg_writer = csv.writer(registry_track_file)
-        if not os.path.isfile(args.export_results_tracking):
-            reg_writer.writerow('act_desc', 'edge', 'derived_val', 'current_time')
-        reg_writer.writerow([action_description, edge, derived_value, time.time()])
+    registry_writer.writerow([action_description, edge, derived_value, time.time()])
+
+
+def flush_writers():
+    for cur_writer in [registry_writer, tracking_writer]:
+        if cur_writer is not None:
+            cur_writer.flush()
 
 
 # ****************************************************
 # ****** Append solution statistics file *************
 # ****************************************************
-# if file does not exist open the file and write the header
-if not os.path.isfile(args.export_results_tracking):
-    with open(args.export_results_tracking, 'ab') as tracking_file:
-        writer = csv.writer(tracking_file)
-        writer.writerow([
-            "time_stamp_str", "current_time",
-            "args.instance_location", "budget",
-            "full_destruct_probability", "upgrade_selection_bias",
-            "left_budget", "loop_counter", "num_improvements",
-            "current_supply", "total_demand",
-            "neighborhoods_searched", "min_neighbors_per_neighborhood", "current_incumbent",
-            "min_neighborhoods", "local_improvement_ratio", "overall_improvement_ratio", "temporary_grid_outcome"
-        ])
+# the header is written if the file does not exist
+global tracking_writer
+tracking_writer = None
+if args.export_results_tracking != "False":
+    tracking_writer = buffered_writer.BufferedCsvWriter(args.export_results_tracking, [
+        "time_stamp_str", "current_time",
+        "args.instance_location", "budget",
+        "full_destruct_probability", "upgrade_selection_bias",
+        "left_budget", "loop_counter", "num_improvements",
+        "current_supply", "total_demand",
+        "neighborhoods_searched", "min_neighbors_per_neighborhood", "current_incumbent",
+        "min_neighborhoods", "local_improvement_ratio", "overall_improvement_ratio", "temporary_grid_outcome"
+    ])
+
+
+def search_options():
+    """
+    :return: the arguments which define the search (all but RESUMABLE_OPTIONS), saved with the search state
+    """
+    return {name: value for name, value in vars(args).items() if name not in RESUMABLE_OPTIONS}
 
 
 # ****************************************************
 # ******* The main program ***************************
 # ****************************************************
 def main_program():
+    global results_store
+    results_store = open_results_store('robustness_heuristic_upper_bound.py', vars(args), args.results_store)
+    start_reporting(args.metrics_file, args.metrics_port, args.metrics_interval)  # live progress metrics
     # get the start time
     start_time = time.time()
     current_time = time.time()
-    nodes = read_nodes(instance_location + 'grid_nodes.csv')
-    edges = read_edges(instance_location + 'grid_edges.csv')
+    instance = load_instance(instance_location)  # compiled once into a binary bundle, see instance_loader.py
+    nodes = instance.nodes()
+    edges = instance.edges(args.load_capacity_factor, args.line_establish_cost_coef_scale,
+                           args.line_upgrade_cost_coef_scale)
 
-    scenarios = read_scenarios(instance_location + 'scenario_failures.csv',
-                               instance_location + 'scenario_probabilities.csv')
+    scenarios = instance.scenarios()
 
     # compute the total demand in the grid
     total_demand = sum([nodes[node_key] for node_key in nodes.keys() if node_key[0] == 'd'])
-
-    # build a basic networkx object which will be used to hold the solution, and serve as an initial solution
-    current_grid = create_power_grid(nodes, edges)
-    current_grid_outcome = compute_current_supply(current_grid.copy(), scenarios)
+    if args.supply_estimator != "exact":
+        global supply_estimator
+        supply_estimator = SupplyEstimator(scenarios, args.supply_estimator,
+                                           args.estimator_half_width*total_demand, args.estimator_confidence,
+                                           min_samples=args.estimator_min_samples,
+                                           max_samples=args.estimator_max_samples)
+
+    if args.scenario_dominance:
+        global dominance_index
+        dominance_index = ScenarioDominanceIndex(scenarios)
+
+    # the base topology is shared by all solutions, a solution is a capacity vector over grid_universe.edge_list.
+    # the initial solution is the original grid. A networkx grid is built only for simulation and export.
+    grid_universe = EdgeUniverse(nodes, edges)
+    current_solution = grid_universe.initial_solution()
+    current_grid_outcome = evaluate_grid(grid_universe.to_grid(current_solution), scenarios)
+
+    # weighted samplers over all candidate edges, used for the upgrade selection bias.
+    # each sampler is kept in sync with the current solution's outcome (see update_selection_samplers)
+    global edge_selection_samplers
+    edge_selection_samplers = {'fail_count': FenwickSampler(grid_universe.edge_list)}
+    update_selection_samplers(current_grid_outcome)
     current_supply = [current_grid_outcome['supply']]  # retains the history of objective function values
     continue_flag = True  # will be used as a flag when stopping criteria is matched
 
@@ -175,9 +376,23 @@ def main_program():
     upgrade_downgrade_step = args.line_upgrade_capacity_coef_scale
     establish_step = args.line_establish_capacity_coef_scale
 
-    # compute the remaining budget after the initial solution has been determined
-    left_budget = compute_left_budget(current_grid.copy(), edges)  # for now, this should equal budget,
+    # the budget ledger tracks the remaining budget of temporary_solution, incrementally with every move
+    budget_ledger = BudgetLedger(grid_universe, budget, current_solution, debug=args.debug_budget_ledger)
+    current_spent = budget_ledger.snapshot()  # for now, this should be 0 (the whole budget is left),
     # until a better initial solution is devised
+    original_spent = budget_ledger.snapshot()
+
+    # destroy (upgrade) and repair (downgrade) operators, defined by their failure count selection bias and
+    # full destruction probability. Without adaptive operators only the fixed mix set by the arguments is used
+    destroy_operators = {'mixed_upgrade': upgrade_selection_bias}
+    repair_operators = {'mixed_downgrade': full_destruct_probability}
+    if args.adaptive_operators:
+        destroy_operators.update({'random_upgrade': 0.0, 'biased_upgrade': 1.0})
+        repair_operators.update({'minor_downgrade': 0.0, 'destruct_downgrade': 1.0})
+    destroy_selector = AdaptiveOperatorSelector(destroy_operators, args.operator_segment_length,
+                                                args.operator_reaction_factor, adaptive=args.adaptive_operators)
+    repair_selector = AdaptiveOperatorSelector(repair_operators, args.operator_segment_length,
+                                               args.operator_reaction_factor, adaptive=args.adaptive_operators)
 
     loop_counter = 0  # used to count the number of iterations
     loops_local = 0  # number of loops in current area
@@ -185,34 +400,158 @@ def main_program():
     num_improvements = 0  # number of times the algorithm found a better incumbent
     num_improvements_local = 0  # number of time the algorithm found a better incumbent, in current search area
     local_no_improve = 0  # number of neighbors examined in the current neighborhood since last improvement
-
-    # copy the current grid to a temporary solution
-    temporary_grid = current_grid.copy()
-    original_grid = current_grid.copy()
+    last_optimal_sol_time = None  # time at which the incumbent was found
+
+    # copy the current solution to a temporary solution.
+    # current_solution is the solution the search continues from (accepted by the acceptance criterion),
+    # best_solution is the incumbent. With the improvement criterion the two are always the same.
+    temporary_solution = current_solution.copy()
+    original_solution = current_solution.copy()
+    best_solution = current_solution.copy()
+    best_grid_outcome = current_grid_outcome.copy()
     current_incumbent = True  # The initial solution is also the incumbent solution
+    acceptance = create_acceptance_criterion(args.acceptance_criterion, args.acceptance_temperature*total_demand,
+                                             args.acceptance_cooling_rate, args.late_acceptance_length,
+                                             current_grid_outcome['supply'])
+    # the surrogate pre-screens neighbors, so that only the most promising ones are fully simulated
+    surrogate = None
+    if args.surrogate_screening:
+        surrogate = RidgeSurrogate(grid_universe, args.surrogate_ridge_lambda, args.surrogate_warm_up)
+
+    def current_search_state():
+        # the search state at the end of an iteration, saved in checkpoints (see search_checkpoint.py)
+        return SearchState(instance_location=args.instance_location, budget=budget, search_options=search_options(),
+                           current_solution=current_solution, current_spent=current_spent,
+                           current_grid_outcome=current_grid_outcome, temporary_solution=temporary_solution,
+                           temporary_spent=budget_ledger.snapshot(), best_solution=best_solution,
+                           best_grid_outcome=best_grid_outcome, current_supply=current_supply,
+                           current_incumbent=current_incumbent, loop_counter=loop_counter, loops_local=loops_local,
+                           local_area_jumps=local_area_jumps, num_improvements=num_improvements,
+                           num_improvements_local=num_improvements_local, local_no_improve=local_no_improve,
+                           last_optimal_sol_time=last_optimal_sol_time, elapsed_time=time.time() - start_time,
+                           acceptance=acceptance, destroy_selector=destroy_selector, repair_selector=repair_selector,
+                           surrogate=surrogate, supply_estimator=supply_estimator)
+
+    # resume the search from a checkpoint (an explicit --resume_from, or the run's own checkpoint if it exists)
+    resume_file = args.resume_from if args.resume_from != "False" else args.checkpoint_file
+    state = load_search_state(resume_file) if resume_file != "False" else None
+    if state is None and args.resume_from != "False":
+        print "Could not resume the search from", args.resume_from, "(missing or invalid checkpoint)."
+        sys.exit(1)
+    if state is not None:
+        # the acceptance criterion, selectors, surrogate and estimator are restored as saved, so the options which
+        # created them (and any other search option) must be the same
+        saved_options = getattr(state, 'search_options', None)
+        if saved_options is None:
+            print "The checkpoint", resume_file, "was saved without its search options, and cannot be resumed."
+            sys.exit(1)
+        options = search_options()
+        different_options = sorted([name for name in set(options.keys()) | set(saved_options.keys())
+                                    if options.get(name) != saved_options.get(name)])
+        if different_options:
+            print "The checkpoint", resume_file, "was saved with different search options:", \
+                ", ".join(["--" + name + " " + str(saved_options.get(name)) + " (now " + str(options.get(name)) + ")"
+                           for name in different_options])
+            sys.exit(1)
+        current_solution = state.current_solution
+        current_spent = state.current_spent
+        current_grid_outcome = state.current_grid_outcome
+        temporary_solution = state.temporary_solution
+        budget_ledger.restore(state.temporary_spent)
+        best_solution = state.best_solution
+        best_grid_outcome = state.best_grid_outcome
+        current_supply = state.current_supply
+        current_incumbent = state.current_incumbent
+        loop_counter = state.loop_counter
+        loops_local = state.loops_local
+        local_area_jumps = state.local_area_jumps
+        num_improvements = state.num_improvements
+        num_improvements_local = state.num_improvements_local
+        local_no_improve = state.local_no_improve
+        last_optimal_sol_time = state.last_optimal_sol_time
+        acceptance = state.acceptance
+        destroy_selector = state.destroy_selector
+        repair_selector = state.repair_selector
+        surrogate = state.surrogate
+        supply_estimator = state.supply_estimator
+        update_selection_samplers(current_grid_outcome)
+        start_time = time.time() - state.elapsed_time
+        elapsed_time = state.elapsed_time/60
+        print "Resumed the search from", resume_file, "after", loop_counter, "rounds,", round(elapsed_time, 1), \
+            "minutes. Incumbent:", current_supply[-1]
+    last_checkpoint_time = time.time()
+
+    if args.parallel_tempering > 0:
+        # run the replicas in parallel processes instead of the sequential search below
+        tempering_results = parallel_tempering(grid_universe, scenarios, current_solution, current_grid_outcome,
+                                               current_spent, total_demand, start_time)
+        best_solution = tempering_results['best_solution']
+        best_grid_outcome = tempering_results['best_grid_outcome']
+        current_supply += tempering_results['supply_history']
+        loop_counter = tempering_results['loop_counter']
+        last_optimal_sol_time = tempering_results['last_optimal_sol_time']
+        elapsed_time = (time.time() - start_time)/60
+        continue_flag = False
 
     # while criteria has not been met (we haven't exceeded time and solution hasn't improved in last x iterations):
     while current_time - start_time < args.time_limit*60*60 and continue_flag:
-        # "destroy" current solution: choose what to upgrade until the upgrades exceed budget constraints
-        left_budget = upgrade(temporary_grid, current_grid_outcome['fail_count'], edges, left_budget)
-        # TODO: add weights for methods.
-        # "repair" the new grid: choose what to downgrade until the remaining upgrades are within the budget constrains
-        left_budget = downgrade(temporary_grid, edges, left_budget)  # TODO: add weights for methods.
-        # evaluate the performance of the temporary grid
-        temporary_grid_outcome = compute_current_supply(temporary_grid, scenarios)
-        # check value of current solution using the cascade simulator
-        if temporary_grid_outcome['supply'] > current_supply[-1] or loop_counter == 0:
-            last_optimal_sol_time = time.time()
-            # a better solution was found - update current incumbent TODO: insert a simulated annealing like behaviour
-            current_supply.append(temporary_grid_outcome['supply'])
-            current_grid = temporary_grid.copy()
+        operator_start_time = cpu_time()
+        destroy_operator = destroy_selector.select()
+        repair_operator = repair_selector.select()
+        if surrogate is not None:
+            # create several neighbors, and simulate only the ones ranked best by the surrogate
+            temporary_solution, temporary_grid_outcome = screen_neighbors(
+                temporary_solution, current_solution, current_grid_outcome, grid_universe, scenarios, budget_ledger,
+                surrogate, destroy_selector.parameters(destroy_operator), repair_selector.parameters(repair_operator))
+            left_budget = budget_ledger.left()
+        else:
+            # "destroy" current solution: choose what to upgrade until the upgrades exceed budget constraints
+            upgrade(temporary_solution, edge_selection_samplers['fail_count'], grid_universe, budget_ledger,
+                    destroy_selector.parameters(destroy_operator))
+            # "repair" the new grid: choose what to downgrade until the remaining upgrades are within the budget
+            left_budget = downgrade(temporary_solution, grid_universe, budget_ledger,
+                                    repair_selector.parameters(repair_operator))
+            # evaluate the performance of the temporary grid (no need to simulate if the repair restored the incumbent)
+            if numpy.array_equal(temporary_solution, current_solution) and loop_counter > 0:
+                temporary_grid_outcome = current_grid_outcome
+                metrics.inc('evaluations_reused')
+            else:
+                # with the improvement criterion only improving neighbors matter, the rest can be bounded
+                reject_below = current_supply[-1] if args.acceptance_criterion == 'improvement' and loop_counter > 0 \
+                    else None
+                with span('build_grid'):
+                    temporary_grid = grid_universe.to_grid(temporary_solution)
+                temporary_grid_outcome = evaluate_grid(temporary_grid, scenarios, reject_below)
+        # update the operators' statistics (the evaluation time is included in the operators' time)
+        operator_time = cpu_time() - operator_start_time
+        improved = is_improvement(temporary_grid_outcome, best_grid_outcome)
+        destroy_selector.record(destroy_operator, improved, operator_time)
+        repair_selector.record(repair_operator, improved, operator_time)
+        # check value of current solution using the cascade simulator, and decide if the search moves to it
+        accepted = acceptance.accept(temporary_grid_outcome['supply'], current_grid_outcome['supply'])
+        if improved or accepted or loop_counter == 0:
+            current_solution = temporary_solution.copy()
+            current_spent = budget_ledger.snapshot()
             current_grid_outcome = temporary_grid_outcome.copy()
-            num_improvements += 1
-            num_improvements_local += 1
-            current_incumbent = True
-            local_no_improve = -1  # update local neighborhood since last improvement (the "-1" is increased in a bit)
-            if create_registry:
-                write_track("Found new incumbent", "NA", current_supply[-1])
+            update_selection_samplers(current_grid_outcome)
+            local_no_improve = -1  # update local neighborhood since last move (the "-1" is increased in a bit)
+            if improved or loop_counter == 0:
+                # a better solution was found - update current incumbent
+                last_optimal_sol_time = time.time()
+                current_supply.append(temporary_grid_outcome['supply'])
+                best_solution = temporary_solution.copy()
+                best_grid_outcome = current_grid_outcome
+                num_improvements += 1
+                num_improvements_local += 1
+                current_incumbent = True
+                metrics.inc('incumbents')
+                metrics.set('incumbent', current_supply[-1])
+                if create_registry:
+                    write_track("Found new incumbent", "NA", current_supply[-1])
+            else:
+                current_incumbent = False
+                if create_registry:
+                    write_track("Accepting solution", "NA", temporary_grid_outcome['supply'])
         else:
             current_incumbent = False
             if create_registry:
@@ -232,12 +571,16 @@ def main_program():
                              local_area_jumps, args.min_neighbors, current_incumbent,
                              args.min_neighborhoods_total, args.local_improvement_ratio,
                              args.overall_improvement_ratio_threshold, temporary_grid_outcome['supply']]
-            with open(args.export_results_tracking, 'ab') as tracking_file:
-                writer = csv.writer(tracking_file)
-                writer.writerow(line_to_write)
+            tracking_writer.writerow(line_to_write)
         # TODO: do something with continue flag
         # TODO: add time counter
         loop_counter += 1
+        metrics.inc('rounds')
+        metrics.set('current_supply', current_grid_outcome['supply'])
+        metrics.set('evaluation_reuse_rate', float(metrics.counter('evaluations_reused'))/loop_counter)
+        if dominance_index is not None:
+            metrics.set('dominance_hit_rate', float(dominance_index.num_determined) /
+                        max(1, dominance_index.num_simulated + dominance_index.num_determined))
         loops_local += 1
         local_no_improve += 1
         current_time = time.time()  # to manage time stopping criteria
@@ -266,161 +609,359 @@ def main_program():
             if create_registry:
                 write_track("Jumping neighborhood", "NA", current_supply[-1])
             # reset grid to original state and start over the search - jumps to a new neighborhood
-            temporary_grid = original_grid.copy()
+            temporary_solution = original_solution.copy()
+            budget_ledger.restore(original_spent)
         else:
-            # return back to the best solution found so far
-            temporary_grid = current_grid.copy()
+            # return back to the current solution (the best solution found so far, for the improvement criterion)
+            temporary_solution = current_solution.copy()
+            budget_ledger.restore(current_spent)
             if create_registry:
                 write_track("Reset to incumbent", "NA", current_supply[-1])
         if args.overall_improvement_ratio_threshold >= float(num_improvements)/loop_counter and \
                 local_area_jumps >= args.min_neighborhoods_total-1:
             # in this case the overall ratio is so low, that probably nothing can be done with the heuristic
             continue_flag = False
-
-    # write the current solution current_grid to a gpickle file
+        if args.checkpoint_file != "False" and current_time - last_checkpoint_time >= args.checkpoint_every:
+            flush_writers()  # the tracked rows up to the checkpoint are on disk
+            current_search_state().save(args.checkpoint_file)
+            last_checkpoint_time = current_time
+
+    flush_writers()
+    if args.checkpoint_file != "False":
+        current_search_state().save(args.checkpoint_file)
+
+    # write the best solution current_grid to a gpickle file (and its capacity vector to an npz file)
+    current_grid = grid_universe.to_grid(best_solution)
+    estimate_half_width = best_grid_outcome.get('half_width', 0.0)
+    if supply_estimator is not None:
+        # the incumbent's estimate is the best of many noisy estimates (biased upwards), it is reported exactly
+        estimated_supply = best_grid_outcome['supply']
+        best_grid_outcome = compute_current_supply(current_grid, scenarios)
+        print "\nIncumbent evaluated exactly:", best_grid_outcome['supply'], "(estimated", estimated_supply, "+-", \
+            str(estimate_half_width) + ")"
     if args.export_final_grid != "False":
-        if args.export_final_grid == "timestamped" and 'last_optimal_sol_time' in locals():
+        if args.export_final_grid == "timestamped" and last_optimal_sol_time is not None:
             time_stamp = time.gmtime(last_optimal_sol_time)
-            filename = "c:/temp/grid_cascade_output/" + str(time_stamp[0]) + '-' + str(time_stamp[1]).zfill(2) + \
-                       '-' + str(time_stamp[2]).zfill(2) + '-' + str(time_stamp[3]).zfill(2) + '-' + \
-                       str(time_stamp[4]).zfill(2) + '-' + \
-                       str(time_stamp[5]).zfill(2) + ' - ' + args.instance_location + 'heuristic_sol'
+            filename = output_path(str(time_stamp[0]) + '-' + str(time_stamp[1]).zfill(2) + \
+                                   '-' + str(time_stamp[2]).zfill(2) + '-' + str(time_stamp[3]).zfill(2) + '-' + \
+                                   str(time_stamp[4]).zfill(2) + '-' + \
+                                   str(time_stamp[5]).zfill(2) + ' - ' + args.instance_location + 'heuristic_sol')
         else:
             filename = args.export_final_grid
         nx.write_gpickle(current_grid, filename + '.gpickle')
+        save_solution(grid_universe, best_solution, filename + '_capacities.npz')
         # export the per scenario statistics
         with open(filename + '_per_scenario_statistics.csv', 'wb') as scenario_stats_csv:
             writer = csv.writer(scenario_stats_csv)
             writer.writerow(['scenario', 'supply'])
-            writer.writerows(current_grid_outcome['supply_per_scenario'])
-
-    with open("c:/temp/grid_cascade_output/dump.csv", 'ab') as dump_file:
-        writer = csv.writer(dump_file)
-        writer.writerow([args.dump_file, max(current_supply), elapsed_time*60])
-    nx.write_gpickle(current_grid, "c:/temp/grid_cascade_output/detailed_results/" + str(args.dump_file) + '.gpickle')
+            writer.writerows(best_grid_outcome['supply_per_scenario'])
+        # export the operators' statistics
+        with open(filename + '_operator_statistics.csv', 'wb') as operator_stats_csv:
+            writer = csv.writer(operator_stats_csv)
+            writer.writerow(['operator', 'weight', 'uses', 'improvements', 'improvement_rate',
+                             'cpu_time', 'improvements_per_cpu_sec'])
+            writer.writerows(destroy_selector.statistics() + repair_selector.statistics())
+        # export the surrogate's calibration report
+        if surrogate is not None:
+            with open(filename + '_surrogate_calibration.csv', 'wb') as calibration_csv:
+                writer = csv.writer(calibration_csv)
+                writer.writerow(['measure', 'value'])
+                writer.writerows(surrogate.calibration_report())
+
+    results_store.append('dump', {'dump_file': args.dump_file, 'objective': best_grid_outcome['supply'],
+                                  'estimate_half_width': estimate_half_width, 'elapsed_time': elapsed_time*60})
+    results_store.extend('scenario_supply', [{'dump_file': args.dump_file, 'scenario': scenario, 'supply': supply}
+                                             for scenario, supply in best_grid_outcome['supply_per_scenario']])
+    results_store.extend('operator_statistics', [dict(zip(['operator', 'weight', 'uses', 'improvements',
+                                                           'improvement_rate', 'cpu_time', 'improvements_per_cpu_sec'],
+                                                          operator_row), dump_file=args.dump_file)
+                                                 for operator_row in destroy_selector.statistics() +
+                                                 repair_selector.statistics()])
+    nx.write_gpickle(current_grid, output_path('detailed_results', str(args.dump_file) + '.gpickle'))
+    if profiling.enabled:
+        profiling.print_report()
+        results_store.extend('profile', [dict(zip(profiling.REPORT_COLUMNS, row), dump_file=args.dump_file)
+                                         for row in profiling.report()])
+        if args.profile_trace:
+            profiling.write_folded(args.profile_trace)
+    if surrogate is not None:
+        print "\nSurrogate calibration:"
+        for measure, value in surrogate.calibration_report():
+            print measure + ":", value
     print "Program complete."
 
 
 # ****************************************************
-# ******* Downgrade and upgrade grid *****************
+# ******* Surrogate screening ************************
 # ****************************************************
-def compute_left_budget(power_grid, original_edges):
+@profiled()
+def screen_neighbors(start_solution, current_solution, current_grid_outcome, universe, scenarios, ledger, surrogate,
+                     selection_bias, destruct_probability):
+    """
+    Create args.surrogate_candidates neighbors of start_solution, rank them by the surrogate and fully simulate
+    only the top args.surrogate_keep_fraction (and occasionally a screened out neighbor, for calibration).
+    Every simulated neighbor trains the surrogate.
+    :param start_solution: the solution which the neighbors are created from (the ledger is at its state)
+    :param current_solution: the current solution of the search, the surrogate predicts the change relative to it
+    :param current_grid_outcome: the outcome of compute_current_supply for current_solution
+    :return: the best simulated neighbor and its outcome, the ledger is left at the state of that neighbor
+    """
+    start_spent = ledger.snapshot()
+    fail_weights = fail_count_vector(universe, current_grid_outcome['fail_count'])
+    candidates = []
+    for candidate_num in xrange(args.surrogate_candidates):
+        ledger.restore(start_spent)
+        candidate = start_solution.copy()
+        upgrade(candidate, edge_selection_samplers['fail_count'], universe, ledger, selection_bias)
+        downgrade(candidate, universe, ledger, destruct_probability)
+        candidates.append((candidate, ledger.snapshot()))
+    candidate_features = [surrogate.features(cur_candidate[0], current_solution, fail_weights)
+                          for cur_candidate in candidates]
+    kept, audited = surrogate.screen(candidate_features, args.surrogate_keep_fraction,
+                                     args.surrogate_audit_probability)
+    best_candidate = None
+    best_outcome = None
+    for i in kept + audited:
+        if numpy.array_equal(candidates[i][0], current_solution):
+            outcome = current_grid_outcome
+        else:
+            outcome = evaluate_grid(universe.to_grid(candidates[i][0]), scenarios)
+        supply_change = outcome['supply'] - current_grid_outcome['supply']
+        surrogate.add_observation(candidate_features[i], supply_change)
+        surrogate.record_outcome(supply_change, i in audited)
+        if best_outcome is None or outcome['supply'] > best_outcome['supply']:
+            best_candidate = i
+            best_outcome = outcome
+    ledger.restore(candidates[best_candidate][1])
+    return candidates[best_candidate][0], best_outcome
+
+
+# ****************************************************
+# ******* Parallel tempering *************************
+# ****************************************************
+def parallel_tempering(universe, scenarios, initial_solution, initial_outcome, initial_spent, total_demand,
+                       start_time):
+    """
+    Run simulated annealing replicas at fixed temperatures (a geometric ladder) in parallel processes.
+    Every TEMPERING_EXCHANGE_INTERVAL iterations the replicas return, and states of neighboring temperatures are
+    exchanged with probability min(1, exp((s_j - s_i)*(1/T_i - 1/T_j))). Stops at the time limit or opt gap.
+    :param universe: EdgeUniverse of the instance
+    :param scenarios: failure scenarios
+    :param initial_solution: solution vector all replicas start from
+    :param initial_outcome: compute_current_supply outcome of the initial solution
+    :param initial_spent: budget spent by the initial solution
+    :param total_demand: total demand in the grid
+    :param start_time: start time of the run (for the time limit)
+    :return: dictionary with the best solution and outcome, the history of best supply values,
+             the total number of iterations (simulations) and time of the last improvement
     """
-    Function to compute the remaining budget after grid upgrades
-    :param power_grid: Upgraded power grid to compute
-    :param original_edges: Edges in the original power grid (pre-upgrade)
-    :return: The remaining budget to allocate (can be negative if upgrades exceed budget)
+    temperatures = tempering_ladder(args.acceptance_temperature*total_demand,
+                                    args.tempering_min_temperature*total_demand, args.parallel_tempering)
+    replicas = [{'solution': initial_solution.copy(), 'spent': initial_spent, 'outcome': initial_outcome,
+                 'best_solution': initial_solution.copy(), 'best_outcome': initial_outcome,
+                 'temperature': cur_temperature, 'iterations': args.tempering_exchange_interval,
+                 'seed': random.randint(0, 2**31 - 1)}
+                for cur_temperature in temperatures]
+    pool = multiprocessing.Pool(args.parallel_tempering, initializer=init_tempering_worker,
+                                initargs=(universe, scenarios, upgrade_downgrade_step, establish_step,
+                                          supply_estimator, dominance_index))
+    best_solution = initial_solution.copy()
+    best_grid_outcome = initial_outcome
+    supply_history = []
+    last_optimal_sol_time = time.time()
+    loop_counter = 0
+    exchange_round = 0
+    while time.time() - start_time < args.time_limit*60*60 and \
+            args.opt_gap < 1 - best_grid_outcome['supply']/total_demand:
+        replicas = pool.map(tempering_replica_walk, replicas)
+        for cur_replica in replicas:
+            metrics.merge_deltas(cur_replica.pop('metric_deltas'))  # simulations, cascade depths, ... of the walk
+        loop_counter += args.tempering_exchange_interval * len(replicas)
+        # exchange states between neighboring temperatures (alternating even and odd pairs)
+        for i in range(exchange_round % 2, len(replicas) - 1, 2):
+            if random.random() < swap_probability(replicas[i]['outcome']['supply'], replicas[i]['temperature'],
+                                                  replicas[i+1]['outcome']['supply'], replicas[i+1]['temperature']):
+                for state_key in ['solution', 'spent', 'outcome']:
+                    replicas[i][state_key], replicas[i+1][state_key] = replicas[i+1][state_key], \
+                                                                       replicas[i][state_key]
+                if create_registry:
+                    write_track("Exchanging replicas", (i, i+1), replicas[i]['outcome']['supply'])
+        exchange_round += 1
+        metrics.inc('rounds', args.tempering_exchange_interval * len(replicas))
+        for cur_replica in replicas:
+            if is_improvement(cur_replica['best_outcome'], best_grid_outcome):
+                best_solution = cur_replica['best_solution'].copy()
+                best_grid_outcome = cur_replica['best_outcome']
+                supply_history.append(best_grid_outcome['supply'])
+                last_optimal_sol_time = time.time()
+                metrics.inc('incumbents')
+                metrics.set('incumbent', best_grid_outcome['supply'])
+                if create_registry:
+                    write_track("Found new incumbent", "NA", best_grid_outcome['supply'])
+        elapsed_time = (time.time()-start_time)/60
+        print "\r>> Elapsed:", str(int(elapsed_time)/60) + "hr,", str(int(elapsed_time % 60)) + "m", \
+            str(round(elapsed_time * 60.0 % 60, 1)) + "s.", \
+            "Exchange round", exchange_round, "Simulations", loop_counter, \
+            "| Replicas:", [round(cur_replica['outcome']['supply'], 1) for cur_replica in replicas], \
+            "| Overall Obj.:", best_grid_outcome['supply'], '(of ' + str(total_demand) + ').', \
+            "Gap:", 100-round(best_grid_outcome['supply']/total_demand*100, 1), "\b%",
+        sys.stdout.flush()
+    pool.close()
+    pool.join()
+    return {'best_solution': best_solution, 'best_grid_outcome': best_grid_outcome,
+            'supply_history': supply_history, 'loop_counter': loop_counter,
+            'last_optimal_sol_time': last_optimal_sol_time}
+
+
+def init_tempering_worker(universe, scenarios, upgrade_step, establish_step_value, estimator, dominance):
     """
-    current_edges = [arrange_edge_minmax(edge[0], edge[1])
-                     for edge in power_grid.edges()]
-    upgrade_costs = sum(
-        [(power_grid.edges[cur_edge]['capacity'] - original_edges[('c',) + cur_edge]) * original_edges[
-            ('h',) + cur_edge]
-         for cur_edge in current_edges])
-    establishment_costs = sum(
-        [(power_grid.edges[cur_edge]['capacity'] > 0 and original_edges[('c',) + cur_edge] == 0) * original_edges[
-            ('H',) + cur_edge]
-         for cur_edge in current_edges])
-    left_budget = budget - upgrade_costs + establishment_costs
-    return left_budget
+    Initialize a parallel tempering worker process with the instance data (shared by all replicas in the process)
+    """
+    global tempering_universe
+    global tempering_scenarios
+    global upgrade_downgrade_step
+    global establish_step
+    global supply_estimator
+    global dominance_index
+    tempering_universe = universe
+    tempering_scenarios = scenarios
+    upgrade_downgrade_step = upgrade_step
+    establish_step = establish_step_value
+    supply_estimator = estimator
+    dominance_index = dominance
+    metrics.reset()  # a forked worker starts with a copy of the parent's metrics, only the walks' deltas are returned
+
+
+def tempering_replica_walk(replica):
+    """
+    Run the LNS with simulated annealing at the replica's (fixed) temperature, for replica['iterations'] iterations.
+    :param replica: dictionary with the replica's current solution, spent budget, outcome, best solution and outcome,
+                    temperature, number of iterations and random seed
+    :return: the updated replica, with the deltas of the metrics of the walk (metric_deltas, see
+             telemetry.Metrics.take_deltas) to be merged into the metrics of the run
+    """
+    random.seed(replica['seed'])
+    numpy.random.seed(replica['seed'] % (2**32))
+    selection_sampler = FenwickSampler(tempering_universe.edge_list, replica['outcome']['fail_count'])
+    ledger = BudgetLedger(tempering_universe, budget, replica['solution'], debug=args.debug_budget_ledger)
+    acceptance = SimulatedAnnealingAcceptance(replica['temperature'])
+    for iteration in range(replica['iterations']):
+        temporary_solution = replica['solution'].copy()
+        ledger.restore(replica['spent'])
+        upgrade(temporary_solution, selection_sampler, tempering_universe, ledger, upgrade_selection_bias)
+        downgrade(temporary_solution, tempering_universe, ledger, full_destruct_probability)
+        temporary_outcome = evaluate_grid(tempering_universe.to_grid(temporary_solution),
+                                                   tempering_scenarios)
+        if acceptance.accept(temporary_outcome['supply'], replica['outcome']['supply']):
+            replica['solution'] = temporary_solution
+            replica['spent'] = ledger.snapshot()
+            replica['outcome'] = temporary_outcome
+            selection_sampler.set_weights(temporary_outcome['fail_count'])
+            if is_improvement(temporary_outcome, replica['best_outcome']):
+                replica['best_solution'] = temporary_solution.copy()
+                replica['best_outcome'] = temporary_outcome
+    replica['seed'] = random.randint(0, 2**31 - 1)
+    replica['metric_deltas'] = metrics.take_deltas()
+    flush_writers()  # the pool's workers exit without the exit handlers, their last tracked rows would be lost
+    return replica
 
 
-def upgrade(power_grid, fail_count, original_edges, left_budget):
+# ****************************************************
+# ******* Downgrade and upgrade grid *****************
+# ****************************************************
+@profiled('destroy')
+def upgrade(capacities, selection_sampler, universe, ledger, selection_bias):
     """
     Upgrade a power grid until upgrades exceed the budget
-    :param power_grid: The power grid to upgrade
-    :param fail_count: Dictionary of fail count of every edge in the power grid (relating to scenarios)
-    :param original_edges: The edges and capacities in the original power grid
-    :param left_budget: remaining budget for upgrades (should be positive)
-    :return: The amount of exceeding budget after upgrades (the function also updates power_grid)
+    :param capacities: The power grid to upgrade (solution vector, updated in place)
+    :param selection_sampler: FenwickSampler of the edges, weighted by their fail count (relating to scenarios)
+    :param universe: EdgeUniverse with the edges and capacities in the original power grid
+    :param ledger: BudgetLedger of capacities, remaining budget for upgrades should be positive (updated per move)
+    :param selection_bias: probability that an upgrade is selected by failure counts (versus a random selection)
+    :return: The amount of exceeding budget after upgrades (the function also updates capacities and ledger)
     """
 
     # list all edges which have a setup cost H and are also not in the current solution
-    establishable_edges = [(edge[1], edge[2]) for edge in original_edges if edge[0] == 'H' and original_edges[edge] > 0
-                           and not power_grid.has_edge(edge[1], edge[2])]
-
-    # list all edges which are still upgradable
-    upgradable_edges = [(edge[1], edge[2]) for edge in original_edges if edge[0] == 'H' and original_edges[edge] > 0
-                        and power_grid.has_edge(edge[1], edge[2])
-                        and power_grid.get_edge_data(edge[1], edge[2])['capacity'] <
-                        upgrade_downgrade_step + establish_step] + \
-                       [(edge[1], edge[2]) for edge in original_edges if edge[0] == 'H' and original_edges[edge] == 0
-                        and power_grid.has_edge(edge[1], edge[2])
-                        and power_grid.get_edge_data(edge[1], edge[2])['capacity'] <
-                        original_edges[('c',) + (edge[1], edge[2])] + upgrade_downgrade_step]
-
-    while left_budget > 0:
-        selected_operation = random.uniform(0, 1)  # used to randomly select the upgrade method
-        if selected_operation <= upgrade_selection_bias and len(upgradable_edges) > 0:  # upgrade an edge according to failure counts
-            existing_edges = fail_count.keys()
-            tot_fails = sum([fail_count[cur_edge] for cur_edge in existing_edges])
-            edge_selection_probability = [float(fail_count[cur_edge])/tot_fails for cur_edge in upgradable_edges]
-            edge_to_upgrade = upgradable_edges[
-                numpy.random.choice(range(len(upgradable_edges)), 1, edge_selection_probability)[0]
-            ]
+    establishable_edges = [universe.edge_list[i] for i in
+                           numpy.flatnonzero((universe.establish_cost > 0) & (capacities <= 0))]
+
+    # list all edges which are still upgradable (0.01 tolerance for rounding)
+    upgradable_edges = [universe.edge_list[i] for i in
+                        numpy.flatnonzero((universe.establish_cost > 0) & (capacities > 0) &
+                                          (capacities < upgrade_downgrade_step + establish_step - 0.01))] + \
+                       [universe.edge_list[i] for i in
+                        numpy.flatnonzero((universe.establish_cost == 0) & (capacities > 0) &
+                                          (capacities < universe.original_capacity + upgrade_downgrade_step - 0.01))]
+
+    # only upgradable edges can be drawn by the biased selection (masks are removed before returning)
+    selection_sampler.mask_all_except(upgradable_edges)
+
+    while ledger.left() > 0:
         if establishable_edges == [] and upgradable_edges == []:
             print 'STOPPING: Reached full upgrade situation. Cannot upgrade further.'
             sys.exit()
-        else:  # upgrade a regular edge without applying selection bias
+        selected_operation = random.uniform(0, 1)  # used to randomly select the upgrade method
+        edge_to_upgrade = None
+        if selected_operation <= selection_bias and len(upgradable_edges) > 0:
+            # upgrade an edge according to failure counts, O(log E) per draw.
+            # returns None if none of the upgradable edges failed
+            edge_to_upgrade = selection_sampler.sample()
+        if edge_to_upgrade is None:  # upgrade a regular edge without applying selection bias
             edge_to_upgrade = random.choice(upgradable_edges+establishable_edges)
+        edge_pos = universe.position[edge_to_upgrade]
         if edge_to_upgrade in establishable_edges:
             # edge does not exist, establish it by adding upgrade_downgrade_step
-            power_grid.add_edge(edge_to_upgrade[0], edge_to_upgrade[1],
-                                capacity=establish_step,
-                                susceptance=original_edges[('x',) + edge_to_upgrade])
-            left_budget = left_budget - original_edges[('H',) + edge_to_upgrade] - \
-                          original_edges[('h',) + edge_to_upgrade]*establish_step
+            ledger.set_capacity(capacities, edge_pos, establish_step)
             # Remove edge from establishable edges:
             establishable_edges.remove(edge_to_upgrade)
             if create_registry:
                 write_track("Upgrade new edge", edge_to_upgrade, "NA")
         else:  # edge exists, do an upgrade
-            power_grid.edges[edge_to_upgrade]['capacity'] += upgrade_downgrade_step
-            left_budget = left_budget - original_edges[('h',) + edge_to_upgrade] * upgrade_downgrade_step
-            # Remove edge from upgradable_edges
+            ledger.set_capacity(capacities, edge_pos, capacities[edge_pos] + upgrade_downgrade_step)
+            # Remove edge from upgradable_edges (and from the biased selection)
             upgradable_edges.remove(edge_to_upgrade)
+            selection_sampler.mask(edge_to_upgrade)
             if create_registry:
                 write_track("Upgrade existing edge", edge_to_upgrade, "NA")
 
-    return left_budget
+    selection_sampler.unmask_all()
+    return ledger.left()
 
 
-def downgrade(power_grid, original_edges, left_budget):
+@profiled('repair')
+def downgrade(capacities, universe, ledger, destruct_probability):
     """
     The inverse function to upgrade, it randomly chooses what edges to downgrade until
     the solution becomes feasible again (not exceeding budget)
-    :param power_grid: The power grid to upgrade
-    :param original_edges: The edges and capacities in the original power grid
-    :param left_budget: remaining budget for upgrades (should be negative)
-    :return: The amount of exceeding budget after upgrades (the function also updates power_grid)
+    :param capacities: The power grid to upgrade (solution vector, updated in place)
+    :param universe: EdgeUniverse with the edges and capacities in the original power grid
+    :param ledger: BudgetLedger of capacities, remaining budget for upgrades should be negative (updated per move)
+    :param destruct_probability: probability that a new edge is fully destructed (versus a minor downgrade)
+    :return: The amount of exceeding budget after upgrades (the function also updates capacities and ledger)
     """
     # TODO: Add an adaptive way to decide on a small downgrade versus edge elimination
-    while left_budget < 0:
+    while ledger.left() < 0:
         selected_operation = random.uniform(0, 1)  # used to randomly select the downgrade method
-        new_edges = [(edge[1], edge[2]) for edge in original_edges if edge[0] == 'c' and
-                     power_grid.has_edge(edge[1], edge[2]) and
-                     original_edges[edge] == 0]
-        if selected_operation < full_destruct_probability and new_edges != []:
+        new_edges = numpy.flatnonzero((capacities > 0) & (universe.original_capacity == 0))
+        if selected_operation < destruct_probability and len(new_edges) > 0:
             # select a new edge and completely destruct it
-            edge_to_downgrade = random.choice(new_edges)
+            edge_pos = random.choice(new_edges)
             # compute the capacity to remove (cannot exceed the line's capacity)
             # currently the step is constant so this not needed, but later on will be important
-            remove_capacity = power_grid.edges[edge_to_downgrade]['capacity']  # remove entire capacity
+            remove_capacity = capacities[edge_pos]  # remove entire capacity
             if create_registry:
-                write_track("Destruct edge", edge_to_downgrade, "NA")
+                write_track("Destruct edge", universe.edge_list[edge_pos], "NA")
         else:  # don't destruct, just make minor changes to edges (may destruct if small capacity exists)
-            edge_to_downgrade = random.choice([(edge[1], edge[2]) for edge in original_edges if edge[0] == 'c' and
-                                               power_grid.has_edge(edge[1], edge[2]) and
-                                               original_edges[edge] < power_grid.edges[(edge[1], edge[2])]['capacity'] - 0.01])
+            edge_pos = random.choice(numpy.flatnonzero((capacities > 0) &
+                                                       (universe.original_capacity < capacities - 0.01)))
             # compute the capacity to remove (cannot exceed the line's original capacity)
-            if original_edges[('c',) + edge_to_downgrade] == 0 and \
-                    power_grid.edges[edge_to_downgrade]['capacity'] \
-                    >= upgrade_downgrade_step + establish_step - 0.01:
+            if universe.original_capacity[edge_pos] == 0 and \
+                    capacities[edge_pos] >= upgrade_downgrade_step + establish_step - 0.01:
                 # in this case the edge does not exist in the original grid and
                 # in the current solution it was established and upgraded
                 remove_capacity = upgrade_downgrade_step
-            elif original_edges[('c',) + edge_to_downgrade] == 0 and \
-                power_grid.edges[edge_to_downgrade]['capacity'] >= establish_step - 0.01:
+            elif universe.original_capacity[edge_pos] == 0 and \
+                    capacities[edge_pos] >= establish_step - 0.01:
                 # For readability, I'm slightly more explicit than what I have to be.
                 # In this case the edge does not exist in the original grid and
                 # in the current solution it was established (with no additional upgrades)
@@ -429,70 +970,19 @@ def downgrade(power_grid, original_edges, left_budget):
                 # The edge did exist in the original grid, but was upgraded in the current solution
                 remove_capacity = upgrade_downgrade_step
             if create_registry:
-                write_track("Downgrade edge", edge_to_downgrade, "NA")
-        # do the actual modification to the power grid networkx object
-        power_grid.edges[edge_to_downgrade]['capacity'] -= remove_capacity
-        left_budget += original_edges[('h',) + edge_to_downgrade] * remove_capacity
-        if power_grid.edges[edge_to_downgrade]['capacity'] <= 0.01:
-            # if this edge should not exist - remove it and add back establishment cost
-            left_budget += original_edges[('H',) + edge_to_downgrade]
-            power_grid.remove_edge(edge_to_downgrade[0], edge_to_downgrade[1])
-            if create_registry:
-                write_track("Destruct edge", edge_to_downgrade, "NA")
+                write_track("Downgrade edge", universe.edge_list[edge_pos], "NA")
+        # do the actual modification to the solution vector.
+        # if this edge should not exist (capacity <= 0.01) the ledger removes it and adds back establishment cost
+        ledger.set_capacity(capacities, edge_pos, capacities[edge_pos] - remove_capacity)
+        if capacities[edge_pos] == 0 and create_registry:
+            write_track("Destruct edge", universe.edge_list[edge_pos], "NA")
 
-    return left_budget
+    return ledger.left()
 
 
 # ****************************************************
 # ******* Reading and writing files ******************
 # ****************************************************
-def read_nodes(filename):
-    dic = dict()
-    with open(filename, 'rb') as nodes_file:
-        nodes_reader = csv.reader(nodes_file, delimiter=',')
-        next(nodes_reader)  # assuming header, skip first line
-        for row in nodes_reader:
-            dic[('d', row[0])] = float(row[1])  # read demand
-            dic[('c', row[0])] = float(row[2])  # read capacity
-            dic[('gen_up_ub', row[0])] = float(row[3])  # max generation upgrade
-            dic[('H', row[0])] = float(row[4])  # fixed cost
-            dic[('h', row[0])] = float(row[5])  # variable cost
-    return dic
-
-
-def read_edges(filename):
-    dic = dict()
-    with open(filename, 'rb') as edges_file:
-        csv_reader = csv.reader(edges_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            cur_edge = arrange_edge_minmax(row[0], row[1])
-            dic[('c',) + cur_edge] = float(row[2])*args.load_capacity_factor  # current capacity
-            dic[('x',) + cur_edge] = float(row[3])  # reactance
-            dic[('H',) + cur_edge] = float(row[4])*args.line_establish_cost_coef_scale  # fixed cost
-            dic[('h',) + cur_edge] = float(row[5])*args.line_upgrade_cost_coef_scale  # variable cost
-    return dic
-
-
-def read_scenarios(filename_fail, filename_pr):
-    dic = dict()
-    with open(filename_pr, 'rb') as pr_file:
-        csv_reader = csv.reader(pr_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            dic[('s_pr', row[0])] = float(row[1])
-
-    with open(filename_fail, 'rb') as failure_file:
-        csv_reader = csv.reader(failure_file, delimiter=',')
-        next(csv_reader)  # assuming header, skip first line
-        for row in csv_reader:
-            if ('s', row[0]) in dic.keys():
-                dic[('s', row[0])] += [arrange_edge_minmax(row[1], row[2])]  # failures
-            else:
-                dic[('s', row[0])] = [arrange_edge_minmax(row[1], row[2])]  # first failure in this scenario
-    return dic
-
-
 def arrange_edge_minmax(edge_i, edge_j=None):
     if edge_j is None:
         # case edge_i contains a tuple
@@ -502,43 +992,10 @@ def arrange_edge_minmax(edge_i, edge_j=None):
     return tmp
 
 
-# ****************************************************
-# ******* Create power grid as networkx object *******
-# ****************************************************
-def create_power_grid(nodes, edges):
-    """
-    Build a power grid as a networkx object with customized keys
-    :param nodes: a dictionary of nodes, as read and output by read_nodes() function
-    :param edges: a dictionary of edges, as read and output by read_edges() function
-    :return: grid an nx.Graph() object with the proper nodes and edges.
-    """
-
-    # initialize empty graph
-    grid = nx.Graph()
-    # add all the nodes
-    node_list = [node[1] for node in nodes.keys() if node[0] == 'd']
-    add_nodes = [(cur_node, {'demand': nodes[('d', cur_node)],
-                             'gen_cap': nodes[('c', cur_node)], 'generated': 0,
-                             'un_sup_cost': 0, 'gen_cost': 0, 'original_demand': nodes[('d', cur_node)]})
-                 for cur_node in node_list]
-    grid.add_nodes_from(add_nodes)
-
-    # add all the edges
-    edge_list = [(min(edge[1], edge[2]), max(edge[1], edge[2])) for edge in edges if edge[0] == 'c']
-    add_edges_1 = [(cur_edge[0], cur_edge[1], {
-        'capacity': edges[('c',) + cur_edge],
-        'susceptance': edges[('x',) + cur_edge],
-        'establish_cost': edges[('H',) + cur_edge],
-        'upgrade_cost': edges[('h',) + cur_edge]})
-                   for cur_edge in edge_list if (edges[('c',) + cur_edge] > 0)]
-    grid.add_edges_from(add_edges_1)
-
-    return grid
-
-
 # ****************************************************
 # ************ Test power grid failures **************
 # ****************************************************
+@profiled('cascade_simulation')
 def cfe(power_grid, init_fail_edges):
     """
     Simulates a cascade failure evolution.
@@ -554,6 +1011,7 @@ def cfe(power_grid, init_fail_edges):
     tot_failed = [] + init_fail_edges  # include initial failures in all_failed
     # loop
     i = 0
+    simulation_start_time = time.time()
     tmp_grid_flow_update = {'cplex_object': None}  # initialize an empty object
     # The loop continues to recompute the flow only as long as there are more cascades and if this current
     # simulation has a max depth then it has not been reached (i<max_cascade_depth)
@@ -563,9 +1021,13 @@ def cfe(power_grid, init_fail_edges):
         tot_failed += F[i+1]
         i += 1
     failed_grid = power_grid.copy()
+    metrics.inc('simulations')
+    metrics.inc('time_cascade_sim', time.time() - simulation_start_time)
+    metrics.observe('cascade_depth', i)
     return {'F': F, 't': i, 'all_failed': tot_failed, 'updated_grid_copy': failed_grid}
 
 
+@profiled('flow_update')
 def grid_flow_update(power_grid, failed_edges=[], write_lp=False, return_cplex_object=False):
     """
     Modifies power_grid after failure of edges in failed_edges,
@@ -586,7 +1048,7 @@ def grid_flow_update(power_grid, failed_edges=[], write_lp=False, return_cplex_o
     update_grid(power_grid, failed_edges)  # Each component of power_grid will balance demand and generation
     # capacities after this line
     # Initialize cplex internal flow problem
-    find_flow = cplex.Cplex() # create cplex instance
+    find_flow = flow_solver.Cplex() # create cplex instance (or its model builder stand-in)
     find_flow.objective.set_sense(find_flow.objective.sense.minimize)  # doesn't matter
 
     # Initialize decision variables (demand, supply, theta, and flow)
@@ -630,20 +1092,23 @@ def grid_flow_update(power_grid, failed_edges=[], write_lp=False, return_cplex_o
 
     # Solve problem
     find_flow.set_problem_type(find_flow.problem_type.LP) # This is a regular linear problem, avoid code 1017 error.
-    find_flow.solve()
+    with span('flow_solve'):
+        find_flow.solve()
 
     # Check to make sure that an optimal solution has been reached or exit otherwise
     if find_flow.solution.get_status() != 1:
         find_flow.write('problem_infeasible.lp')
         print "I'm having difficulty with a flow problem - please check"
-        nx.write_gexf(power_grid, "c:/temp/exported_grid_err.gexf")
+        nx.write_gexf(power_grid, output_path("exported_grid_err.gexf"))
         sys.exit('Error: no optimal solution found while trying to solve flow problem. Writing into: '
-                 'problem_infeasible.lp and c:/temp/exported_grid_err.gexf')
+                 'problem_infeasible.lp and ' + output_path("exported_grid_err.gexf"))
 
     find_flow_vars = find_flow.solution.get_values()
 
     # Set the failed edges
-    new_failed_edges = [edge for edge in sorted_edges(power_grid.edges().keys()) if abs(find_flow_vars[dvar_pos_flow[('flow', edge)]]) > power_grid.edges[edge]['capacity']]
+    with span('failure_detection'):
+        new_failed_edges = [edge for edge in sorted_edges(power_grid.edges().keys())
+                            if abs(find_flow_vars[dvar_pos_flow[('flow', edge)]]) > power_grid.edges[edge]['capacity']]
 
     # just in case you want an lp file - for debugging purposes.
 
@@ -660,6 +1125,7 @@ def grid_flow_update(power_grid, failed_edges=[], write_lp=False, return_cplex_o
     return return_object
 
 
+@profiled()
 def update_grid(power_grid, failed_edges):
     """
     Function to update the existing graph by omitting failed_edges from it and re-computing demand and generation in
@@ -747,6 +1213,95 @@ def compute_current_supply(power_grid, scenarios):
     return result
 
 
+def compute_dominated_supply(power_grid, scenarios, reject_below=None):
+    """
+    compute_current_supply, where scenarios whose outcome is determined by the cascade of another scenario are not
+    simulated (see scenario_dominance.py).
+    :param power_grid: power grid as a networkx object with special properties (e.g. capacity, demand).
+    :param scenarios: failure (initial) scenarios
+    :param reject_below: stop simulating once the supply can not exceed this value. The remaining scenarios are
+                         bounded by the supply of their islands, and the returned supply is then an upper bound
+    :return: A dictionary as returned by compute_current_supply, with 'bounded' (True if the evaluation was stopped,
+             in which case 'fail_count' and 'supply_per_scenario' cover only the evaluated scenarios)
+    """
+    scenario_list = [key[1] for key in scenarios.keys() if key[0] == 's']
+    def scenario_supply(failed_grid):
+        return sum([failed_grid['updated_grid_copy'].nodes[cur_node]['demand'] for cur_node in power_grid.nodes])
+
+    stop = None
+    if reject_below is not None:
+        bounds = {cur_scenario: island_supply_bound(power_grid, scenarios[('s', cur_scenario)]) *
+                  scenarios[('s_pr', cur_scenario)] for cur_scenario in scenario_list}
+
+        def stop(results):
+            return sum([scenario_supply(results[cur_scenario]) * scenarios[('s_pr', cur_scenario)]
+                        if cur_scenario in results else bounds[cur_scenario]
+                        for cur_scenario in scenario_list]) <= reject_below
+
+    failed_grids = dominance_index.evaluate(scenario_list,
+                                            lambda cur_scenario: cfe(power_grid.copy(),
+                                                                     scenarios[('s', cur_scenario)]),
+                                            stop)
+    bounded = len(failed_grids) < len(scenario_list)
+    supply = sum([scenario_supply(failed_grids[cur_scenario]) * scenarios[('s_pr', cur_scenario)]
+                  for cur_scenario in failed_grids.keys()])
+    if bounded:
+        supply += sum([bounds[cur_scenario] for cur_scenario in scenario_list if cur_scenario not in failed_grids])
+    # count the number of times each edge failed (not including initial failures)
+    failed_count = collections.Counter([cur_edge for cur_scenario in failed_grids.keys()
+                                        for cascade_step in range(failed_grids[cur_scenario]['t'])
+                                        for cur_edge in failed_grids[cur_scenario]['F'][cascade_step+1]])
+    return {'supply': supply, 'fail_count': failed_count, 'bounded': bounded,
+            'supply_per_scenario': [[cur_scenario, scenario_supply(failed_grids[cur_scenario])]
+                                    for cur_scenario in failed_grids.keys()]}
+
+
+@profiled('evaluation')
+def evaluate_grid(power_grid, scenarios, reject_below=None):
+    """
+    Evaluate a grid exactly by compute_current_supply (or compute_dominated_supply with --scenario_dominance),
+    or by the Monte-Carlo supply estimator (--supply_estimator).
+    :param power_grid: power grid as a networkx object with special properties (e.g. capacity, demand).
+    :param scenarios: failure (initial) scenarios
+    :param reject_below: see compute_dominated_supply (ignored without --scenario_dominance)
+    :return: A dictionary as returned by compute_current_supply (for an estimate, 'fail_count' and
+             'supply_per_scenario' cover only the simulated scenarios)
+    """
+    if supply_estimator is None:
+        if dominance_index is not None:
+            return compute_dominated_supply(power_grid, scenarios, reject_below)
+        return compute_current_supply(power_grid, scenarios)
+
+    def simulate(init_fail_edges):
+        failed_grid = cfe(power_grid.copy(), init_fail_edges)
+        cascade_failures = [cur_edge for cascade_step in range(failed_grid['t'])
+                            for cur_edge in failed_grid['F'][cascade_step+1]]
+        return sum([failed_grid['updated_grid_copy'].nodes[cur_node]['demand'] for cur_node in power_grid.nodes]), \
+            cascade_failures
+
+    return supply_estimator.estimate(power_grid, simulate)
+
+
+def is_improvement(outcome, incumbent_outcome):
+    """
+    :return: True if an outcome (of evaluate_grid) improves on the incumbent's. An estimated outcome improves only
+             by more than the confidence interval half width of the difference of the estimates, so that sampling
+             noise is not taken for an improvement (exact outcomes have no half width)
+    """
+    margin = math.sqrt(outcome.get('half_width', 0.0)**2 + incumbent_outcome.get('half_width', 0.0)**2)
+    return outcome['supply'] - incumbent_outcome['supply'] > margin
+
+
+def update_selection_samplers(grid_outcome):
+    """
+    Incrementally update the upgrade selection samplers from the outcome of compute_current_supply.
+    Only edges whose weight changed are updated (O(log E) each).
+    :param grid_outcome: the dictionary returned by compute_current_supply (for the current solution)
+    """
+    for bias_name, cur_sampler in edge_selection_samplers.iteritems():
+        cur_sampler.set_weights(grid_outcome[bias_name])
+
+
 def get_associated_edges(node, edges):
     """
     Get the associated edges leaving and coming into a specified (input) node
@@ -0,0 +1,145 @@
+# ------------------------------------------------------------------------------
+# Name:        Scenario dominance
+# Purpose:     An index over the initial outage sets of the scenarios, as bitsets (python integers, a bit
+#              per edge) arranged in a subset lattice (each outage set points to its minimal strict supersets).
+#              The cascade is deterministic given the set of failed edges, so once a scenario is simulated,
+#              every scenario whose outage set equals the cumulative failures of that cascade after some step
+#              (a superset of the simulated outage set) has a determined outcome - the rest of the same cascade -
+#              and does not have to be simulated. Scenarios are therefore simulated in lattice order (subsets
+#              first). Scenarios whose outcome is not determined can be bounded by their island structure:
+#              every island supplies at most min(demand, generation capacity), and the cascade only splits
+#              islands further.
+# ------------------------------------------------------------------------------
+
+import networkx as nx
+from edge_bitset import EdgeIndex, popcount
+
+
+class ScenarioDominanceIndex(object):
+    """
+    Bitset subset lattice of the scenarios' initial outage sets.
+    Usage: results = index.evaluate(scenario_names, simulate)
+    """
+
+    def __init__(self, scenarios):
+        """
+        :param scenarios: the scenarios dictionary {('s_pr', s): probability, ('s', s): failed edges}
+        """
+        self.edge_index = EdgeIndex()
+        self.masks = dict()
+        for key in sorted(scenarios.keys()):
+            if key[0] == 's':
+                self.masks[key[1]] = self.edge_index.mask(scenarios[key])
+        self.scenarios_by_mask = dict()
+        for name, mask in self.masks.items():
+            self.scenarios_by_mask.setdefault(mask, []).append(name)
+        # the lattice: every distinct outage set and its minimal strict supersets
+        distinct_masks = sorted(self.scenarios_by_mask.keys(), key=lambda mask: (popcount(mask), mask))
+        self.covers = dict()
+        for i, mask in enumerate(distinct_masks):
+            supersets = [other for other in distinct_masks[i + 1:] if other & mask == mask and other != mask]
+            self.covers[mask] = [other for other in supersets
+                                 if not any([other & between == between and other != between
+                                             for between in supersets])]
+        # statistics
+        self.num_simulated = 0
+        self.num_determined = 0
+
+    def supersets(self, name):
+        """
+        :return: the scenarios whose outage set strictly contains the outage set of scenario name (dominated ones)
+        """
+        found = set()
+        pending = list(self.covers[self.masks[name]])
+        while pending:
+            mask = pending.pop()
+            if mask not in found:
+                found.add(mask)
+                pending += self.covers[mask]
+        return [other for cur_mask in found for other in self.scenarios_by_mask[cur_mask]]
+
+    def determined_by(self, name, cascade):
+        """
+        The scenarios whose outcome is determined by the cascade of scenario name.
+        :param name: a simulated scenario
+        :param cascade: its cascade, a dictionary with 'F' (edges failed at each step) and 't' (number of steps)
+        :return: list of (scenario, step), the scenario's outage set equals the cumulative failures up to step
+        """
+        determined = [(other, 0) for other in self.scenarios_by_mask[self.masks[name]] if other != name]
+        cumulative = self.masks[name]
+        for step in range(1, cascade['t'] + 1):
+            if not cascade['F'][step]:
+                continue
+            step_mask = self.edge_index.mask(cascade['F'][step], add_edges=False)
+            if step_mask is None:
+                break  # no scenario fails an edge outside of the index
+            cumulative |= step_mask
+            determined += [(other, step) for other in self.scenarios_by_mask.get(cumulative, [])]
+        return determined
+
+    def evaluate(self, scenario_names, simulate, stop=None):
+        """
+        Simulate the scenarios in lattice order, skipping scenarios whose outcome is determined by a previous cascade.
+        :param scenario_names: the scenarios to evaluate
+        :param simulate: function of a scenario name, returning its cascade as returned by cfe
+                         (a dictionary with 'F', 't', 'all_failed' and 'updated_grid_copy')
+        :param stop: optional function of the results so far, returning True to stop the evaluation (e.g., by bounds)
+        :return: dictionary {scenario: cascade} (partial if stopped)
+        """
+        pending = set(scenario_names)
+        results = dict()
+        for cur_scenario in self.order(scenario_names):
+            if cur_scenario not in pending:
+                continue
+            results[cur_scenario] = simulate(cur_scenario)
+            pending.discard(cur_scenario)
+            self.num_simulated += 1
+            for other, step in self.determined_by(cur_scenario, results[cur_scenario]):
+                if other in pending:
+                    results[other] = derive_cascade(results[cur_scenario], step)
+                    pending.discard(other)
+                    self.num_determined += 1
+            if stop is not None and pending and stop(results):
+                break
+        return results
+
+    def order(self, scenario_names):
+        """
+        :return: the scenarios in lattice order (an outage set before its supersets)
+        """
+        return sorted(scenario_names, key=lambda name: (popcount(self.masks[name]), self.masks[name], name))
+
+
+def derive_cascade(cascade, step):
+    """
+    The cascade of a scenario whose initial failures are the cumulative failures of cascade up to step.
+    :return: a dictionary as returned by cfe (the grid copy is shared with cascade)
+    """
+    initial_failures = [cur_edge for cur_step in range(step + 1) for cur_edge in cascade['F'][cur_step]]
+    derived = {0: initial_failures}
+    for cur_step in range(step + 1, cascade['t'] + 1):
+        derived[cur_step - step] = cascade['F'][cur_step]
+    derived_cascade = {'F': derived, 't': cascade['t'] - step,
+                       'all_failed': initial_failures + [cur_edge for cur_step in range(1, cascade['t'] - step + 1)
+                                                         for cur_edge in derived[cur_step]],
+                       'updated_grid_copy': cascade['updated_grid_copy']}
+    if 'all_failed_mask' in cascade:
+        derived_cascade['all_failed_mask'] = cascade['all_failed_mask']  # the same edges fail by the end
+    return derived_cascade
+
+
+def island_supply_bound(power_grid, failed_edges):
+    """
+    An upper bound of the supply after the cascade of failed_edges: the supply of the islands right after the
+    initial failures, min(demand, generation capacity) of each island.
+    :param power_grid: power grid as a networkx object (nodes with 'demand' and 'gen_cap')
+    :param failed_edges: list of initially failed edges
+    """
+    failed = set([(min(cur_edge[0], cur_edge[1]), max(cur_edge[0], cur_edge[1])) for cur_edge in failed_edges])
+    islands_grid = nx.Graph()
+    islands_grid.add_nodes_from(power_grid.nodes())
+    islands_grid.add_edges_from([cur_edge for cur_edge in power_grid.edges()
+                                 if (min(cur_edge[0], cur_edge[1]), max(cur_edge[0], cur_edge[1])) not in failed])
+    return sum([min(sum([power_grid.nodes[cur_node]['demand'] for cur_node in island]),
+                    sum([power_grid.nodes[cur_node]['gen_cap'] for cur_node in island]))
+                for island in nx.connected_components(islands_grid)])
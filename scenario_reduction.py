@@ -0,0 +1,106 @@
+# ------------------------------------------------------------------------------
+# Name:        Scenario reduction
+# Purpose:     Reduce the scenario set before building the MIP. Every scenario is simulated on the
+#              base grid (no upgrades), and scenarios are clustered by their cascade signature -
+#              the set of all edges failed by the end of the cascade. Scenarios with identical
+#              signatures are merged, and near-identical ones (Jaccard distance of the signatures up to
+#              a tolerance) are merged greedily, most probable first. Each cluster is represented by its
+#              most probable scenario, with the aggregated probability of the cluster.
+#              Note that scenarios with the same signature on the base grid may still cascade
+#              differently once the grid is upgraded, hence the reduction error is reported.
+# ------------------------------------------------------------------------------
+
+
+def jaccard_distance(set_a, set_b):
+    union_size = len(set_a | set_b)
+    if union_size == 0:
+        return 0.0
+    return 1.0 - float(len(set_a & set_b)) / union_size
+
+
+def scenario_signatures(scenarios, simulate):
+    """
+    Simulate every scenario on the base grid.
+    :param scenarios: the scenarios dictionary {('s_pr', s): probability, ('s', s): failed edges}
+    :param simulate: function of a list of initially failed edges, returning (all failed edges, supply)
+    :return: dictionary {scenario: (frozenset of all failed edges, supply)}
+    """
+    signatures = dict()
+    for key in scenarios.keys():
+        if key[0] == 's_pr':
+            all_failed, supply = simulate(scenarios.get(('s', key[1]), []))
+            signatures[key[1]] = (frozenset(all_failed), supply)
+    return signatures
+
+
+def cluster_scenarios(scenarios, signatures, tolerance=0.0):
+    """
+    Cluster the scenarios by their cascade signatures.
+    :param scenarios: the scenarios dictionary
+    :param signatures: dictionary {scenario: (frozenset of all failed edges, supply)}, see scenario_signatures
+    :param tolerance: maximal Jaccard distance between the signature of a scenario and that of its cluster's
+                      representative (0 merges identical signatures only)
+    :return: dictionary {representative scenario: list of member scenarios (including the representative)}
+    """
+    # scenarios with identical signatures, most probable first (ties by name, for reproducibility)
+    groups = dict()
+    for scenario in sorted(signatures.keys(), key=lambda s: (-scenarios[('s_pr', s)], s)):
+        groups.setdefault(signatures[scenario][0], []).append(scenario)
+    ordered_groups = sorted(groups.values(), key=lambda members: (-sum([scenarios[('s_pr', s)] for s in members]),
+                                                                  members[0]))
+    clusters = dict()
+    for members in ordered_groups:
+        signature = signatures[members[0]][0]
+        nearest = None
+        if tolerance > 0:
+            distances = [(jaccard_distance(signature, signatures[representative][0]), representative)
+                         for representative in clusters.keys()]
+            distances = [distance for distance in distances if distance[0] <= tolerance]
+            if distances:
+                nearest = min(distances)[1]
+        if nearest is None:
+            clusters[members[0]] = list(members)
+        else:
+            clusters[nearest] += members
+    return clusters
+
+
+def reduce_scenarios(scenarios, clusters):
+    """
+    :param scenarios: the scenarios dictionary
+    :param clusters: dictionary {representative: members}, see cluster_scenarios
+    :return: a scenarios dictionary of the representatives, with the aggregated probabilities
+    """
+    reduced = dict()
+    for representative, members in clusters.items():
+        reduced[('s_pr', representative)] = sum([scenarios[('s_pr', s)] for s in members])
+        if ('s', representative) in scenarios:
+            reduced[('s', representative)] = scenarios[('s', representative)]
+    return reduced
+
+
+def reduction_report(scenarios, signatures, clusters):
+    """
+    The reduction error, measured on the base grid.
+    :return: dictionary {'num_scenarios', 'num_representatives', 'expected_supply', 'reduced_expected_supply',
+                         'supply_error', 'max_supply_deviation', 'max_jaccard_distance', 'merged_probability'}
+    """
+    expected_supply = sum([scenarios[('s_pr', s)] * signatures[s][1] for s in signatures.keys()])
+    reduced_expected_supply = 0.0
+    max_supply_deviation = 0.0
+    max_jaccard_distance = 0.0
+    merged_probability = 0.0
+    for representative, members in clusters.items():
+        reduced_expected_supply += sum([scenarios[('s_pr', s)] for s in members]) * signatures[representative][1]
+        for s in members:
+            if s != representative:
+                merged_probability += scenarios[('s_pr', s)]
+                max_supply_deviation = max(max_supply_deviation,
+                                           abs(signatures[s][1] - signatures[representative][1]))
+                max_jaccard_distance = max(max_jaccard_distance,
+                                           jaccard_distance(signatures[s][0], signatures[representative][0]))
+    return {'num_scenarios': len(signatures), 'num_representatives': len(clusters),
+            'expected_supply': expected_supply, 'reduced_expected_supply': reduced_expected_supply,
+            'supply_error': abs(expected_supply - reduced_expected_supply),
+            'max_supply_deviation': max_supply_deviation, 'max_jaccard_distance': max_jaccard_distance,
+            'merged_probability': merged_probability}
@@ -0,0 +1,65 @@
+# ------------------------------------------------------------------------------
+# Name:        Search checkpoint
+# Purpose:     A serializable state of the heuristic search (robustness_heuristic_upper_bound.py), saved
+#              periodically as a checkpoint, so that an interrupted run resumes from its last checkpoint
+#              instead of restarting, and a finished time limited run can be extended (e.g., continuing a
+#              1 hour run up to 12 hours, without redoing the first hour).
+#              The state is taken at the end of an iteration: the current, temporary and best solutions and
+#              their outcomes, the search counters, the time spent so far, the acceptance criterion, the
+#              operator selectors, the surrogate and the supply estimator, and the states of the random number
+#              generators (random and numpy.random). A checkpoint is written to a temporary file which then
+#              replaces the previous checkpoint, so a crash while writing leaves the previous checkpoint intact.
+# ------------------------------------------------------------------------------
+
+import os
+import pickle
+import random
+import numpy
+
+CHECKPOINT_VERSION = 1
+
+
+class SearchState(object):
+    """
+    The state of the search, as named fields (picklable values). Usage:
+    SearchState(loop_counter=..., ...).save(filename); state = load_search_state(filename); state.loop_counter
+    """
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def save(self, filename):
+        """
+        Save the state, with the random generators' states, as a checkpoint file.
+        """
+        checkpoint = {'version': CHECKPOINT_VERSION, 'fields': self.__dict__, 'random_state': random.getstate(),
+                      'numpy_random_state': numpy.random.get_state()}
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(filename + '.tmp', 'wb') as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, protocol=2)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        if os.path.exists(filename):
+            os.remove(filename)  # os.rename does not replace an existing file on windows
+        os.rename(filename + '.tmp', filename)
+
+
+def load_search_state(filename):
+    """
+    Load a checkpoint, and restore the random generators' states.
+    :return: a SearchState, None if there is no (valid) checkpoint
+    """
+    if not os.path.isfile(filename) and os.path.isfile(filename + '.tmp'):
+        filename = filename + '.tmp'  # interrupted between the removal of the previous checkpoint and the rename
+    try:
+        with open(filename, 'rb') as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if not isinstance(checkpoint, dict) or checkpoint.get('version') != CHECKPOINT_VERSION:
+        return None
+    random.setstate(checkpoint['random_state'])
+    numpy.random.set_state(checkpoint['numpy_random_state'])
+    return SearchState(**checkpoint['fields'])
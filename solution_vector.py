@@ -0,0 +1,107 @@
+# ------------------------------------------------------------------------------
+# Name:        Solution vector
+# Purpose:     Compact representation of heuristic solutions.
+#              A solution is a fixed length float64 vector of edge capacities over the
+#              universe of candidate edges of an instance (existing and establishable edges).
+#              The capacities are float64, as in the cascade simulation of main_program.py, so the failure
+#              test of an edge (abs(flow) > capacity) is the same in both.
+#              The base topology (nodes, susceptance, costs) is held once by EdgeUniverse,
+#              so copying, comparing, hashing and saving a solution are plain array operations.
+#              A networkx grid is built from a vector only when it is needed (simulation, export).
+# ------------------------------------------------------------------------------
+
+import networkx as nx
+import numpy
+
+
+class EdgeUniverse(object):
+    """
+    The shared (solution independent) part of an instance: the nodes and the ordered list of candidate edges
+    with their original capacity, susceptance, establishment cost (H) and upgrade cost (h).
+    An edge with capacity 0 in a solution vector does not exist in the corresponding grid.
+    """
+
+    def __init__(self, nodes, edges):
+        """
+        :param nodes: a dictionary of nodes, as output by InstanceBundle.nodes()
+        :param edges: a dictionary of edges, as output by InstanceBundle.edges()
+        """
+        self.node_list = sorted([node[1] for node in nodes.keys() if node[0] == 'd'])
+        self.node_attributes = [(cur_node, {'demand': nodes[('d', cur_node)],
+                                            'gen_cap': nodes[('c', cur_node)], 'generated': 0,
+                                            'un_sup_cost': 0, 'gen_cost': 0,
+                                            'original_demand': nodes[('d', cur_node)]})
+                                for cur_node in self.node_list]
+        self.edge_list = sorted([(edge[1], edge[2]) for edge in edges.keys() if edge[0] == 'c'])
+        self.position = {cur_edge: i for i, cur_edge in enumerate(self.edge_list)}
+        self.num_edges = len(self.edge_list)
+        self.original_capacity = numpy.array([edges[('c',) + cur_edge] for cur_edge in self.edge_list],
+                                             dtype=numpy.float64)
+        self.susceptance = numpy.array([edges[('x',) + cur_edge] for cur_edge in self.edge_list])
+        self.establish_cost = numpy.array([edges[('H',) + cur_edge] for cur_edge in self.edge_list])
+        self.upgrade_cost = numpy.array([edges[('h',) + cur_edge] for cur_edge in self.edge_list])
+
+    def initial_solution(self):
+        """
+        :return: the capacity vector of the original (not upgraded) grid
+        """
+        return self.original_capacity.copy()
+
+    def to_grid(self, capacities):
+        """
+        Build a power grid as a networkx object from a capacity vector.
+        :param capacities: a solution vector (float64, one entry per edge in edge_list)
+        :return: grid an nx.Graph() object with the proper nodes and edges (edges with capacity > 0)
+        """
+        grid = nx.Graph()
+        grid.add_nodes_from(self.node_attributes)
+        grid.add_edges_from([(cur_edge[0], cur_edge[1], {
+            'capacity': float(capacities[i]),
+            'susceptance': self.susceptance[i],
+            'establish_cost': self.establish_cost[i],
+            'upgrade_cost': self.upgrade_cost[i]})
+                             for i, cur_edge in enumerate(self.edge_list) if capacities[i] > 0])
+        return grid
+
+    def from_grid(self, power_grid):
+        """
+        The inverse of to_grid - read the capacities of a networkx grid (e.g., a gpickle) into a solution vector.
+        Edges of power_grid which are not in the universe are ignored.
+        """
+        capacities = numpy.zeros(self.num_edges, dtype=numpy.float64)
+        for edge in power_grid.edges():
+            cur_edge = (min(edge[0], edge[1]), max(edge[0], edge[1]))
+            if cur_edge in self.position:
+                capacities[self.position[cur_edge]] = power_grid.edges[edge]['capacity']
+        return capacities
+
+
+def solution_key(capacities):
+    """
+    A hashable key of a solution vector (its raw bytes), e.g., for dictionaries of evaluated solutions.
+    """
+    return capacities.tobytes()
+
+
+def save_solution(universe, capacities, filename):
+    """
+    Save a solution vector along with its edge list (a compressed numpy .npz file)
+    :param universe: the EdgeUniverse of the instance
+    :param capacities: the solution vector
+    :param filename: target file name (should end with .npz)
+    """
+    numpy.savez_compressed(filename, edges=numpy.array(universe.edge_list), capacities=capacities)
+
+
+def load_solution(universe, filename):
+    """
+    Load a solution vector saved by save_solution. Edges are matched by name, not by position.
+    :return: a solution vector ordered according to universe.edge_list
+    """
+    saved = numpy.load(filename)
+    capacities = numpy.zeros(universe.num_edges, dtype=numpy.float64)
+    for cur_edge, cur_capacity in zip(saved['edges'], saved['capacities']):
+        cur_edge = (str(cur_edge[0]), str(cur_edge[1]))
+        if cur_edge in universe.position:
+            capacities[universe.position[cur_edge]] = cur_capacity
+    return capacities
@@ -0,0 +1,219 @@
+# ------------------------------------------------------------------------------
+# Name:        Supply estimator
+# Purpose:     Monte-Carlo estimation of the expected supply of a grid over a (large) set of scenarios,
+#              as an alternative to the exact probability weighted sum of compute_current_supply.
+#              Scenarios are sampled (with replacement) either by
+#              importance  - a defensive mixture of the scenario probabilities and a proposal weighted
+#                            toward scenarios whose edges have high historical fail counts, or
+#              stratified  - strata by quantiles of the first-step loss, proportional allocation.
+#              The first-step supply (islanding only, no cascade) is computed for all scenarios at
+#              once (vectorized, no flow solution), and serves as a control variate with a known mean.
+#              Sampling stops once the confidence interval's half width reaches a target.
+# ------------------------------------------------------------------------------
+
+import collections
+import math
+import numpy
+from contingency_sampler import component_labels, component_totals
+
+Z_CRITICAL = {0.9: 1.6449, 0.95: 1.9600, 0.99: 2.5758}
+
+
+def first_step_supply(power_grid, scenario_failures, chunk_size=2048):
+    """
+    The supply right after the initial failures, before any cascade: every connected component supplies
+    min(demand, generation capacity), as the flow update does for islands.
+    :param power_grid: power grid as a networkx object (nodes with 'demand' and 'gen_cap')
+    :param scenario_failures: list of the failed edges of each scenario
+    :return: vector of the first-step supply of each scenario
+    """
+    node_list = list(power_grid.nodes())
+    node_position = {cur_node: i for i, cur_node in enumerate(node_list)}
+    edge_list = [(min(edge[0], edge[1]), max(edge[0], edge[1])) for edge in power_grid.edges()]
+    edge_position = {cur_edge: i for i, cur_edge in enumerate(edge_list)}
+    edge_u = numpy.array([node_position[cur_edge[0]] for cur_edge in edge_list], dtype=numpy.int64)
+    edge_v = numpy.array([node_position[cur_edge[1]] for cur_edge in edge_list], dtype=numpy.int64)
+    demand = numpy.array([power_grid.nodes[cur_node]['demand'] for cur_node in node_list], dtype=numpy.float64)
+    gen_cap = numpy.array([power_grid.nodes[cur_node]['gen_cap'] for cur_node in node_list], dtype=numpy.float64)
+    supply = numpy.zeros(len(scenario_failures))
+    for chunk_start in range(0, len(scenario_failures), chunk_size):
+        chunk = scenario_failures[chunk_start:chunk_start + chunk_size]
+        masks = numpy.zeros((len(chunk), len(edge_list)), dtype=bool)
+        for row, failures in enumerate(chunk):
+            # failures of edges which do not exist in the grid are ignored
+            masks[row, [edge_position[cur_edge] for cur_edge in failures if cur_edge in edge_position]] = True
+        labels = component_labels(masks, edge_u, edge_v, len(node_list))
+        supply[chunk_start:chunk_start + len(chunk)] = numpy.sum(
+            numpy.minimum(component_totals(labels, demand), component_totals(labels, gen_cap)), axis=1)
+    return supply
+
+
+class SupplyEstimator(object):
+    """
+    Estimates sum_s pr(s)*supply(s) over the scenarios dictionary by sampling scenarios.
+    The estimator keeps the fail counts of all its simulations (historical fail counts, for importance sampling).
+    """
+
+    def __init__(self, scenarios, mode='importance', target_half_width=0.0, confidence=0.95, batch_size=10,
+                 min_samples=30, max_samples=0, num_strata=5, smoothing=1.0, seed=None):
+        """
+        :param scenarios: the scenarios dictionary {('s_pr', s): probability, ('s', s): failed edges}
+        :param mode: importance or stratified
+        :param target_half_width: stop when the confidence interval's half width is below this (supply units)
+        :param confidence: confidence level of the interval (0.9, 0.95 or 0.99)
+        :param batch_size: number of samples between stopping checks
+        :param min_samples: minimal number of samples (with fewer scenarios than this, all are simulated exactly)
+        :param max_samples: maximal number of samples (0 for the number of scenarios)
+        :param num_strata: number of strata (stratified mode)
+        :param smoothing: added to the historical fail count of every edge (importance mode)
+        :param seed: random seed
+        """
+        if mode not in ('importance', 'stratified'):
+            raise ValueError('Unknown estimator mode: ' + str(mode))
+        if confidence not in Z_CRITICAL:
+            raise ValueError('Confidence must be one of ' + str(sorted(Z_CRITICAL.keys())))
+        self.names = sorted([key[1] for key in scenarios.keys() if key[0] == 's'])
+        self.failures = [scenarios[('s', name)] for name in self.names]
+        self.probabilities = numpy.array([scenarios[('s_pr', name)] for name in self.names], dtype=numpy.float64)
+        self.total_probability = self.probabilities.sum()
+        self.mode = mode
+        self.target_half_width = target_half_width
+        self.z_value = Z_CRITICAL[confidence]
+        self.batch_size = batch_size
+        self.min_samples = min_samples
+        self.max_samples = max_samples if max_samples > 0 else len(self.names)
+        self.num_strata = num_strata
+        self.smoothing = smoothing
+        self.random_state = numpy.random.RandomState(seed)
+        self.fail_count = collections.Counter()  # historical fail counts of all simulations
+        self.num_simulations = 0
+
+    def proposal(self):
+        """
+        :return: the importance sampling proposal over the scenarios (a defensive mixture with the probabilities)
+        """
+        target = self.probabilities / self.total_probability
+        tilt = numpy.array([self.smoothing + sum([self.fail_count[cur_edge] for cur_edge in failures])
+                            for failures in self.failures])
+        tilted = target * tilt / numpy.sum(target * tilt)
+        return 0.5 * target + 0.5 * tilted
+
+    def strata(self, control):
+        """
+        Split the scenarios into strata of (about) equal probability mass by quantiles of the control variate.
+        :return: vector of the stratum of each scenario
+        """
+        order = numpy.argsort(control, kind='mergesort')
+        mass_before = numpy.cumsum(self.probabilities[order]) - self.probabilities[order]
+        stratum = numpy.zeros(len(control), dtype=numpy.int64)
+        stratum[order] = numpy.minimum(self.num_strata - 1,
+                                       (mass_before / self.total_probability * self.num_strata).astype(numpy.int64))
+        return stratum
+
+    def estimate(self, power_grid, simulate):
+        """
+        Estimate the expected supply of power_grid.
+        :param power_grid: power grid as a networkx object
+        :param simulate: function of a list of failed edges, returning (supply, list of edges failed in the cascade)
+        :return: dictionary {'supply', 'half_width', 'num_samples', 'num_simulations', 'beta',
+                             'fail_count', 'supply_per_scenario'} (fail_count and supply_per_scenario refer to the
+                             simulated scenarios only)
+        """
+        simulated = dict()  # scenario position -> supply, each scenario is simulated at most once
+        fail_count = collections.Counter()
+
+        def simulated_supply(position):
+            if position not in simulated:
+                supply, cascade_failures = simulate(self.failures[position])
+                simulated[position] = supply
+                fail_count.update(cascade_failures)
+            return simulated[position]
+
+        if len(self.names) <= self.min_samples:
+            # a small scenario set is computed exactly
+            supply = sum([self.probabilities[i] * simulated_supply(i) for i in range(len(self.names))])
+            result = {'supply': supply, 'half_width': 0.0, 'num_samples': len(self.names), 'beta': 0.0}
+        else:
+            control = first_step_supply(power_grid, self.failures)
+            if self.mode == 'importance':
+                result = self.importance_estimate(control, simulated_supply)
+            else:
+                result = self.stratified_estimate(control, simulated_supply)
+        self.fail_count.update(fail_count)
+        self.num_simulations += len(simulated)
+        result.update({'num_simulations': len(simulated), 'fail_count': fail_count,
+                       'supply_per_scenario': [[self.names[i], simulated[i]] for i in sorted(simulated.keys())]})
+        return result
+
+    def importance_estimate(self, control, simulated_supply):
+        target = self.probabilities / self.total_probability
+        proposal = self.proposal()
+        likelihood_ratio = target / proposal
+        control_mean = numpy.sum(target * control)
+        weighted_values = []
+        weighted_controls = []
+        while True:
+            for position in self.random_state.choice(len(target), size=self.batch_size, p=proposal):
+                weighted_values.append(likelihood_ratio[position] * simulated_supply(position))
+                weighted_controls.append(likelihood_ratio[position] * control[position])
+            estimate, half_width, beta = self.control_variate_estimate(
+                [(1.0, numpy.array(weighted_values), numpy.array(weighted_controls), control_mean)])
+            if self.stop(len(weighted_values), half_width):
+                break
+        return {'supply': self.total_probability * estimate, 'half_width': self.total_probability * half_width,
+                'num_samples': len(weighted_values), 'beta': beta}
+
+    def stratified_estimate(self, control, simulated_supply):
+        stratum = self.strata(control)
+        members = [numpy.flatnonzero(stratum == h) for h in range(self.num_strata)]
+        members = [cur_members for cur_members in members if len(cur_members) > 0]
+        masses = [self.probabilities[cur_members].sum() / self.total_probability for cur_members in members]
+        within = [self.probabilities[cur_members] / self.probabilities[cur_members].sum() for cur_members in members]
+        control_means = [numpy.sum(within[h] * control[members[h]]) for h in range(len(members))]
+        values = [[] for h in range(len(members))]
+        controls = [[] for h in range(len(members))]
+        num_samples = 0
+        while True:
+            num_samples += self.batch_size
+            for h in range(len(members)):
+                # proportional allocation, at least two samples per stratum for its variance
+                required = max(2, int(math.ceil(masses[h] * num_samples)))
+                if required > len(values[h]):
+                    for position in self.random_state.choice(members[h], size=required - len(values[h]),
+                                                             p=within[h]):
+                        values[h].append(simulated_supply(position))
+                        controls[h].append(control[position])
+            estimate, half_width, beta = self.control_variate_estimate(
+                [(masses[h], numpy.array(values[h]), numpy.array(controls[h]), control_means[h])
+                 for h in range(len(members))])
+            if self.stop(sum([len(cur_values) for cur_values in values]), half_width):
+                break
+        return {'supply': self.total_probability * estimate, 'half_width': self.total_probability * half_width,
+                'num_samples': sum([len(cur_values) for cur_values in values]), 'beta': beta}
+
+    def control_variate_estimate(self, strata):
+        """
+        Stratified mean with a pooled control variate coefficient (a single stratum for importance sampling).
+        :param strata: list of (stratum mass, sampled values, sampled controls, known control mean)
+        :return: (estimate, confidence interval half width, control variate coefficient)
+        """
+        covariance = 0.0
+        control_variance = 0.0
+        for mass, values, controls, control_mean in strata:
+            if len(values) > 1:
+                covariance += mass ** 2 / len(values) * numpy.cov(values, controls)[0, 1]
+                control_variance += mass ** 2 / len(values) * numpy.var(controls, ddof=1)
+        beta = covariance / control_variance if control_variance > 0 else 0.0
+        estimate = 0.0
+        variance = 0.0
+        for mass, values, controls, control_mean in strata:
+            adjusted = values - beta * (controls - control_mean)
+            estimate += mass * numpy.mean(adjusted)
+            if len(values) > 1:
+                variance += mass ** 2 * numpy.var(adjusted, ddof=1) / len(values)
+        return estimate, self.z_value * math.sqrt(variance), beta
+
+    def stop(self, num_samples, half_width):
+        if num_samples >= self.max_samples:
+            return True
+        return num_samples >= self.min_samples and half_width <= self.target_half_width
@@ -0,0 +1,142 @@
+# ------------------------------------------------------------------------------
+# Name:        Surrogate screening
+# Purpose:     A cheap surrogate of the cascade simulation, used by the LNS heuristic to
+#              pre-screen neighbors before the full (costly) evaluation with compute_current_supply.
+#              The surrogate is an online ridge regression, predicting the change in supply of a
+#              neighbor relative to the current solution, from the capacity deltas of the edges
+#              and the deltas weighted by the edges' fail counts in the current solution.
+#              Screened out neighbors are occasionally simulated anyway (audit), in order to report
+#              how many true improvements the surrogate filtered out.
+# ------------------------------------------------------------------------------
+
+import random
+import numpy
+
+
+class RidgeSurrogate(object):
+    """
+    Online ridge regression over capacity delta features.
+    Observations are accumulated in X'X and X'y, and the coefficients are refitted every refit_interval observations.
+    """
+
+    def __init__(self, universe, ridge_lambda=1.0, min_observations=30, refit_interval=10):
+        """
+        :param universe: EdgeUniverse of the instance
+        :param ridge_lambda: regularization coefficient
+        :param min_observations: number of observations before the surrogate is used for screening
+        :param refit_interval: refit the coefficients every refit_interval new observations
+        """
+        self.universe = universe
+        self.ridge_lambda = ridge_lambda
+        self.min_observations = min_observations
+        self.refit_interval = refit_interval
+        self.num_features = 2 * universe.num_edges + 1
+        self.xtx = numpy.zeros((self.num_features, self.num_features))
+        self.xty = numpy.zeros(self.num_features)
+        self.coefficients = None
+        self.num_observations = 0
+        # calibration statistics
+        self.kept = 0  # candidates which were fully simulated after screening
+        self.kept_improvements = 0
+        self.screened_out = 0  # candidates which were not simulated due to screening
+        self.audited = 0  # screened out candidates which were simulated anyway
+        self.audited_improvements = 0
+        self.predictions = []  # pairs of [predicted, actual] change in supply of simulated candidates
+
+    def features(self, candidate, current, fail_weights):
+        """
+        :param candidate: the neighbor's solution vector
+        :param current: the current solution's vector
+        :param fail_weights: vector of the fail count of each edge in the current solution
+        :return: the feature vector of the candidate
+        """
+        delta = candidate - current
+        return numpy.concatenate([delta, delta * fail_weights, [1.0]])
+
+    def is_trained(self):
+        return self.coefficients is not None and self.num_observations >= self.min_observations
+
+    def predict(self, features):
+        """
+        :return: the predicted change in supply (0 if the surrogate is not trained yet)
+        """
+        if self.coefficients is None:
+            return 0.0
+        return float(numpy.dot(self.coefficients, features))
+
+    def add_observation(self, features, actual_change):
+        """
+        Train the surrogate with a fully simulated candidate.
+        :param features: the candidate's features
+        :param actual_change: the simulated change in supply relative to the current solution
+        """
+        self.predictions.append([self.predict(features), actual_change])
+        self.xtx += numpy.outer(features, features)
+        self.xty += features * actual_change
+        self.num_observations += 1
+        if self.num_observations % self.refit_interval == 0:
+            self.coefficients = numpy.linalg.solve(self.xtx + self.ridge_lambda * numpy.eye(self.num_features),
+                                                   self.xty)
+
+    def screen(self, candidate_features, keep_fraction, audit_probability):
+        """
+        Rank candidates by their predicted change in supply, and decide which ones to simulate.
+        Until the surrogate is trained all candidates are kept.
+        :param candidate_features: list of feature vectors
+        :param keep_fraction: the fraction of top ranked candidates to simulate (at least one)
+        :param audit_probability: probability of simulating a screened out candidate (for calibration)
+        :return: (indices of kept candidates, indices of audited candidates), best predicted first
+        """
+        if not self.is_trained():
+            return list(range(len(candidate_features))), []
+        predicted = [self.predict(cur_features) for cur_features in candidate_features]
+        ranked = sorted(range(len(candidate_features)), key=lambda i: predicted[i], reverse=True)
+        num_kept = max(1, int(round(keep_fraction * len(ranked))))
+        kept = ranked[:num_kept]
+        audited = [i for i in ranked[num_kept:] if random.random() < audit_probability]
+        self.screened_out += len(ranked) - num_kept
+        return kept, audited
+
+    def record_outcome(self, actual_change, audited):
+        """
+        Record whether a simulated candidate (kept or audited) was a true improvement, for calibration.
+        """
+        if audited:
+            self.audited += 1
+            self.audited_improvements += actual_change > 0
+        else:
+            self.kept += 1
+            self.kept_improvements += actual_change > 0
+
+    def calibration_report(self):
+        """
+        :return: rows of [measure, value] describing the quality of the screening
+        """
+        audit_rate = float(self.audited_improvements) / self.audited if self.audited else float('nan')
+        if len(self.predictions) > 2:
+            predictions = numpy.array(self.predictions)
+            correlation = float(numpy.corrcoef(predictions[:, 0], predictions[:, 1])[0, 1])
+        else:
+            correlation = float('nan')
+        return [['observations', self.num_observations],
+                ['simulated_after_screening', self.kept],
+                ['improvements_after_screening', self.kept_improvements],
+                ['screened_out', self.screened_out],
+                ['audited_screened_out', self.audited],
+                ['audited_improvements', self.audited_improvements],
+                ['audited_improvement_rate', audit_rate],
+                ['estimated_improvements_filtered_out', audit_rate * self.screened_out],
+                ['prediction_correlation', correlation]]
+
+
+def fail_count_vector(universe, fail_count):
+    """
+    :param universe: EdgeUniverse of the instance
+    :param fail_count: the fail_count dictionary {edge: count} of compute_current_supply
+    :return: the fail counts as a vector ordered according to universe.edge_list
+    """
+    fail_weights = numpy.zeros(universe.num_edges)
+    for cur_edge, cur_count in fail_count.items():
+        if cur_edge in universe.position:
+            fail_weights[universe.position[cur_edge]] = cur_count
+    return fail_weights
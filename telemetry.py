@@ -0,0 +1,237 @@
+# ------------------------------------------------------------------------------
+# Name:        Telemetry
+# Purpose:     Live progress metrics of a run (counters, gauges and histograms), for monitoring long batch
+#              runs without parsing their screen output.
+#              counters   - totals which only increase (simulations, incumbents found, lazy callbacks, ...), their
+#                           rate per second since the start of the run is reported as well
+#              gauges     - the current value of a measure (incumbent, time on simulations, cache hit rate, ...)
+#              histograms - the distribution of an observed value (e.g., the cascade depth), counts per bucket
+#              The metrics are reported as a json snapshot, written periodically (--metrics_file, replaced
+#              atomically every --metrics_interval seconds and on exit), and/or served over a local http
+#              endpoint (--metrics_port, http://127.0.0.1:<port>/metrics).
+# ------------------------------------------------------------------------------
+
+import atexit
+import json
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+DEFAULT_BUCKETS = [0, 1, 2, 3, 4, 5, 7, 10, 15, 20, 30, 50, 100]
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        """
+        :param buckets: sorted upper bounds of the buckets (a last bucket collects the values above them)
+        """
+        self.buckets = list(buckets)
+        self.counts = [0]*(len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        position = 0
+        while position < len(self.buckets) and value > self.buckets[position]:
+            position += 1
+        self.counts[position] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        """
+        Add the observations of another histogram (with the same buckets)
+        """
+        self.counts = [cur_count + other_count for cur_count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        for value in [other.min, other.max]:
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        return {'buckets': [['<=' + str(bound), cur_count] for bound, cur_count in zip(self.buckets, self.counts)] +
+                           [['>' + str(self.buckets[-1]) if self.buckets else 'all', self.counts[-1]]],
+                'count': self.count, 'mean': self.total / self.count if self.count else None,
+                'min': self.min, 'max': self.max}
+
+
+class Metrics(object):
+    """
+    A registry of metrics. Usage: metrics.inc('simulations'); metrics.set('incumbent', 10.5);
+    metrics.observe('cascade_depth', 3); metrics.snapshot()
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # the metrics are reported by other threads
+        self.start_time = time.time()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def counter(self, name):
+        return self.counters.get(name, 0)
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value, buckets=None):
+        """
+        :param buckets: the buckets of a new histogram [default DEFAULT_BUCKETS]
+        """
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(DEFAULT_BUCKETS if buckets is None else buckets)
+            self.histograms[name].observe(value)
+
+    def snapshot(self):
+        """
+        :return: a dictionary of the metrics (json serializable)
+        """
+        with self.lock:
+            uptime = time.time() - self.start_time
+            return {'time': time.time(), 'pid': os.getpid(), 'uptime': uptime,
+                    'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                    'rates': {name + '_per_sec': value / uptime if uptime > 0 else 0.0
+                              for name, value in self.counters.items()},
+                    'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+
+    def take_deltas(self):
+        """
+        Remove the counters and histograms, e.g., of a worker process, whose metrics do not reach the run's metrics
+        otherwise - they are passed to the parent process and added to its metrics by merge_deltas.
+        :return: (counters, histograms) since the last call (or reset)
+        """
+        with self.lock:
+            deltas = (self.counters, self.histograms)
+            self.counters = dict()
+            self.histograms = dict()
+            return deltas
+
+    def merge_deltas(self, deltas):
+        """
+        :param deltas: (counters, histograms) of take_deltas, added to the metrics
+        """
+        counters, histograms = deltas
+        with self.lock:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, histogram in histograms.items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(histogram.buckets)
+                self.histograms[name].merge(histogram)
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+
+
+metrics = Metrics()  # the metrics of the run
+snapshot_filename = ''  # set by start_reporting, see write_snapshot
+reporting_stop = None  # event which stops the snapshot thread, see stop_reporting
+reporting_server = None  # the http server of the endpoint, see stop_reporting
+
+
+def write_snapshot(filename=None):
+    """
+    Write the metrics as a json file (replaced atomically, so a reader never sees a partial snapshot).
+    """
+    filename = snapshot_filename if filename is None else filename
+    if not filename:
+        return
+    with open(filename + '.tmp', 'w') as snapshot_file:
+        json.dump(metrics.snapshot(), snapshot_file, sort_keys=True, default=str)
+    if os.path.exists(filename):
+        os.remove(filename)  # os.rename does not replace an existing file on windows
+    os.rename(filename + '.tmp', filename)
+
+
+def write_snapshots(interval, stop):
+    while not stop.wait(interval):
+        try:
+            write_snapshot()
+        except (IOError, OSError):
+            pass  # e.g., the file is locked by its reader - the next snapshot replaces it
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ['', '/metrics']:
+            self.send_error(404)
+            return
+        body = json.dumps(metrics.snapshot(), sort_keys=True, default=str).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no screen output per request
+
+
+def start_reporting(filename='', port=0, interval=30.0):
+    """
+    Start reporting the metrics, by background threads.
+    :param filename: the json snapshot file (empty for no snapshots)
+    :param port: the local http port (0 for no endpoint)
+    :param interval: seconds between snapshots
+    :return: the http server (None without an endpoint)
+    """
+    global snapshot_filename
+    global reporting_stop
+    global reporting_server
+    stop_reporting()  # the reporting of a previous run in the same process (e.g., a batch runner's worker)
+    metrics.reset()
+    if filename:
+        snapshot_filename = filename
+        reporting_stop = threading.Event()
+        snapshot_thread = threading.Thread(target=write_snapshots, args=(interval, reporting_stop),
+                                           name='metrics snapshots')
+        snapshot_thread.daemon = True
+        snapshot_thread.start()
+    if port:
+        reporting_server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+        server_thread = threading.Thread(target=reporting_server.serve_forever, name='metrics endpoint')
+        server_thread.daemon = True
+        server_thread.start()
+    return reporting_server
+
+
+def stop_reporting():
+    """
+    Write the last snapshot, stop the snapshot thread and close the http endpoint (releasing its port).
+    """
+    global snapshot_filename
+    global reporting_stop
+    global reporting_server
+    write_snapshot()
+    snapshot_filename = ''
+    if reporting_stop is not None:
+        reporting_stop.set()
+        reporting_stop = None
+    if reporting_server is not None:
+        reporting_server.shutdown()
+        reporting_server.server_close()
+        reporting_server = None
+
+
+atexit.register(write_snapshot)
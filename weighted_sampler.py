@@ -0,0 +1,156 @@
+# ------------------------------------------------------------------------------
+# Name:        Weighted sampler
+# Purpose:     Persistent weighted sampling of edges (or any other keys) for the LNS heuristic.
+#              Based on a Fenwick (binary indexed) tree, so that both a weight update
+#              and a weighted draw cost O(log n) instead of rebuilding a probability vector.
+#              Used for the failure count upgrade selection bias, and can hold any other
+#              non-negative bias (flow utilization, loss per scenario, etc.).
+# ------------------------------------------------------------------------------
+
+import random
+
+
+class FenwickSampler(object):
+    """
+    Weighted sampler over a fixed universe of keys (e.g., all candidate edges of the instance).
+    Keys are drawn with probability proportional to their (non-negative) weight.
+    Keys can be temporarily masked (weight treated as 0) without loosing their weight.
+    """
+
+    def __init__(self, keys, weights=None):
+        """
+        :param keys: the universe of keys (e.g., edges as (node1, node2) tuples)
+        :param weights: optional dictionary {key: weight} with initial weights (missing keys get 0)
+        """
+        self.keys = list(keys)
+        self.position = {cur_key: i for i, cur_key in enumerate(self.keys)}
+        self.size = len(self.keys)
+        self.weights = [0.0] * self.size  # the effective weight of each key (0 while masked)
+        self.tree = [0.0] * (self.size + 1)  # the Fenwick tree (1-based)
+        self.active = set()  # keys with a positive weight (masked keys included)
+        self.masked = dict()  # masked keys and the weight they hold while masked
+        # the highest power of 2 which is not larger than size, used when searching the tree
+        self.top_bit = 1
+        while self.top_bit * 2 <= self.size:
+            self.top_bit *= 2
+        if weights:
+            self.set_weights(weights)
+
+    def _add(self, index, delta):
+        # index is 0-based, the tree is 1-based
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & (-index)
+
+    def set_weight(self, key, weight):
+        """
+        Set the weight of a single key in O(log n). Unknown keys are ignored.
+        :param key: the key to update
+        :param weight: new (non-negative) weight
+        """
+        if key not in self.position:
+            return
+        weight = float(max(weight, 0))
+        if weight > 0:
+            self.active.add(key)
+        else:
+            self.active.discard(key)
+        if key in self.masked:
+            # keep the key masked, just remember the new weight
+            self.masked[key] = weight
+            return
+        index = self.position[key]
+        delta = weight - self.weights[index]
+        if delta != 0:
+            self.weights[index] = weight
+            self._add(index, delta)
+
+    def set_weights(self, new_weights):
+        """
+        Incrementally replace the weights with new_weights (e.g., a collections.Counter of failures).
+        Keys which currently have a positive weight but are missing from new_weights are set to 0.
+        Only keys which actually change are touched, i.e., O(k log n) for k changed keys.
+        :param new_weights: dictionary {key: weight}
+        """
+        for cur_key in [cur_key for cur_key in self.active if cur_key not in new_weights]:
+            self.set_weight(cur_key, 0)
+        for cur_key, cur_weight in new_weights.items():
+            if self.get_weight(cur_key) != cur_weight:
+                self.set_weight(cur_key, cur_weight)
+
+    def get_weight(self, key):
+        """
+        :return: the weight of key (the retained weight, if it is currently masked)
+        """
+        if key in self.masked:
+            return self.masked[key]
+        if key not in self.position:
+            return 0.0
+        return self.weights[self.position[key]]
+
+    def total(self):
+        """
+        :return: the sum of all (unmasked) weights
+        """
+        index = self.size
+        tot = 0.0
+        while index > 0:
+            tot += self.tree[index]
+            index -= index & (-index)
+        return tot
+
+    def mask(self, key):
+        """
+        Temporarily exclude key from sampling (its weight is retained, see unmask_all)
+        """
+        if key not in self.position or key in self.masked:
+            return
+        index = self.position[key]
+        self.masked[key] = self.weights[index]
+        if self.weights[index] != 0:
+            self._add(index, -self.weights[index])
+            self.weights[index] = 0.0
+
+    def mask_all_except(self, eligible_keys):
+        """
+        Mask every key with a positive weight which is not in eligible_keys.
+        Only keys with positive weights are examined, hence this is O(k log n) and not O(n).
+        :param eligible_keys: keys which should remain available for sampling
+        """
+        eligible_keys = set(eligible_keys)
+        for cur_key in [cur_key for cur_key in self.active if cur_key not in eligible_keys]:
+            self.mask(cur_key)
+
+    def unmask_all(self):
+        """
+        Restore the weights of all masked keys.
+        """
+        masked = self.masked
+        self.masked = dict()
+        for cur_key, cur_weight in masked.items():
+            self.set_weight(cur_key, cur_weight)
+
+    def sample(self, uniform=random.random):
+        """
+        Draw a key with probability proportional to its weight, in O(log n).
+        :param uniform: a function returning a uniform number in [0, 1)
+        :return: the selected key, or None if all (unmasked) weights are 0
+        """
+        tot = self.total()
+        if tot <= 0:
+            return None
+        target = uniform() * tot
+        # descend the tree and find the first index for which the prefix sum exceeds target
+        index = 0
+        bit = self.top_bit
+        while bit > 0:
+            next_index = index + bit
+            if next_index <= self.size and self.tree[next_index] <= target:
+                target -= self.tree[next_index]
+                index = next_index
+            bit >>= 1
+        if index >= self.size or self.weights[index] <= 0:
+            # can only happen due to floating point rounding - take the last key with a positive weight
+            index = max(i for i in range(self.size) if self.weights[i] > 0)
+        return self.keys[index]